@@ -27,13 +27,15 @@ gi_require_version('Gtk', '3.0')
 # если сей модуль, gtktools, указать первым перед прочими связанными
 # с GTK модулями - не придётся из оттудова дёргать gi_require_version()
 from gi.repository import Gtk, Gdk, GObject, GLib, Pango, Gio
-from gi.repository.GdkPixbuf import Pixbuf
+from gi.repository.GdkPixbuf import Pixbuf, Colorspace
 
 
 # для *ResourceLoader
 import zipfile
 from sys import stderr, argv
 import os.path
+from collections import OrderedDict
+from time import perf_counter
 
 
 REVISION = 2021042400
@@ -339,6 +341,63 @@ def flush_gtk_events():
         Gtk.main_iteration()
 
 
+def new_model_like(model):
+    """Создаёт новый пустой экземпляр Gtk.ListStore или Gtk.TreeStore
+    с тем же набором типов столбцов, что у model.
+    Полезно, когда новое содержимое надо заполнить отдельно
+    от отображаемой модели и подставить в Gtk.TreeView одним махом."""
+
+    coltypes = [model.get_column_type(i) for i in range(model.get_n_columns())]
+
+    if isinstance(model, Gtk.TreeStore):
+        return Gtk.TreeStore(*coltypes)
+    else:
+        return Gtk.ListStore(*coltypes)
+
+
+class SwatchCache():
+    """Кэш значков-образцов цвета - экземпляров Pixbuf, залитых
+    одним цветом.
+
+    Одинаковые образцы (один цвет и размер) используются совместно,
+    поэтому менять содержимое полученных из кэша Pixbuf нельзя.
+    Размер кэша ограничен, дольше всех не запрашивавшиеся образцы
+    из кэша выбрасываются (при этом те, что ещё где-то используются,
+    продолжают жить, пока на них есть ссылки)."""
+
+    MAX_SWATCHES = 4096
+
+    def __init__(self, maxswatches=MAX_SWATCHES):
+        """maxswatches  - максимальное кол-во образцов в кэше."""
+
+        self.maxSwatches = maxswatches
+        self.swatches = OrderedDict()
+
+    def get_swatch(self, rgb, size):
+        """Возвращает экземпляр Pixbuf размером size*size пикселов,
+        залитый цветом rgb (целое 0xRRGGBB)."""
+
+        key = (rgb & 0xffffff, size)
+
+        pbuf = self.swatches.get(key)
+
+        if pbuf is None:
+            pbuf = Pixbuf.new(Colorspace.RGB, False, 8, size, size)
+            pbuf.fill((key[0] << 8) | 0xff)
+
+            self.swatches[key] = pbuf
+
+            if len(self.swatches) > self.maxSwatches:
+                self.swatches.popitem(last=False)
+        else:
+            self.swatches.move_to_end(key)
+
+        return pbuf
+
+    def clear(self):
+        self.swatches.clear()
+
+
 def get_resource_loader():
     """Возвращает экземпляр класса FileResourceLoader
     или ZipFileResourceLoader, в зависимости от того, как запущена
@@ -482,9 +541,166 @@ class ZipFileResourceLoader(FileResourceLoader):
                 raise Exception('Не удалось загрузить файл "%s" - %s' % (filename, str(ex)))
 
 
+class TreeModelIndex():
+    """Индекс для быстрого поиска строк Gtk.TreeModel по значению
+    одного из столбцов.
+
+    Значения столбца должны быть хэшируемыми; строки со значением
+    None в индекс не попадают.
+    Сигналы модели индекс не слушает (сигнал "row-deleted" значения
+    удалённой строки не сообщает), поэтому строки Gtk.ListStore
+    и Gtk.TreeStore следует добавлять и удалять методами индекса -
+    append(), remove() и clear(); сдвиг строк при вставке и удалении
+    отслеживают сами Gtk.TreeRowReference.
+    Индекс для модели, которую меняют иначе (или для неизменяемой
+    модели), строится rebuild() или iter_rebuild().
+
+    Поля:
+        model   - экземпляр Gtk.TreeModel;
+        column  - номер столбца;
+        rows    - словарь, где ключи - значения столбца,
+                  а значения - списки экземпляров Gtk.TreeRowReference
+                  строк с этим значением в порядке добавления."""
+
+    def __init__(self, model, column, build=True):
+        """Параметры:
+            model   - экземпляр Gtk.TreeModel;
+            column  - номер столбца;
+            build   - булевское значение; если True - индекс сразу
+                      строится по имеющимся строкам model."""
+
+        self.model = model
+        self.column = column
+        self.rows = {}
+
+        if build:
+            self.rebuild()
+
+    def add_row(self, itr):
+        """Добавление в индекс уже имеющейся в модели строки itr
+        (экземпляра Gtk.TreeIter)."""
+
+        v = self.model.get_value(itr, self.column)
+
+        if v is not None:
+            ref = Gtk.TreeRowReference.new(self.model, self.model.get_path(itr))
+
+            refs = self.rows.get(v)
+            if refs is None:
+                self.rows[v] = [ref]
+            else:
+                refs.append(ref)
+
+    def __discard_row(self, itr):
+        # удаление из индекса строки itr и её дочерних строк
+        v = self.model.get_value(itr, self.column)
+
+        refs = self.rows.get(v)
+        if refs is not None:
+            path = self.model.get_path(itr)
+
+            for ix, ref in enumerate(refs):
+                if ref.get_path() == path:
+                    del refs[ix]
+                    break
+
+            if not refs:
+                del self.rows[v]
+
+        subitr = self.model.iter_children(itr)
+        while subitr is not None:
+            self.__discard_row(subitr)
+            subitr = self.model.iter_next(subitr)
+
+    def append(self, values, parent=None):
+        """Добавление строки в конец model (Gtk.ListStore или
+        Gtk.TreeStore) с занесением её в индекс.
+
+        values  - кортеж (или список) значений столбцов;
+        parent  - None или Gtk.TreeIter родительской строки
+                  (только для Gtk.TreeStore).
+
+        Возвращает Gtk.TreeIter добавленной строки."""
+
+        if isinstance(self.model, Gtk.TreeStore):
+            itr = self.model.append(parent, values)
+        else:
+            itr = self.model.append(values)
+
+        self.add_row(itr)
+
+        return itr
+
+    def remove(self, itr):
+        """Удаление строки itr (и её дочерних строк) из model
+        и из индекса.
+        Возвращает то же, что и Gtk.*Store.remove()."""
+
+        self.__discard_row(itr)
+
+        return self.model.remove(itr)
+
+    def clear(self):
+        """Очистка model и индекса."""
+
+        self.rows.clear()
+        self.model.clear()
+
+    def iter_rebuild(self):
+        """Генератор, строящий индекс заново - по одной строке
+        модели за шаг (для выполнения по кусочку в обработчике
+        GLib.idle_add()).
+        Пока генератор не закончил работу, индекс неполон.
+        Возвращаемые значения - Gtk.TreeIter обработанной строки."""
+
+        self.rows.clear()
+
+        def __walk(parent):
+            itr = self.model.iter_children(parent)
+
+            while itr is not None:
+                self.add_row(itr)
+                yield itr
+
+                yield from __walk(itr)
+
+                itr = self.model.iter_next(itr)
+
+        yield from __walk(None)
+
+    def rebuild(self):
+        """Полное перестроение индекса."""
+
+        for itr in self.iter_rebuild():
+            pass
+
+    def find(self, v):
+        """Возвращает Gtk.TreeIter первой (в порядке обхода дерева)
+        строки со значением v в столбце column, или None, если такой
+        строки нет."""
+
+        refs = self.rows.get(v)
+        if not refs:
+            return None
+
+        if len(refs) == 1:
+            path = refs[0].get_path()
+        else:
+            # строки в Gtk.TreeStore могли добавляться не по порядку -
+            # берём ту, что раньше всех при обходе дерева
+            path = min((ref.get_path() for ref in refs), key=lambda p: p.get_indices())
+
+        return self.model.get_iter(path)
+
+
 class TreeViewShell():
     """Обёртка для упрощения дёргания Gtk.TreeView"""
 
+    # если True - bulk_load() сообщает в stderr кол-во строк
+    # и скорость заполнения (для отслеживания регрессий);
+    # включается переменной окружения GTKTOOLS_DEBUG
+    REPORT_BULK_LOAD = bool(os.environ.get('GTKTOOLS_DEBUG'))
+
     def __init__(self, tv):
         """Параметры:
             tv      - экземпляр Gtk.TreeView.
@@ -508,6 +724,9 @@ class TreeViewShell():
         self.sortOrder = Gtk.SortType.ASCENDING
         self.sortColumn = -1
 
+        # None или экземпляр TreeModelIndex (см. set_index())
+        self.index = None
+
     class Cell():
         """Класс-хранилище параметров для создания Gtk.CellRenderer*"""
 
@@ -651,6 +870,67 @@ class TreeViewShell():
             if rows:
                 return self.store.get_iter(rows[0])
 
+    def set_index(self, index):
+        """Подключение индекса index (экземпляра TreeModelIndex,
+        построенного для store) для ускорения find_iter();
+        если index is None - индекс отключается.
+        При подключенном индексе строки следует добавлять
+        и удалять методами append_row(), remove_row() и clear()
+        (или через bulk_load() и refresh_begin()/refresh_end()),
+        чтобы индекс не расходился с содержимым store."""
+
+        self.index = index
+
+    def set_index_column(self, col):
+        """Включение индекса (см. TreeModelIndex) по столбцу col
+        с построением по имеющимся строкам store; если col is None -
+        индекс отключается."""
+
+        self.set_index(TreeModelIndex(self.store, col) if col is not None else None)
+
+    def __get_index(self):
+        # индекс годен, только если store не подменили после его построения
+        if self.index is not None and self.index.model is self.store:
+            return self.index
+
+    def append_row(self, values, parent=None):
+        """Добавление строки в конец store (Gtk.ListStore или
+        Gtk.TreeStore) с учётом индекса (см. set_index()).
+
+        values  - кортеж (или список) значений столбцов;
+        parent  - None или Gtk.TreeIter родительской строки
+                  (только для Gtk.TreeStore).
+
+        Возвращает Gtk.TreeIter добавленной строки."""
+
+        index = self.__get_index()
+        if index is not None:
+            return index.append(values, parent)
+
+        if isinstance(self.store, Gtk.TreeStore):
+            return self.store.append(parent, values)
+        else:
+            return self.store.append(values)
+
+    def remove_row(self, itr):
+        """Удаление строки itr (экземпляра Gtk.TreeIter) из store
+        с учётом индекса (см. set_index())."""
+
+        index = self.__get_index()
+        if index is not None:
+            return index.remove(itr)
+
+        return self.store.remove(itr)
+
+    def clear(self):
+        """Очистка store (и индекса, если он подключен)."""
+
+        index = self.__get_index()
+        if index is not None:
+            index.clear()
+        else:
+            self.store.clear()
+
     def find_iter(self, col, v, fromIter=None):
         """Рекурсивный поиск положения в Gtk.TreeModel.
 
@@ -661,7 +941,15 @@ class TreeViewShell():
                       в случае None поиск идёт с первого элемента TreeModel.
 
         Возвращает Gtk.TreeIter для первого найденного значения,
-        или None, если ничего не находит."""
+        или None, если ничего не находит.
+        Если подключен индекс по столбцу col (см. set_index()),
+        а fromIter is None - поиск идёт по индексу."""
+
+        if fromIter is None:
+            index = self.__get_index()
+
+            if index is not None and index.column == col:
+                return index.find(v)
 
         itr = self.store.iter_children(fromIter)
         while itr:
@@ -694,6 +982,36 @@ class TreeViewShell():
         self.selection.select_path(path)
         self.view.set_cursor(path, col, edit)
 
+    def set_fixed_height_mode(self, colwidths=None):
+        """Включение режима с фиксированными высотой строк и шириной
+        столбцов - Gtk.TreeView в этом режиме не измеряет каждую
+        строку, что заметно ускоряет прокрутку и разворачивание ветвей
+        с большим кол-вом строк.
+        Все строки при этом должны быть одной высоты.
+
+        colwidths   - None или последовательность ширин содержимого
+                      столбцов в пикселах (отсутствующие значения
+                      и значения None считаются нулями); ширина столбца
+                      берётся не меньше ширины его заголовка, плюс
+                      поля."""
+
+        for ix, col in enumerate(self.view.get_columns()):
+            width = colwidths[ix] if colwidths is not None and ix < len(colwidths) else None
+
+            title = col.get_title()
+            width = max(width or 0, self.get_text_width(title) if title else 0) + WIDGET_BASE_WIDTH * 2
+
+            col.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            col.set_fixed_width(width)
+
+        self.view.set_fixed_height_mode(True)
+
+    def get_text_width(self, text):
+        """Возвращает ширину text в пикселах при отображении
+        шрифтом self.view."""
+
+        return self.view.create_pango_layout(text).get_pixel_size()[0]
+
     def enable_sorting(self, enable):
         """Разрешение/запрет сортировки treestore."""
 
@@ -708,14 +1026,102 @@ class TreeViewShell():
 
         self.view.set_model(None)
         self.enable_sorting(False)
-        self.store.clear()
+        self.clear()
 
     def refresh_end(self):
-        """Завершение заполнения данными."""
+        """Завершение заполнения данными; индекс (если подключен)
+        строится заново, т.к. store заполнялся в обход него."""
+
+        index = self.__get_index()
+        if index is not None:
+            index.rebuild()
 
         self.enable_sorting(True)
         self.view.set_model(self.store)
 
+    def bulk_load(self, rows, clear=True):
+        """Массовое заполнение store.
+
+        rows    - итерируемый объект:
+                  для Gtk.ListStore - с кортежами (или списками)
+                  значений столбцов;
+                  для Gtk.TreeStore - с кортежами из двух элементов:
+                  кортежа значений столбцов и итерируемого объекта
+                  с дочерними строками в том же формате (или None);
+        clear   - булевское значение; если True - store перед
+                  заполнением очищается.
+
+        На время заполнения store отключается от view (именно это
+        и экономит основное время - отключенному view не нужно
+        обрабатывать сигналы row-inserted), сортировка запрещается.
+        Строки добавляются через insert_with_values[v] со списком
+        номеров столбцов и значениями, заранее приведёнными к типам
+        столбцов - т.е. без лишней работы, которую делают
+        обёртки PyGObject над append().
+
+        Если подключен индекс (см. set_index()) - по окончании
+        заполнения он строится заново.
+
+        Возвращает кортеж из двух элементов - кол-ва добавленных строк
+        и скорости заполнения (строк в секунду); если REPORT_BULK_LOAD
+        равно True, эти же значения выводятся в stderr."""
+
+        t0 = perf_counter()
+
+        self.view.set_model(None)
+        self.enable_sorting(False)
+
+        nrows = 0
+
+        index = self.__get_index()
+
+        try:
+            if clear:
+                self.store.clear()
+
+            coltypes = [self.store.get_column_type(i) for i in range(self.store.get_n_columns())]
+            columns = list(range(len(coltypes)))
+
+            def __values(row):
+                return [GObject.Value(ctype, v) for ctype, v in zip(coltypes, row)]
+
+            if isinstance(self.store, Gtk.TreeStore):
+                insertf = self.store.insert_with_values
+
+                def __insert_tree(parent, trows):
+                    nonlocal nrows
+
+                    for row, children in trows:
+                        itr = insertf(parent, -1, columns, __values(row))
+                        nrows += 1
+
+                        if children:
+                            __insert_tree(itr, children)
+
+                __insert_tree(None, rows)
+            else:
+                insertf = self.store.insert_with_valuesv
+
+                for row in rows:
+                    insertf(-1, columns, __values(row))
+                    nrows += 1
+
+            if index is not None:
+                index.rebuild()
+        finally:
+            self.enable_sorting(True)
+            self.view.set_model(self.store)
+
+        dt = perf_counter() - t0
+        rate = nrows / dt if dt > 0 else 0.0
+
+        if self.REPORT_BULK_LOAD:
+            print('%s.bulk_load(): %d rows, %.3f s, %.0f rows/s' % (
+                Gtk.Buildable.get_name(self.view) or self.__class__.__name__,
+                nrows, dt, rate), file=stderr)
+
+        return (nrows, rate)
+
 
 def __debug_msgdlg():
     print(msg_dialog(None, 'Message dialog test', 'Delete anything?', buttons=Gtk.ButtonsType.YES_NO,
@@ -738,10 +1144,21 @@ def __debug_treeviewshell():
             TreeViewShell.Cell(2)), 'foo')))
 
 
+def __debug_bulk_load(nrows=100000):
+    tvsh = TreeViewShell.new_view(
+        (GObject.TYPE_STRING, GObject.TYPE_INT),
+        (TreeViewShell.Column((TreeViewShell.Cell(0),), 'name'),
+         TreeViewShell.Column((TreeViewShell.Cell(1),), 'value')))
+
+    n, rate = tvsh.bulk_load(('row %d' % i, i) for i in range(nrows))
+    print('bulk_load: %d rows, %.0f rows/s' % (n, rate))
+
+
 if __name__ == '__main__':
     print('[debugging %s]' % __file__)
 
     #__debug_msgdlg()
     #__debug_load_icon()
+    #__debug_bulk_load()
     __debug_treeviewshell()
 
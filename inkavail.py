@@ -23,11 +23,20 @@
 import os.path
 import sys
 from orgmodeparser import *
+from inktags import TagTable
 import re
 import datetime
 from math import sqrt
 from colorsys import rgb_to_hls
 from collections import OrderedDict, namedtuple
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # numpy - необязательная зависимость;
+    # без неё ColorArray обходится модулем array
+    numpy = None
 
 
 VERSION = '1.10.1'
@@ -91,36 +100,141 @@ RX_AVAIL_CR = re.compile('.*картридж.*', re.UNICODE|re.IGNORECASE)
 RX_INK_COLOR = re.compile('^цвет:\s*#([0-9,a-f]{6})$', re.UNICODE|re.IGNORECASE)
 RX_INK_MAIN_COLOR = re.compile('^основной\s+цвет:\s*(.*)$', re.UNICODE|re.IGNORECASE)
 
+# метка ветвей с описаниями чернил
+INK_TAG = 'ink'
+
+
+class InkHeadlineNode(OrgHeadlineNode):
+    """Ветвь с описанием чернил (заголовок с меткой INK_TAG).
+
+    Дополнительные поля в документе не хранятся, их значения
+    заполняются InkNodeStatistics.get_ink_node_statistics()
+    (до этого поля missing и usage равны None):
+    missing         - множество значений InkNodeStatistics.MISSING_*
+                      (чего не хватает в описании);
+    color           - None или целое 0xRRGGBB, образец цвета;
+    maincolor       - None или строка, метка основного цвета;
+    usage           - список экземпляров InkNodeStatistics.usageinfo;
+    daysSLU         - None или целое, кол-во дней с последнего
+                      использования;
+    avail           - булевское значение, есть ли чернила в наличии;
+    availMl         - float, объём в наличии в миллилитрах;
+    availCartridges - булевское значение, есть ли картриджи;
+    tagMask         - целое, битовая маска меток (см. TagTable)
+                      в таблице меток того экземпляра
+                      InkDescriptionParser, который разбирал ветвь."""
+
+    __slots__ = 'missing', 'color', 'maincolor', 'usage', 'daysSLU',\
+        'avail', 'availMl', 'availCartridges', 'tagMask'
+
+    def __init__(self, text):
+        super().__init__(text)
+
+        self.missing = None
+        self.color = None
+        self.maincolor = None
+        self.usage = None
+        self.daysSLU = None
+        self.avail = False
+        self.availMl = 0.0
+        self.availCartridges = False
+        self.tagMask = 0
+
+
+class InkOrgParser(MinimalOrgParser):
+    """Парсер БД: то же, что MinimalOrgParser, но для заголовков
+    с меткой INK_TAG создаёт экземпляры InkHeadlineNode."""
+
+    # метки в строке заголовка имеют вид ":метка1:метка2:",
+    # т.е. если нужная метка есть, в строке будет и такая подстрока
+    __INK_TAG_STR = ':%s:' % INK_TAG
+
+    def new_headline_node(self, text):
+        if self.__INK_TAG_STR in text:
+            return InkHeadlineNode(text)
+        else:
+            return OrgHeadlineNode(text)
+
 
 class ColorValue():
     # строим велосипед, т.к. Gdk.RGBA с какого-то чорта уродуется внутри Gtk.ListStore
 
-    #__slots__ = 'r', 'g', 'b'
+    # Неизменяемое значение: r, g, b задаются только при создании,
+    # а h, l, s и hexv вычисляются при первом обращении и запоминаются -
+    # для Pixbuf.fill() (т.е. int(colorv)) они не нужны вовсе.
+    # Для вычисления среднего цвета - см. ColorAccumulator.
+    __slots__ = '__r', '__g', '__b', '__hls', '__hexv'
+
+    def __init__(self, r, g, b, hls=None):
+        """r, g, b  - значения компонент цвета 0-255;
+        hls      - None или заранее вычисленный (например, ColorArray)
+                   кортеж значений (h, l, s) в формате get_hls_value()."""
+
+        self.__r = r
+        self.__g = g
+        self.__b = b
+
+        self.__hls = hls
+        self.__hexv = None
+
+    @property
+    def r(self):
+        return self.__r
+
+    @property
+    def g(self):
+        return self.__g
+
+    @property
+    def b(self):
+        return self.__b
+
+    def get_hls(self):
+        """Возвращает кортеж (h, l, s), вычисляя его при первом вызове."""
+
+        if self.__hls is None:
+            self.__hls = self.get_hls_value(self.__r, self.__g, self.__b)
 
-    def __init__(self, r, g, b):
-        self.r = r
-        self.g = g
-        self.b = b
+        return self.__hls
+
+    @property
+    def h(self):
+        return self.get_hls()[0]
+
+    @property
+    def l(self):
+        return self.get_hls()[1]
+
+    @property
+    def s(self):
+        return self.get_hls()[2]
+
+    @property
+    def hexv(self):
+        if self.__hexv is None:
+            self.__hexv = self.get_hex_value(self.__r, self.__g, self.__b)
+
+        return self.__hexv
+
+    @staticmethod
+    def get_hls_value(r, g, b):
+        """Возвращает кортеж из трёх целых (h, l, s),
+        где h: 0-359, l: 0-100, s: 0-100."""
 
         # Т.к. colorsys.rgb_to_hls() пытается определить диапазон значений
         # (м.б. как 0.0-1.0, так и 0-255) - у этой функции случаются
         # ошибки при значениях <=1, а потому принудительно приводим
         # входные значения к диапазону 0.0-1.0, а выходные - к
         # h: 0-359, l: 0-100, s: 0-100.
-        self.h, self.l, self.s = rgb_to_hls(self.r / 255, self.g / 255, self.b / 255)
-        self.h = int(round(self.h * 359))
-        self.l = int(round(self.l * 100))
-        self.s = int(round(self.s * 100))
-
-        self.hexv = self.get_hex_value(self.r, self.g, self.b)
+        h, l, s = rgb_to_hls(r / 255, g / 255, b / 255)
 
-        self.navg = 0
-        self.ravg = 0.0
-        self.gavg = 0.0
-        self.bavg = 0.0
+        return (int(round(h * 359)), int(round(l * 100)), int(round(s * 100)))
 
     def __eq__(self, other):
-        return (self.r == other.r) and (self.g == other.g) and (self.b == other.b)
+        return (self.__r == other.r) and (self.__g == other.g) and (self.__b == other.b)
+
+    def __hash__(self):
+        return (self.__r << 16) | (self.__g << 8) | self.__b
 
     @staticmethod
     def get_int_value(r, g, b):
@@ -144,14 +258,14 @@ class ColorValue():
         return cls((rgb >> 16) & 255, (rgb >> 8) & 255, rgb & 255)
 
     def __int__(self):
-        return self.get_int_value(self.r, self.g, self.b)
+        return self.get_int_value(self.__r, self.__g, self.__b)
 
     def __repr__(self):
         return '%s(r=%d, g=%d, b=%d, h=%d, l=%d, s=%d, hex=%s)' % (self.__class__.__name__,
-            self.r, self.g, self.b, self.h, self.l, self.s, self.hexv)
+            self.__r, self.__g, self.__b, *self.get_hls(), self.hexv)
 
     def get_values(self):
-        return (self.r, self.g, self.b)
+        return (self.__r, self.__g, self.__b)
 
     @staticmethod
     def get_hex_value(r, g, b):
@@ -198,22 +312,35 @@ class ColorValue():
 
             return fromlst[-1][1]
 
+        h, l, s = self.get_hls()
+
         # костыль для тёмных малонасыщенных цветов
-        if self.s <= 3:
-            if self.l <= 4:
+        if s <= 3:
+            if l <= 4:
                 desc = 'чёрный'
-            elif self.l >= 90:
+            elif l >= 90:
                 desc = 'белый'
             else:
-                desc = '%s серый' % __getv(self.LIGHTNESS_NAMES, self.l)
+                desc = '%s серый' % __getv(self.LIGHTNESS_NAMES, l)
         else:
             desc = '%s, %s (%d%%), %s (%d%%)' % (
-                __getv(self.HUE_NAMES, self.h),
-                __getv(self.SATURATION_NAMES, self.s), self.s,
-                __getv(self.LIGHTNESS_NAMES, self.l), self.l)
+                __getv(self.HUE_NAMES, h),
+                __getv(self.SATURATION_NAMES, s), s,
+                __getv(self.LIGHTNESS_NAMES, l), l)
 
         return '%s; %s' % (self.hexv, desc)
 
+
+class ColorAccumulator():
+    """Накопитель для вычисления среднего цвета по набору
+    экземпляров ColorValue (среднеквадратичное по каждой компоненте)."""
+
+    def __init__(self):
+        self.navg = 0
+        self.ravg = 0.0
+        self.gavg = 0.0
+        self.bavg = 0.0
+
     def avg_color_add(self, colorv):
         """Накопление значений для вычисления среднего цвета.
         colorv - экземпляр ColorValue."""
@@ -246,6 +373,333 @@ class ColorValue():
             return
 
 
+class ColorArray():
+    """Пакетное преобразование цветов.
+
+    Хранит массив упакованных значений цвета 0xRRGGBB и вычисленные
+    за один проход массивы h, l, s (в тех же единицах, что и у
+    ColorValue.get_hls_value()).
+    При наличии numpy вычисления векторизованы, иначе значения HLS
+    вычисляются однократно для каждого уникального цвета, а
+    результаты складываются в array.array."""
+
+    def __init__(self, rgb):
+        """rgb  - последовательность целых 0xRRGGBB
+                  (список, array.array, numpy.ndarray)."""
+
+        if numpy is not None:
+            self.rgb = numpy.asarray(rgb, dtype=numpy.uint32) & 0xffffff
+            self.h, self.l, self.s = self.__get_hls_numpy(self.rgb)
+        else:
+            self.rgb = array('L', (v & 0xffffff for v in rgb))
+            self.h, self.l, self.s = self.__get_hls_array(self.rgb)
+
+        self.hexValues = None
+
+    @staticmethod
+    def __get_hls_numpy(rgb):
+        """Векторизованный вариант colorsys.rgb_to_hls() для массива
+        numpy.uint32. Порядок операций повторяет colorsys, чтобы
+        результаты совпадали с ColorValue.get_hls_value()."""
+
+        r = (rgb >> 16) / 255
+        g = ((rgb >> 8) & 255) / 255
+        b = (rgb & 255) / 255
+
+        maxc = numpy.maximum(numpy.maximum(r, g), b)
+        minc = numpy.minimum(numpy.minimum(r, g), b)
+        sumc = maxc + minc
+        rangec = maxc - minc
+        l = sumc / 2.0
+
+        # у серых цветов делители нулевые; h и s для них
+        # всё равно потом обнуляются
+        gray = minc == maxc
+        rangec[gray] = 1.0
+
+        sdiv = numpy.where(l <= 0.5, sumc, 2.0 - maxc - minc)
+        sdiv[gray] = 1.0
+        s = rangec / sdiv
+
+        rc = (maxc - r) / rangec
+        gc = (maxc - g) / rangec
+        bc = (maxc - b) / rangec
+
+        h = numpy.where(r == maxc, bc - gc,
+                numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+        h = (h / 6.0) % 1.0
+
+        h[gray] = 0.0
+        s[gray] = 0.0
+
+        return (numpy.rint(h * 359).astype(numpy.uint16),
+                numpy.rint(l * 100).astype(numpy.uint8),
+                numpy.rint(s * 100).astype(numpy.uint8))
+
+    @staticmethod
+    def __get_hls_array(rgb):
+        """Вариант без numpy: HLS считается по разу на каждый
+        уникальный цвет (в базе чернил и на фотографиях повторы
+        встречаются постоянно)."""
+
+        cache = dict()
+
+        for v in rgb:
+            if v not in cache:
+                cache[v] = ColorValue.get_hls_value(v >> 16, (v >> 8) & 255, v & 255)
+
+        hlss = [cache[v] for v in rgb]
+
+        return (array('H', [hls[0] for hls in hlss]),
+                array('B', [hls[1] for hls in hlss]),
+                array('B', [hls[2] for hls in hlss]))
+
+    @classmethod
+    def new_from_pixels(cls, pixels, channels, rowstride, x, y, cx, cy):
+        """Создаёт экземпляр ColorArray из прямоугольной области
+        изображения. Точки идут построчно, слева направо.
+
+        pixels      - bytes с данными изображения
+                      (напр., из Pixbuf.get_pixels());
+        channels    - количество байт на точку;
+        rowstride   - количество байт на строку;
+        x, y        - левый верхний угол области;
+        cx, cy      - размеры области (должны быть в пределах
+                      изображения)."""
+
+        if numpy is not None:
+            buf = numpy.frombuffer(pixels, dtype=numpy.uint8)
+            offs = ((numpy.arange(y, y + cy) * rowstride)[:, None]
+                + (numpy.arange(x, x + cx) * channels)[None, :]).ravel()
+
+            rgb = ((buf[offs].astype(numpy.uint32) << 16)
+                | (buf[offs + 1].astype(numpy.uint32) << 8)
+                | buf[offs + 2])
+        else:
+            rgb = array('L', [(pixels[pix] << 16) | (pixels[pix + 1] << 8) | pixels[pix + 2]
+                for row in range(y * rowstride, (y + cy) * rowstride, rowstride)
+                for pix in range(row + x * channels, row + (x + cx) * channels, channels)])
+
+        return cls(rgb)
+
+    def __len__(self):
+        return len(self.rgb)
+
+    def get_hex_values(self):
+        """Возвращает список строк вида '#rrggbb'
+        (вычисляется при первом обращении)."""
+
+        if self.hexValues is None:
+            self.hexValues = ['#%.6x' % v for v in (self.rgb.tolist() if numpy is not None else self.rgb)]
+
+        return self.hexValues
+
+    def __getitem__(self, ix):
+        """Возвращает экземпляр ColorValue для элемента с индексом ix;
+        значения HLS берутся уже вычисленные."""
+
+        v = int(self.rgb[ix])
+
+        return ColorValue(v >> 16, (v >> 8) & 255, v & 255,
+            (int(self.h[ix]), int(self.l[ix]), int(self.s[ix])))
+
+    def __iter__(self):
+        for ix in range(len(self.rgb)):
+            yield self[ix]
+
+
+class PixelSampler():
+    """Выборка цветов точек из изображения в памяти (для определителя
+    цвета в GUI).
+
+    При наличии numpy данные изображения однократно (и без копирования)
+    оборачиваются в массив формы (высота, ширина, каналы), из которого
+    потом берутся срезы; без numpy точки выбираются из bytes напрямую.
+
+    Кроме того, при наличии numpy для всего изображения можно заранее
+    посчитать яркость и насыщенность точек (см. compute_planes()),
+    после чего get_intense_color() значения HLS вообще не считает.
+
+    Поля:
+        pixels      - bytes с данными изображения (формат - как у
+                      GdkPixbuf.Pixbuf: 8 бит на канал, каналы RGB[A]);
+        width, height, channels, rowstride - параметры изображения;
+        pixarray    - None или numpy.ndarray (см. выше);
+        planes      - None или кортеж из двух numpy.ndarray формы
+                      (высота, ширина) с типом numpy.uint8 - значения
+                      яркости и насыщенности точек (в тех же единицах,
+                      что у ColorValue.get_hls_value())."""
+
+    # размер области для get_intense_color() по умолчанию - 7х7
+    INTENSE_RADIUS = 3
+
+    # примерное кол-во точек, обрабатываемых compute_planes() за раз;
+    # ограничивает расход памяти на временные массивы
+    PLANES_BAND_PIXELS = 1 << 20
+
+    def __init__(self, pixels, width, height, channels, rowstride):
+        self.pixels = pixels
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rowstride = rowstride
+
+        if numpy is not None and width > 0 and height > 0:
+            # последняя строка в Pixbuf может быть короче rowstride,
+            # поэтому reshape тут не годится
+            self.pixarray = numpy.ndarray((height, width, channels),
+                dtype=numpy.uint8, buffer=pixels,
+                strides=(rowstride, channels, 1))
+        else:
+            self.pixarray = None
+
+        self.planes = None
+        self.cancelled = False
+
+    def compute_planes(self):
+        """Вычисление плоскостей яркости и насыщенности (поля planes).
+
+        Вычисление идёт полосами по несколько строк, на больших
+        изображениях может занимать заметное время, потому метод
+        рассчитан на вызов в отдельном потоке; до его завершения
+        get_intense_color() считает HLS на лету, а поле planes
+        присваивается одним махом только в самом конце.
+        Вычисление можно прервать вызовом cancel().
+
+        Без numpy плоскости не вычисляются (на чистом питоне это
+        заняло бы минуты).
+
+        Возвращает True, если плоскости вычислены."""
+
+        if self.pixarray is None:
+            return False
+
+        lplane = numpy.empty((self.height, self.width), dtype=numpy.uint8)
+        splane = numpy.empty((self.height, self.width), dtype=numpy.uint8)
+
+        band = max(1, self.PLANES_BAND_PIXELS // self.width)
+
+        for y in range(0, self.height, band):
+            if self.cancelled:
+                return False
+
+            px = self.pixarray[y:y + band, :, :3].astype(numpy.uint32)
+
+            colors = ColorArray(((px[:, :, 0] << 16) | (px[:, :, 1] << 8) | px[:, :, 2]).ravel())
+
+            lplane[y:y + band] = colors.l.reshape(-1, self.width)
+            splane[y:y + band] = colors.s.reshape(-1, self.width)
+
+        self.planes = (lplane, splane)
+
+        return True
+
+    def cancel(self):
+        """Прерывание compute_planes() (напр., если загружено
+        другое изображение)."""
+
+        self.cancelled = True
+
+    def get_pixel_color(self, x, y):
+        """Возвращает экземпляр ColorValue для точки с координатами x, y,
+        или None, если точка за пределами изображения.
+        Для одиночной точки индексирование bytes быстрее, чем обращение
+        к массиву numpy, поэтому pixarray здесь не используется."""
+
+        if x < 0 or x >= self.width or y < 0 or y >= self.height:
+            return None
+
+        pix = x * self.channels + y * self.rowstride
+
+        return ColorValue(self.pixels[pix], self.pixels[pix + 1], self.pixels[pix + 2])
+
+    def get_area(self, x, y, radius):
+        """Возвращает кортеж (x0, y0, cx, cy) - область (2*radius+1)^2
+        с центром в x, y, обрезанную по границам изображения,
+        или None, если область целиком за его пределами."""
+
+        x0 = max(x - radius, 0)
+        y0 = max(y - radius, 0)
+        cx = min(x + radius + 1, self.width) - x0
+        cy = min(y + radius + 1, self.height) - y0
+
+        if cx <= 0 or cy <= 0:
+            return None
+
+        return (x0, y0, cx, cy)
+
+    @staticmethod
+    def find_intense_index(s, l):
+        """Поиск самого тёмного и насыщенного цвета.
+
+        s, l    - последовательности значений насыщенности и яркости.
+
+        Просмотр идёт по порядку; текущий цвет заменяется следующим,
+        если тот одновременно насыщеннее и темнее. Результат зависит
+        от порядка просмотра (это не максимум какой-то одной величины).
+
+        Возвращает индекс найденного цвета."""
+
+        cur = 0
+        n = len(s)
+
+        if numpy is not None and isinstance(s, numpy.ndarray):
+            # каждый шаг - поиск первого подходящего элемента
+            # после текущего; шагов обычно единицы
+            while cur < n - 1:
+                better = (s[cur + 1:] > s[cur]) & (l[cur + 1:] < l[cur])
+                nxt = int(better.argmax())
+                if not better[nxt]:
+                    break
+
+                cur += nxt + 1
+        else:
+            for ix in range(1, n):
+                if s[ix] > s[cur] and l[ix] < l[cur]:
+                    cur = ix
+
+        return cur
+
+    def get_intense_color(self, x, y, radius=INTENSE_RADIUS):
+        """Возвращает экземпляр ColorValue с самым тёмным и насыщенным
+        цветом из области (2*radius+1)^2 с центром в x, y (см.
+        find_intense_index()), или None, если область за пределами
+        изображения. Область просматривается по столбцам."""
+
+        area = self.get_area(x, y, radius)
+        if area is None:
+            return None
+
+        x0, y0, cx, cy = area
+
+        planes = self.planes
+
+        if planes is not None:
+            # транспонированием получаем порядок "по столбцам"
+            lplane, splane = planes
+
+            ix = self.find_intense_index(splane[y0:y0 + cy, x0:x0 + cx].T.ravel(),
+                lplane[y0:y0 + cy, x0:x0 + cx].T.ravel())
+
+            ox, oy = divmod(ix, cy)
+
+            return ColorValue(*self.pixarray[y0 + oy, x0 + ox, :3].tolist())
+
+        elif self.pixarray is not None:
+            # транспонированием получаем порядок "по столбцам"
+            win = self.pixarray[y0:y0 + cy, x0:x0 + cx, :3].transpose(1, 0, 2).reshape(-1, 3).astype(numpy.uint32)
+
+            colors = ColorArray((win[:, 0] << 16) | (win[:, 1] << 8) | win[:, 2])
+        else:
+            pixels = self.pixels
+
+            colors = ColorArray(array('L', [(pixels[pix] << 16) | (pixels[pix + 1] << 8) | pixels[pix + 2]
+                for col in range(x0 * self.channels, (x0 + cx) * self.channels, self.channels)
+                for pix in range(y0 * self.rowstride + col, (y0 + cy) * self.rowstride, self.rowstride)]))
+
+        return colors[self.find_intense_index(colors.s, colors.l)]
+
+
 class TagStatInfo():
     """Класс для отображаемой статистики по меткам"""
 
@@ -291,6 +745,34 @@ class TagStatInfo():
 
             self.inks.append(inknode)
 
+        def remove_inks(self, rminks):
+            """Обновляет счётчики, удаляет чернила из списка.
+
+            rminks  - множество экземпляров OrgHeadlineNode.
+
+            Возвращает True, если список чернил опустел."""
+
+            inks = []
+
+            for inknode in self.inks:
+                if inknode not in rminks:
+                    inks.append(inknode)
+                    continue
+
+                if inknode.avail:
+                    self.available -= 1
+                else:
+                    self.unavailable -= 1
+
+                if inknode.done is None:
+                    self.unwanted -= 1
+                elif not inknode.done:
+                    self.wanted -= 1
+
+            self.inks = inks
+
+            return not inks
+
     def __init__(self, totals, title, col1title, tags):
         """Параметры:
         totals      - экземпляр класса InkNodeStatistics,
@@ -333,36 +815,32 @@ class TagStatInfo():
         for ink in inks:
             nfo.add_ink(ink)
 
-    def gather_statistics(self, inknode):
-        """Учёт чернил в статистике, если у них есть метки, совпадающие
-        с self.tags.
-
-        inknode - экземпляр OrgHeadlineNode.
+    def remove_inks(self, rminks):
+        """Удаление чернил из статистики.
 
-        Метод возвращает булевское значение: True, если чернила
-        попали в статистику, иначе - False."""
+        rminks  - множество экземпляров OrgHeadlineNode.
 
-        ntags = set(inknode.tags) & self.tags
+        Опустевшие экземпляры StatValue удаляются из self.stats."""
 
-        if ntags:
-            for tag in ntags:
-                if tag in self.stats:
-                    nfo = self.stats[tag]
-                else:
-                    nfo = self.StatValue()
-                    self.stats[tag] = nfo
+        for name, nfo in list(self.stats.items()):
+            if nfo.remove_inks(rminks):
+                del self.stats[name]
 
-                nfo.add_ink(inknode)
 
-            return True
+class MainColorStatInfo(TagStatInfo):
+    """Специальная статистика "по основному цвету".
+    Прочие таблицы (TagStatInfo) заполняются через индекс меток
+    InkNodeStatistics.get_tag_stat_index(), а эта - вызовом
+    gather_statistics()."""
 
-        return False
+    def gather_statistics(self, inknode):
+        """Учёт чернил в статистике, если у них указан основной цвет.
 
+        inknode - экземпляр OrgHeadlineNode.
 
-class MainColorStatInfo(TagStatInfo):
-    """Специальная статистика "по основному цвету"."""
+        Метод возвращает булевское значение: True, если чернила
+        попали в статистику, иначе - False."""
 
-    def gather_statistics(self, inknode):
         if inknode.maincolor:
             if inknode.maincolor in self.stats:
                 nfo = self.stats[inknode.maincolor]
@@ -377,194 +855,174 @@ class MainColorStatInfo(TagStatInfo):
         return False
 
 
-class InkNodeStatistics():
-    def __init__(self, rootnode):
-        self.availMl = 0.0
+class InkColumns():
+    """Поколоночное хранилище данных чернил для InkNodeStatistics.
+
+    Каждые чернила - строка, значения полей - в типизированных массивах
+    (array.array) с общим индексом строки, так что итоговые значения
+    считаются проходом по массиву (array.count(), sum()), а не перебором
+    экземпляров InkHeadlineNode.
+
+    Поля:
+    inks        - список экземпляров InkHeadlineNode (по строкам);
+    availMl     - array('d'), объём в наличии (мл);
+    avail       - array('b'), 1 - чернила в наличии, иначе 0;
+    done        - array('b'), DONE_* - состояние ветви;
+    color       - array('l'), 0xRRGGBB или -1, если цвет не указан;
+    daysSLU     - array('l'), дней с последнего использования
+                  или -1, если чернила не использовались;
+    usageCount  - array('l'), количество использований."""
+
+    # значения столбца done
+    DONE_NONE, DONE_FALSE, DONE_TRUE = -1, 0, 1
+
+    def __init__(self):
+        self.inks = []
+        self.availMl = array('d')
+        self.avail = array('b')
+        self.done = array('b')
+        self.color = array('l')
+        self.daysSLU = array('l')
+        self.usageCount = array('l')
+
+    def __len__(self):
+        return len(self.inks)
+
+    def add_ink(self, inknode):
+        """Добавление строки для inknode (экземпляра InkHeadlineNode
+        с уже заполненными полями)."""
+
+        self.inks.append(inknode)
+        self.availMl.append(inknode.availMl)
+        self.avail.append(1 if inknode.avail else 0)
+
+        if inknode.done is None:
+            self.done.append(self.DONE_NONE)
+        else:
+            self.done.append(self.DONE_TRUE if inknode.done else self.DONE_FALSE)
 
-        # список экземпляров OrgHeadlineNode - чернила в наличии
-        self.availInks = []
+        self.color.append(-1 if inknode.color is None else inknode.color)
+        self.daysSLU.append(-1 if inknode.daysSLU is None else inknode.daysSLU)
+        self.usageCount.append(len(inknode.usage))
 
-        # список экземпляров OrgHeadlineNode - отсутствующие чернила
-        self.unavailInks = []
+    def remove_inks(self, rminks):
+        """Удаление строк для чернил из множества rminks."""
 
-        # список экземпляров OrgHeadlineNode - нафиг не нужные чернила
-        # (ветви, которые и не TODO, и не DONE)
-        self.unwantedInks = []
+        keep = [ix for ix, ink in enumerate(self.inks) if ink not in rminks]
+        if len(keep) == len(self.inks):
+            return
 
-        # список экземпляров TagStatInfo - статистика по тэгам
-        self.tagStats = []
+        def __take(col):
+            return [col[ix] for ix in keep]
 
-        # словарь переводов названий тэгов,
-        # где ключ - тэг, а значение - перевод названия
-        self.tagNames = {}
+        self.inks = __take(self.inks)
 
-        # обратное соответствие переводов названий тэгов и тэгов
-        self.namesTags = {}
+        for name in ('availMl', 'avail', 'done', 'color', 'daysSLU', 'usageCount'):
+            col = getattr(self, name)
+            setattr(self, name, array(col.typecode, __take(col)))
 
-        # временный список экземпляров OrgHeadlineNode с неполными данными
-        self.hasMissingData = []
+    def get_avail_ml(self):
+        """Возвращает общий объём чернил в наличии (мл)."""
 
-        # временный список экземпляров OrgHeadlineNode, которые не попали
-        # в списки tagStats
-        self.outOfStatsInks = []
+        # у отсутствующих чернил availMl == 0.0
+        return sum(self.availMl)
 
-        #
-        # статистика популярности чернил
-        #
+    def get_counters(self):
+        """Возвращает кортеж из четырёх целых - количества чернил
+        в наличии, отсутствующих, планируемых к покупке и ненужных
+        (как у TagStatInfo.StatValue)."""
 
-        self.nowDate = datetime.datetime.now().date()
+        # array.count() - проход по массиву без создания объектов
+        available = self.avail.count(1)
+        return (available, len(self.avail) - available,
+            self.done.count(self.DONE_FALSE), self.done.count(self.DONE_NONE))
 
-        # статистика по кол-ву дней с последнего использования
-        #TODO вместо использования в качестве ключей всех значений "дней" сделать группировку по диапазонам
-        self.inksByDaysSLU = TagStatInfo(self, 'Последнее использование', 'Дней', [])
 
-        # статистика по количеству "использований" (напр. заправок)
-        # чернил, а значения - множества (set) соотв. чернил
-        #TODO вместо использования в качестве ключей всех значений кол-ва заправок сделать группировку по диапазонам
-        self.inksByUsage = TagStatInfo(self, 'Количество заправок', 'Кол-во', [])
+class InkDescriptionParser():
+    """Разбор описаний чернил (ветвей InkHeadlineNode) - общая часть
+    InkNodeStatistics и InkRecordReader.
 
-        # очень специальная ветка
-        maincolorStats = MainColorStatInfo(self, 'По основному цвету', '...', [])
-        ixMainColorStats = len(self.tagStats) # некоторый костылинг
-        self.tagStats.append(maincolorStats)
+    Поля:
+    tagNames    - словарь переводов названий тэгов,
+                  где ключ - тэг, а значение - перевод названия
+                  (из директивы @TAGNAMES);
+    namesTags   - обратное соответствие переводов названий тэгов и тэгов;
+    nowDate     - текущая дата (экземпляр datetime.date), от неё
+                  отсчитывается кол-во дней с последнего использования;
+    tagTable    - экземпляр TagTable, по которому считаются
+                  значения InkHeadlineNode.tagMask."""
 
-        #
-        # рекурсивный обход ветвей и заполнение вышеуказанных полей
-        #
-        self.scan_node(rootnode, 0)
+    def __init__(self):
+        self.tagNames = {}
+        self.namesTags = {}
 
-        # ...продолжение некоторого костылинга
-        if not self.tagStats[ixMainColorStats].stats:
-            # статистика пуста - выпиливаем ветвь из списка,
-            # дабы юзера не смущать
-            del self.tagStats[ixMainColorStats]
+        self.tagTable = TagTable()
 
-        #
-        # статистика популярности чернил
-        #
-        self.tagStats.append(self.inksByDaysSLU)
-        self.tagStats.append(self.inksByUsage)
+        self.nowDate = datetime.datetime.now().date()
 
-        # ...а теперь из hasMissingData и outOfStatsInks делаем
-        # специальную ветку в tagStats
+    # флаги для проверки полноты описания
+    MISSING_TAGS, MISSING_DESCRIPTION, MISSING_COLOR, MISSING_MAIN_COLOR = range(4)
 
-        others = TagStatInfo(self, 'Прочие', '...', [])
-        others.issortable = False
+    STR_MISSING = {MISSING_TAGS:'метки',
+        MISSING_DESCRIPTION:'описание',
+        MISSING_COLOR:'цвет',
+        MISSING_MAIN_COLOR:'основной цвет'}
 
-        if self.outOfStatsInks:
-            others.add_special_value('прочие метки', self.outOfStatsInks)
+    __INK_TAG = INK_TAG
 
-        if self.hasMissingData:
-            others.add_special_value('с неполными данными', self.hasMissingData)
+    usageinfo = namedtuple('usageinfo', 'date comment')
 
-        if others.stats:
-            self.tagStats.append(others)
+    def is_ink_node(self, node):
+        """Возвращает True, если node - ветвь с описанием чернил.
+        Если ветвь с меткой INK_TAG - не экземпляр InkHeadlineNode,
+        генерируется исключение TypeError."""
 
-        # потому что содержимое уже лежит в others,
-        # и в виде отдельной сущности больше не нужно
-        del self.hasMissingData
-        del self.outOfStatsInks
+        # ветви с меткой "ink" в дереве, загруженном load_ink_db(),
+        # всегда являются экземплярами InkHeadlineNode;
+        # учитываем только ветви, имеющие метку "ink"
+        if isinstance(node, InkHeadlineNode):
+            return self.__INK_TAG in node.tags
 
-        # список всех меток
-        self.tags = []
+        # у простого OrgHeadlineNode (напр. из дерева, загруженного
+        # MinimalOrgParser) нет полей для результатов разбора -
+        # молча пропускать такие ветви нельзя, статистика была бы неверной
+        if isinstance(node, OrgHeadlineNode) and self.__INK_TAG in node.tags:
+            raise TypeError('is_ink_node(node): node with "%s" tag must be InkHeadlineNode (use InkOrgParser or load_ink_db())' % self.__INK_TAG)
 
-        # ищем ветви типа OrgDirectiveNode только на верхнем уровне
-        for node in rootnode.children:
-            if isinstance(node, OrgDirectiveNode) and node.name == 'TAGS':
-                self.tags += node.text.split(None)
+        return False
 
-    def get_tag_display_name(self, tag):
-        return self.tagNames[tag] if tag in self.tagNames else tag
+    def parse_ink_node(self, node):
+        """Разбор описания чернил - заполнение полей node, если это
+        InkHeadlineNode с описанием чернил (см. InkHeadlineNode).
 
-    def get_total_result_table(self):
-        """Возвращает список списков, содержащих строки
-        со значениями общей статистики."""
+        Возвращает True, если node содержало описание чернил, иначе False."""
 
-        totalMl = self.availMl
+        if not self.is_ink_node(node):
+            return False
 
-        if totalMl < MILLILITERS:
-            units = 'мл'
-        else:
-            totalMl /= MILLILITERS
-            units = 'л'
+        #
+        # поле для проверки статистики, в файле НЕ сохраняется
+        #
+        node.missing = set()
 
-        inksAvail = len(self.availInks)
-        inksUnavail = len(self.unavailInks)
-        inksUnwanted = len(self.unwantedInks)
-        inksTotal = inksAvail + inksUnavail
+        if len(node.tags) == 1:
+            # получается, что метка только одна - "ink"
+            node.missing.add(self.MISSING_TAGS)
 
-        def __percent(n):
-            pc = '%.1f%%' % (0 if inksTotal == 0 else 100.0 * n / inksTotal)
+        node.tagMask = self.tagTable.get_mask(node.tags)
 
-            return (str(n), pc)
+        # это "чернильный" элемент дерева - разбираем его содержимое
 
-        # 4 столбца: название поля, абсолютное значение, процент от общего числа, объем в л/мл
-        # объем указывается только для чернил в наличии, для прочих - пустые строки
-
-        return [
-                ['Всего:', str(inksTotal), '', ''],
-                ['В наличии:', *__percent(inksAvail), '≈{:.2f} {:s}'.format(totalMl, units)],
-                ['Отсутствуют:', *__percent(inksUnavail), ''],
-                ['Не нужны:', *__percent(inksUnwanted), ''],
-               ]
-
-    def __repr__(self):
-        return '%s(availMl=%.2f, availInks=%s, unavailInks=%s, unwantedInks=%s, hasMissingData=%s, tagStats=%s, outOfStatsInks=%s)' % (
-            self.__class__.__name__,
-            self.availMl,
-            self.availInks,
-            self.unavailInks,
-            self.unwantedInks,
-            self.hasMissingData,
-            self.tagStats,
-            self.outOfStatsInks)
-
-    # флаги для проверки полноты описания
-    MISSING_TAGS, MISSING_DESCRIPTION, MISSING_COLOR, MISSING_MAIN_COLOR = range(4)
-
-    STR_MISSING = {MISSING_TAGS:'метки',
-        MISSING_DESCRIPTION:'описание',
-        MISSING_COLOR:'цвет',
-        MISSING_MAIN_COLOR:'основной цвет'}
-
-    __INK_TAG = 'ink'
-
-    usageinfo = namedtuple('usageinfo', 'date comment')
-
-    def get_ink_node_statistics(self, node):
-        """Сбор статистики для node, если это OrgHeadlineNode с описание
-        чернил.
-
-        Возвращает True, если node содержало описание чернил, иначе False."""
-
-        if not isinstance(node, OrgHeadlineNode):
-            return False
-
-        # учитываем только ветви, имеющие метку "ink"
-        if self.__INK_TAG not in node.tags:
-            return False
-
-        #
-        # поле для проверки статистики, в файле НЕ сохраняется
-        #
-        node.missing = set()
-
-        if len(node.tags) == 1:
-            # получается, что метка только одна - "ink"
-            node.missing.add(self.MISSING_TAGS)
-
-        # это "чернильный" элемент дерева - его содержимым кормим статистику
-
-        #
-        # проверяем наличие текстового описания
-        #
-        ntexts = 0
-        for child in node.children:
-            # isinstance тут не годится, нужна строгая проверка типа
-            # т.к. гипотетический наследник OrgTextNode может быть
-            # чем-то заковыристым и не в тему
-            if type(child) is OrgTextNode:
-                ntexts += 1
+        #
+        # проверяем наличие текстового описания
+        #
+        ntexts = 0
+        for child in node.children:
+            # isinstance тут не годится, нужна строгая проверка типа
+            # т.к. гипотетический наследник OrgTextNode может быть
+            # чем-то заковыристым и не в тему
+            if type(child) is OrgTextNode:
+                ntexts += 1
 
         if ntexts == 0:
             node.missing.add(self.MISSING_DESCRIPTION)
@@ -737,7 +1195,6 @@ class InkNodeStatistics():
 
                     node.avail = True
                     node.availMl += avail
-                    self.availMl += avail
                 except ValueError:
                     pass
             else:
@@ -746,6 +1203,358 @@ class InkNodeStatistics():
                     node.avail = True
                     node.availCartridges = True
 
+        return True
+
+    def process_comment(self, text):
+        """Поиск и обработка "самопальной" директивы вида
+        "@directive parameter [parameter]" в тексте комментария text
+        (см. метод process_directive)."""
+
+        dargs = list(map(lambda s: s.strip(), text.split(None, 1)))
+        if not dargs:
+            return
+
+        dname = dargs[0]
+        if not dname.startswith('@'):
+            # просто комментарий или не наша директива
+            return
+
+        dname = dname[1:]
+        if not dname:
+            # "@" без текста за директиву не считаем
+            return
+
+        dargs = dargs[1:] # м.б. пустой список!
+
+        self.process_directive(dname, dargs[0] if dargs else '')
+
+    def process_directive(self, dname, dvalue):
+        """Обработка "самопальной" (не стандарта OrgMode) директивы вида
+        '@ИМЯ значение'.
+
+        dname   - имя директивы (без символа @),
+        dvalue  - значение директивы.
+
+        Имена директив регистро-зависимы.
+        В случае ошибок генерируются исключения."""
+
+        if dname == 'TAGNAMES':
+            self.__process_tagnames_directive(dvalue)
+
+    def __process_tagnames_directive(self, dvalue):
+        # переводы названий тэгов в формате
+        # tagname=translation[:tagname1=translation1[...:tagnameN=translationN]
+
+        for rawtrans in dvalue.split(':'):
+            tagname, sep, tagtrans = map(lambda s: s.strip(), rawtrans.partition('='))
+
+            #TODO прикрутить обработку ошибок синтаксиса
+            if sep != '=' or not tagname or not tagtrans:
+                continue
+
+            self.tagNames[tagname] = tagtrans
+
+        self.namesTags = OrderedDict(map(lambda r: (r[1].lower(), r[0]), self.tagNames.items()))
+
+    def get_tag_display_name(self, tag):
+        return self.tagNames[tag] if tag in self.tagNames else tag
+
+    def get_ink_description(self, ink):
+        """Получение описания чернил.
+
+        Параметры:
+            ink         - экземпляр OrgHeadlineNode.
+
+        Возвращает кортеж из четырёх строк:
+        'название', 'отсортированный список человекочитаемых меток',
+        'описание', 'наличие'."""
+
+        if not isinstance(ink, OrgHeadlineNode):
+            raise TypeError('get_ink_description(ink): "ink" must be OrgHeadlineNode')
+
+        if self.__INK_TAG not in ink.tags:
+            raise ValueError('get_ink_description(ink): "ink" must contain ink description')
+
+        desc = []
+
+        for chld in ink.children:
+            if isinstance(chld, OrgTextNode):
+                desc.append(chld.text)
+
+        avails = []
+
+        if ink.availMl > 0.0:
+            if ink.availMl < 500.0:
+                avs = '%.f мл' % ink.availMl
+            else:
+                avs = '%.2f л' % (ink.availMl / 1000.0)
+            avails.append(avs)
+
+        if ink.availCartridges:
+            avails.append('картриджи')
+
+        # некоторый костылинг
+        disptags = ink.tags.copy()
+        # удаляем служебную метку - она нужна при загрузке БД, не для отображения
+        disptags.remove(self.__INK_TAG)
+
+        return (ink.text,
+                ', '.join(sorted(map(lambda tag: self.tagNames[tag] if tag in self.tagNames else tag, disptags))),
+                '\n'.join(desc),
+                ' и '.join(avails))
+
+    def get_ink_missing_data_str(self, ink):
+        """Возвращает строку, в которой перечислены недостающие данные
+        для ink (экземпляра OrgHeadlineNode), или пустую строку
+        (когда всё данные есть)."""
+
+        return ', '.join(map(lambda k: self.STR_MISSING[k], ink.missing))
+
+
+class InkNodeStatistics(InkDescriptionParser):
+    def __init__(self, rootnode):
+        super().__init__()
+
+        # поколоночная копия данных всех учтённых чернил -
+        # из неё считаются итоговые значения (см. get_total_result_table())
+        self.inkColumns = InkColumns()
+
+        # список экземпляров OrgHeadlineNode - чернила в наличии
+        self.availInks = []
+
+        # список экземпляров OrgHeadlineNode - отсутствующие чернила
+        self.unavailInks = []
+
+        # список экземпляров OrgHeadlineNode - нафиг не нужные чернила
+        # (ветви, которые и не TODO, и не DONE)
+        self.unwantedInks = []
+
+        # список экземпляров TagStatInfo - статистика по тэгам
+        # (для отображения, см. update_tag_stats())
+        self.tagStats = []
+
+        # список экземпляров TagStatInfo, в которые собирает статистику
+        # get_ink_node_statistics() - "по основному цвету" и таблицы
+        # из директив @TAGSTAT
+        self.tagStatTables = []
+
+        # обратный индекс для таблиц из tagStatTables: ключ - метка,
+        # значение - список кортежей (TagStatInfo, TagStatInfo.StatValue);
+        # строится при обработке первых чернил после директив @TAGSTAT
+        # (см. get_tag_stat_index())
+        self.tagStatIndex = None
+
+        # список экземпляров OrgHeadlineNode с неполными данными
+        self.hasMissingData = []
+
+        # список экземпляров OrgHeadlineNode, которые не попали
+        # в списки tagStatTables
+        self.outOfStatsInks = []
+
+        #
+        # статистика популярности чернил
+        #
+
+        # статистика по кол-ву дней с последнего использования
+        #TODO вместо использования в качестве ключей всех значений "дней" сделать группировку по диапазонам
+        self.inksByDaysSLU = TagStatInfo(self, 'Последнее использование', 'Дней', [])
+
+        # статистика по количеству "использований" (напр. заправок)
+        # чернил, а значения - множества (set) соотв. чернил
+        #TODO вместо использования в качестве ключей всех значений кол-ва заправок сделать группировку по диапазонам
+        self.inksByUsage = TagStatInfo(self, 'Количество заправок', 'Кол-во', [])
+
+        # очень специальная ветка
+        self.mainColorStats = MainColorStatInfo(self, 'По основному цвету', '...', [])
+        self.tagStatTables.append(self.mainColorStats)
+
+        # ...и ещё одна - её содержимое берётся из hasMissingData
+        # и outOfStatsInks
+        self.othersStats = TagStatInfo(self, 'Прочие', '...', [])
+        self.othersStats.issortable = False
+
+        # список всех меток
+        self.tags = []
+
+        # ищем ветви типа OrgDirectiveNode только на верхнем уровне
+        for node in rootnode.children:
+            if isinstance(node, OrgDirectiveNode) and node.name == 'TAGS':
+                self.tags += node.text.split(None)
+
+        # первые биты в таблице меток - метки из +TAGS
+        self.tagTable.add_tags(self.tags)
+
+        #
+        # рекурсивный обход ветвей и заполнение вышеуказанных полей
+        #
+        self.scan_node(rootnode, 0)
+
+        self.update_tag_stats()
+
+    def update_tag_stats(self):
+        """Заполнение специальной ветки othersStats и списка tagStats."""
+
+        others = self.othersStats
+        others.stats.clear()
+
+        if self.outOfStatsInks:
+            others.add_special_value('прочие метки', self.outOfStatsInks)
+
+        if self.hasMissingData:
+            others.add_special_value('с неполными данными', self.hasMissingData)
+
+        # пустую статистику по основному цвету выпиливаем из списка,
+        # дабы юзера не смущать
+        self.tagStats = [ts for ts in self.tagStatTables if ts.stats or ts is not self.mainColorStats]
+
+        #
+        # статистика популярности чернил
+        #
+        self.tagStats.append(self.inksByDaysSLU)
+        self.tagStats.append(self.inksByUsage)
+
+        if others.stats:
+            self.tagStats.append(others)
+
+    def get_ink_nodes(self, node):
+        """Возвращает список ветвей с описаниями чернил, учитываемых
+        статистикой, из ветви node (включая её саму) - тех же,
+        до которых при обходе дерева добирается scan_node()."""
+
+        inks = []
+        stack = [node]
+
+        while stack:
+            node = stack.pop()
+
+            if self.is_ink_node(node):
+                inks.append(node)
+            elif node.children:
+                stack.extend(reversed(node.children))
+
+        return inks
+
+    def update(self, removed, added):
+        """Обновление статистики после частичной перезагрузки дерева
+        (см. MinimalOrgParser.update()) без полного пересчёта.
+
+        removed - список ветвей верхнего уровня, удалённых из дерева;
+        added   - список ветвей верхнего уровня, добавленных в дерево.
+
+        Изменения преамбулы файла (директив) и текущей даты этот метод
+        не учитывает - в этих случаях статистику следует посчитать
+        заново (см. update_ink_db()).
+
+        Возвращает кортеж из двух списков экземпляров InkHeadlineNode -
+        чернила, удалённые из статистики и добавленные в неё;
+        изменённые в файле чернила попадают в оба списка (в первый -
+        старая ветвь, во второй - новая)."""
+
+        rminks = []
+        for node in removed:
+            rminks += self.get_ink_nodes(node)
+
+        if rminks:
+            rmset = set(rminks)
+
+            self.inkColumns.remove_inks(rmset)
+
+            def __remove_from(inks):
+                return [ink for ink in inks if ink not in rmset]
+
+            self.availInks = __remove_from(self.availInks)
+            self.unavailInks = __remove_from(self.unavailInks)
+            self.unwantedInks = __remove_from(self.unwantedInks)
+            self.hasMissingData = __remove_from(self.hasMissingData)
+            self.outOfStatsInks = __remove_from(self.outOfStatsInks)
+
+            for tagstat in self.tagStatTables + [self.inksByDaysSLU, self.inksByUsage]:
+                tagstat.remove_inks(rmset)
+
+        newinks = []
+        for node in added:
+            if not self.get_ink_node_statistics(node):
+                self.scan_node(node, 1)
+
+            newinks += self.get_ink_nodes(node)
+
+        if newinks:
+            # новые чернила добавлены в концы списков, а порядок
+            # должен быть тот же, что при полном пересчёте - порядок в файле
+            def __line(ink):
+                return ink.line
+
+            for inks in (self.availInks, self.unavailInks, self.unwantedInks,
+                    self.hasMissingData, self.outOfStatsInks):
+                inks.sort(key=__line)
+
+            for tagstat in self.tagStatTables + [self.inksByDaysSLU, self.inksByUsage]:
+                for nfo in tagstat.stats.values():
+                    nfo.inks.sort(key=__line)
+
+        if rminks or newinks:
+            self.update_tag_stats()
+
+        return (rminks, newinks)
+
+    @property
+    def availMl(self):
+        """Общий объём чернил в наличии (мл)."""
+
+        return self.inkColumns.get_avail_ml()
+
+    def get_total_result_table(self):
+        """Возвращает список списков, содержащих строки
+        со значениями общей статистики."""
+
+        totalMl = self.availMl
+
+        if totalMl < MILLILITERS:
+            units = 'мл'
+        else:
+            totalMl /= MILLILITERS
+            units = 'л'
+
+        inksAvail, inksUnavail, _, inksUnwanted = self.inkColumns.get_counters()
+        inksTotal = inksAvail + inksUnavail
+
+        def __percent(n):
+            pc = '%.1f%%' % (0 if inksTotal == 0 else 100.0 * n / inksTotal)
+
+            return (str(n), pc)
+
+        # 4 столбца: название поля, абсолютное значение, процент от общего числа, объем в л/мл
+        # объем указывается только для чернил в наличии, для прочих - пустые строки
+
+        return [
+                ['Всего:', str(inksTotal), '', ''],
+                ['В наличии:', *__percent(inksAvail), '≈{:.2f} {:s}'.format(totalMl, units)],
+                ['Отсутствуют:', *__percent(inksUnavail), ''],
+                ['Не нужны:', *__percent(inksUnwanted), ''],
+               ]
+
+    def __repr__(self):
+        return '%s(availMl=%.2f, availInks=%s, unavailInks=%s, unwantedInks=%s, hasMissingData=%s, tagStats=%s, outOfStatsInks=%s)' % (
+            self.__class__.__name__,
+            self.availMl,
+            self.availInks,
+            self.unavailInks,
+            self.unwantedInks,
+            self.hasMissingData,
+            self.tagStats,
+            self.outOfStatsInks)
+
+    def get_ink_node_statistics(self, node):
+        """Сбор статистики для node, если это OrgHeadlineNode с описание
+        чернил.
+
+        Возвращает True, если node содержало описание чернил, иначе False."""
+
+        if not self.parse_ink_node(node):
+            return False
+
+        self.inkColumns.add_ink(node)
+
         # Внимание:
         # node.avail НЕ зависит от node.done
 
@@ -805,17 +1614,46 @@ class InkNodeStatistics():
         #
         # скармливаем всё, что следует, статистике "по тэгам"
         #
-        ninstats = 0
+        ninstats = self.mainColorStats.gather_statistics(node)
+
+        tagStatIndex = self.get_tag_stat_index()
+
+        for tag in set(node.tags):
+            for tagstat, nfo in tagStatIndex.get(tag, ()):
+                if not nfo.inks:
+                    # первые чернила с этой меткой (или все прежние
+                    # удалены TagStatInfo.remove_inks())
+                    tagstat.stats[tag] = nfo
 
-        for tagstat in self.tagStats:
-            if tagstat.gather_statistics(node):
-                ninstats += 1
+                nfo.add_ink(node)
+                ninstats = True
 
-        if ninstats == 0:
+        if not ninstats:
             self.outOfStatsInks.append(node)
 
         return True
 
+    def get_tag_stat_index(self):
+        """Возвращает словарь, где ключи - метки, а значения - списки
+        кортежей (TagStatInfo, TagStatInfo.StatValue) для всех таблиц
+        tagStatTables, учитывающих метку (кроме mainColorStats).
+        Словарь строится при первом вызове после добавления таблиц,
+        чтобы get_ink_node_statistics() не перебирала для каждых
+        чернил все таблицы."""
+
+        if self.tagStatIndex is None:
+            self.tagStatIndex = dict()
+
+            for tagstat in self.tagStatTables:
+                for tag in tagstat.tags:
+                    nfo = tagstat.stats.get(tag)
+                    if nfo is None:
+                        nfo = tagstat.StatValue()
+
+                    self.tagStatIndex.setdefault(tag, []).append((tagstat, nfo))
+
+        return self.tagStatIndex
+
     def scan_node(self, node, level):
         """Рекурсивный обход дерева экземпляров OrgNode.
         Сбор статистики по наличию чернил.
@@ -830,23 +1668,7 @@ class InkNodeStatistics():
                 # (см. метод process_directive)
                 # на следующих ничего не делаем, один фиг там нет описаний чернил
                 if level == 0:
-                    dargs = list(map(lambda s: s.strip(), child.text.split(None, 1)))
-                    if not dargs:
-                        continue
-
-                    dname = dargs[0]
-                    if not dname.startswith('@'):
-                        # просто комментарий или не наша директива
-                        continue
-
-                    dname = dname[1:]
-                    if not dname:
-                        # "@" без текста за директиву не считаем
-                        continue
-
-                    dargs = dargs[1:] # м.б. пустой список!
-
-                    self.process_directive(dname, dargs[0] if dargs else '')
+                    self.process_comment(child.text)
 
             elif not self.get_ink_node_statistics(child):
                 self.scan_node(child, level + 1)
@@ -874,91 +1696,108 @@ class InkNodeStatistics():
         if not tstags:
             return
 
-        self.tagStats.append(TagStatInfo(self, tstitle, tsc1title, tstags))
+        self.tagStatTables.append(TagStatInfo(self, tstitle, tsc1title, tstags))
+        self.tagStatIndex = None
 
-    def __process_tagnames_directive(self, dvalue):
-        # переводы названий тэгов в формате
-        # tagname=translation[:tagname1=translation1[...:tagnameN=translationN]
+    def process_directive(self, dname, dvalue):
+        if dname == 'TAGSTAT':
+            self.__process_tagstat_directive(dvalue)
+        else:
+            super().process_directive(dname, dvalue)
 
-        for rawtrans in dvalue.split(':'):
-            tagname, sep, tagtrans = map(lambda s: s.strip(), rawtrans.partition('='))
 
-            #TODO прикрутить обработку ошибок синтаксиса
-            if sep != '=' or not tagname or not tagtrans:
-                continue
+class InkRecordReader(InkDescriptionParser):
+    """Потоковое чтение описаний чернил без построения полного дерева
+    документа.
 
-            self.tagNames[tagname] = tagtrans
+    Из потока токенов (см. orgmodeparser.OrgParseIter.tokens())
+    строятся только поддеревья ветвей с описаниями чернил - по одному
+    за раз, так что расход памяти определяется размером самого большого
+    описания, а не всего файла (если, конечно, вызывающий не хранит
+    все полученные ветви).
+    Директивы @TAGNAMES в комментариях до первого заголовка
+    учитываются так же, как InkNodeStatistics."""
 
-        self.namesTags = OrderedDict(map(lambda r: (r[1].lower(), r[0]), self.tagNames.items()))
+    __INK_TAG_STR = ':%s:' % INK_TAG
 
-    def process_directive(self, dname, dvalue):
-        """Обработка "самопальной" (не стандарта OrgMode) директивы вида
-        '@ИМЯ значение'.
+    def new_headline_node(self, text):
+        # то же, что InkOrgParser.new_headline_node()
+        if self.__INK_TAG_STR in text:
+            return InkHeadlineNode(text)
+        else:
+            return OrgHeadlineNode(text)
 
-        dname   - имя директивы (без символа @),
-        dvalue  - значение директивы.
+    def read_tokens(self, tokens):
+        """Генератор, возвращающий экземпляры InkHeadlineNode
+        с уже заполненными полями (см. InkDescriptionParser.parse_ink_node())
+        в порядке их следования в файле.
 
-        Имена директив регистро-зависимы.
-        В случае ошибок генерируются исключения."""
+        tokens  - итератор, возвращающий кортежи (type, line, value),
+                  см. OrgParseIter.tokens()."""
 
-        if dname == 'TAGSTAT':
-            self.__process_tagstat_directive(dvalue)
-        elif dname == 'TAGNAMES':
-            self.__process_tagnames_directive(dvalue)
+        ti = OrgParseIter.TokenInfo
+        HEADLINE, HLEXIT, TEXT, COMMENT, DIRECTIVE = ti.HEADLINE, ti.HLEXIT, ti.TEXT, ti.COMMENT, ti.DIRECTIVE
 
-    def get_ink_description(self, ink):
-        """Получение описания чернил.
+        inktagstr = self.__INK_TAG_STR
+        new_headline_node = self.new_headline_node
 
-        Параметры:
-            ink         - экземпляр OrgHeadlineNode.
+        # итератор нужен именно один и тот же - часть токенов
+        # выбирает из него build_org_tree()
+        tokens = iter(tokens)
 
-        Возвращает кортеж из четырёх строк:
-        'название', 'отсортированный список человекочитаемых меток',
-        'описание', 'наличие'."""
+        # уровень вложенности заголовков вне описаний чернил
+        level = 0
+        prefix = None
 
-        if not isinstance(ink, OrgHeadlineNode):
-            raise TypeError('get_ink_description(ink): "ink" must be OrgHeadlineNode')
+        for ttype, tline, tvalue in tokens:
+            if ttype == HEADLINE:
+                if inktagstr in tvalue:
+                    node = new_headline_node(tvalue)
 
-        if self.__INK_TAG not in ink.tags:
-            raise ValueError('get_ink_description(ink): "ink" must contain ink description')
+                    if self.is_ink_node(node):
+                        node.line = tline
 
-        desc = []
+                        # строим поддерево; HLEXIT выхода из node
+                        # build_org_tree() выбирает сам, поэтому
+                        # level не меняется
+                        build_org_tree(node, tokens, new_headline_node)
 
-        for chld in ink.children:
-            if isinstance(chld, OrgTextNode):
-                desc.append(chld.text)
+                        self.parse_ink_node(node)
 
-        avails = []
+                        yield node
+                        continue
 
-        if ink.availMl > 0.0:
-            if ink.availMl < 500.0:
-                avs = '%.f мл' % ink.availMl
-            else:
-                avs = '%.2f л' % (ink.availMl / 1000.0)
-            avails.append(avs)
+                level += 1
 
-        if ink.availCartridges:
-            avails.append('картриджи')
+            elif ttype == HLEXIT:
+                level -= 1
 
-        # некоторый костылинг
-        disptags = ink.tags.copy()
-        # удаляем служебную метку - она нужна при загрузке БД, не для отображения
-        disptags.remove(self.__INK_TAG)
+            elif level == 0:
+                # на нулевом уровне - как в InkNodeStatistics.scan_node()
+                if ttype == COMMENT:
+                    self.process_comment(tvalue)
+                elif ttype == DIRECTIVE:
+                    prefix = tvalue
+                elif ttype == TEXT:
+                    if prefix is not None:
+                        # OrgDirectiveNode - тоже OrgCommentNode
+                        self.process_comment(tvalue)
 
-        return (ink.text,
-                ', '.join(sorted(map(lambda tag: self.tagNames[tag] if tag in self.tagNames else tag, disptags))),
-                '\n'.join(desc),
-                ' и '.join(avails))
+                        if prefix == 'TAGS':
+                            self.tagTable.add_tags(tvalue.split(None))
 
-    def get_ink_missing_data_str(self, ink):
-        """Возвращает строку, в которой перечислены недостающие данные
-        для ink (экземпляра OrgHeadlineNode), или пустую строку
-        (когда всё данные есть)."""
+                    prefix = None
 
-        return ', '.join(map(lambda k: self.STR_MISSING[k], ink.missing))
+    def read_file(self, fname):
+        """Генератор, возвращающий экземпляры InkHeadlineNode
+        из файла fname (см. read_tokens())."""
+
+        with open(fname, 'r') as orgfile:
+            for node in self.read_tokens(OrgParseIter(orgfile).tokens()):
+                yield node
 
 
-def load_ink_db(fname):
+def load_ink_db(fname, trackblocks=False):
     if not fname:
         print('Файл не указан', file=sys.stderr)
         return None
@@ -968,13 +1807,35 @@ def load_ink_db(fname):
         return None
 
     #print(f'Загружаю {fname}')
-    return MinimalOrgParser(fname)
+    return InkOrgParser(fname, trackblocks=trackblocks)
 
 
 def get_ink_stats(db):
     return InkNodeStatistics(db) if db is not None else None
 
 
+def update_ink_db(db, stats):
+    """Частичная перезагрузка БД db (экземпляра InkOrgParser, загруженного
+    с trackblocks=True) и обновление статистики stats (экземпляра
+    InkNodeStatistics или None).
+
+    Возвращает кортеж из двух элементов:
+    1. экземпляр InkNodeStatistics - stats, если статистику удалось
+       обновить, или новый экземпляр, если её пришлось посчитать
+       заново (изменилась преамбула файла или текущая дата);
+    2. None, если статистика посчитана заново, иначе - кортеж из двух
+       списков - удалённых и добавленных чернил (см. InkNodeStatistics.update()).
+
+    В случае ошибок ввода/вывода генерируются исключения."""
+
+    changes = db.update()
+
+    if changes is None or stats is None or stats.nowDate != datetime.datetime.now().date():
+        return (get_ink_stats(db), None)
+
+    return (stats, stats.update(*changes))
+
+
 def __test_stats():
     print('%s\n' % TITLE_VERSION)
 
@@ -1028,8 +1889,92 @@ def __test_colordesc():
         print(colorv.hexv, colorv.get_description())
 
 
+def __test_color_array():
+    from time import time
+    from random import randrange
+
+    colors = [randrange(0x1000000) for i in range(50000)]
+
+    t0 = time()
+    clrs = [ColorValue.new_from_rgb24(v) for v in colors]
+    t0 = time() - t0
+
+    t1 = time()
+    carr = ColorArray(colors)
+    t1 = time() - t1
+
+    for ix, colorv in enumerate(clrs):
+        if (colorv.h, colorv.l, colorv.s) != (carr.h[ix], carr.l[ix], carr.s[ix]):
+            print('mismatch:', colorv, carr[ix])
+
+    print('numpy: %s; %d colors: ColorValue - %.4f s, ColorArray - %.4f s' % (numpy is not None,
+        len(colors), t0, t1))
+
+
+def __test_pixel_sampler():
+    from time import time
+    from random import randrange
+
+    cx, cy, channels = 1000, 700, 3
+    rowstride = (cx * channels + 3) & ~3
+    pixels = bytes(randrange(256) for i in range(rowstride * (cy - 1) + cx * channels))
+
+    sampler = PixelSampler(pixels, cx, cy, channels, rowstride)
+
+    points = [(randrange(-5, cx + 5), randrange(-5, cy + 5)) for i in range(2000)]
+
+    t0 = time()
+    for x, y in points:
+        sampler.get_intense_color(x, y)
+    t0 = time() - t0
+
+    print('numpy: %s; %d samples, %.1f us per 7x7 sample' % (numpy is not None,
+        len(points), t0 * 1000000 / len(points)))
+
+    t1 = time()
+    if sampler.compute_planes():
+        t1 = time() - t1
+
+        t2 = time()
+        for x, y in points:
+            sampler.get_intense_color(x, y)
+        t2 = time() - t2
+
+        print('planes: %.3f s; %.1f us per 7x7 sample' % (t1, t2 * 1000000 / len(points)))
+
+
+def __test_ink_columns(fname):
+    from time import time
+
+    stats = get_ink_stats(load_ink_db(fname))
+    cols = stats.inkColumns
+
+    t0 = time()
+    counters = cols.get_counters()
+    t0 = time() - t0
+
+    # то же самое перебором экземпляров InkHeadlineNode
+    available = sum(1 for ink in cols.inks if ink.avail)
+    expected = (available, len(cols.inks) - available,
+        sum(1 for ink in cols.inks if ink.done == False),
+        sum(1 for ink in cols.inks if ink.done is None))
+
+    if counters != expected:
+        print('mismatch: %s %s' % (counters, expected))
+
+    t1 = time()
+    totals = stats.get_total_result_table()
+    t1 = time() - t1
+
+    print('%d inks: counters - %.4f s, totals - %.4f s' % (len(cols), t0, t1))
+    print(totals)
+
+
 if __name__ == '__main__':
     print('[debugging %s]' % __file__)
     __test_stats()
     #__test_colordesc()
+    #__test_color_array()
+    #__test_pixel_sampler()
+    #__test_ink_columns(sys.argv[1])
     #__test_misc1()
@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" inkdbcache.py
+
+    This file is part of InkTools.
+
+    InkTools is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    InkTools is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with InkTools.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+import os, os.path, sys
+import pickle
+import gc
+import hashlib
+import datetime
+import tempfile
+
+from inkavail import *
+
+
+class InkDBCache():
+    """Дисковый кэш разобранной БД чернил.
+
+    Файл кэша состоит из трёх частей:
+    1. заголовок (pickle) - словарь с параметрами исходного файла
+       (полный путь, mtime, размер, хэш содержимого) и версиями формата;
+       читается отдельно, поэтому несовпадение параметров проверяется
+       без загрузки всего кэша;
+    2. дерево (pickle) - столбцы с полями ветвей в порядке прямого
+       обхода дерева (см. encode_tree, decode_tree); сами экземпляры
+       OrgNode в кэш не попадают, т.к. списки строк и чисел pickle
+       читает в разы быстрее, чем экземпляры классов со __slots__;
+    3. статистика (pickle) - экземпляр InkNodeStatistics, ссылки
+       которого на ветви дерева записаны как порядковые номера ветвей
+       (см. NodePickler).
+
+    Кэш годен, только если совпадают все параметры исходного файла.
+    Повреждённый или устаревший кэш молча игнорируется - в этом случае
+    файл БД разбирается заново, а кэш перезаписывается."""
+
+    # версия формата кэша; менять при изменениях классов,
+    # экземпляры которых попадают в кэш:
+    # 1 - первая версия;
+    # 2 - хэши блоков в InkOrgParser (частичная перезагрузка);
+    # 3 - InkHeadlineNode.tagMask и таблица меток в статистике;
+    # 4 - TagTable перенесён в модуль inktags;
+    # 5 - дерево хранится в виде столбцов;
+    # 6 - InkNodeStatistics.tagStatIndex (индекс для директив TAGSTAT);
+    # 7 - InkNodeStatistics.inkColumns, availMl стал свойством;
+    # 8 - у TagStatInfo убрано поле tagMask;
+    # 9 - у InkColumns убраны поля tagMasks, tagTable и tagRows
+    CACHE_VERSION = 9
+
+    CACHE_FN_PREFIX = 'dbcache-'
+    CACHE_FN_EXT = '.cache'
+
+    # название подкаталога в ~/.config/ должно совпадать
+    # с inktoolscfg.Config.CFGAPP; сам модуль inktoolscfg
+    # здесь не импортируем, т.к. он тащит за собой Gtk
+    CFGAPP = 'inktools'
+
+    HASH_BLOCK_SIZE = 1 << 20
+
+    H_CACHE_VERSION = 'cacheversion'
+    H_APP_VERSION = 'appversion'
+    H_PATH = 'path'
+    H_MTIME = 'mtime'
+    H_SIZE = 'size'
+    H_HASH = 'hash'
+
+    # этапы загрузки, передаваемые функции progress в load_ink_db()
+    STAGE_CACHE = 'чтение кэша'
+    STAGE_PARSE = 'разбор файла'
+    STAGE_STATS = 'подсчёт статистики'
+    STAGE_SAVE = 'запись кэша'
+
+    # типы ветвей в записях дерева
+    K_ROOT, K_TEXT, K_COMMENT, K_DIRECTIVE, K_HEADLINE, K_INK = range(6)
+
+    class NodePickler(pickle.Pickler):
+        """Pickler, записывающий вместо экземпляров OrgNode
+        их порядковые номера в списке nodes."""
+
+        def __init__(self, file, nodes):
+            super().__init__(file, pickle.HIGHEST_PROTOCOL)
+
+            self.nodeIndices = {id(node):ix for ix, node in enumerate(nodes)}
+
+        def persistent_id(self, obj):
+            if isinstance(obj, OrgNode):
+                ix = self.nodeIndices.get(id(obj))
+                if ix is None:
+                    raise pickle.PicklingError('%s не принадлежит дереву' % obj.__class__.__name__)
+
+                return ix
+
+            return None
+
+    class NodeUnpickler(pickle.Unpickler):
+        """Unpickler, заменяющий порядковые номера, записанные
+        NodePickler, на экземпляры OrgNode из списка nodes."""
+
+        def __init__(self, file, nodes):
+            super().__init__(file)
+
+            # метод списка вызывается из C-кода Unpickler'а напрямую,
+            # без лишнего вызова питоньей функции на каждую ссылку
+            self.persistent_load = nodes.__getitem__
+
+    def __init__(self, cachedir=None):
+        """Параметры:
+        cachedir    - None или строка с путём к каталогу кэша;
+                      если None - используется ~/.config/inktools.
+
+        Каталог создаётся при первой записи кэша."""
+
+        if not cachedir:
+            cachedir = os.path.join(os.path.expanduser('~'), '.config', self.CFGAPP)
+
+        self.cacheDir = cachedir
+
+    def get_cache_file_name(self, fname):
+        """Возвращает полный путь к файлу кэша для файла БД fname.
+        Имя файла кэша получается из хэша полного пути к fname,
+        т.е. для каждого файла БД - свой файл кэша."""
+
+        fname = os.path.abspath(fname)
+
+        return os.path.join(self.cacheDir, '%s%s%s' % (self.CACHE_FN_PREFIX,
+            hashlib.sha1(fname.encode('utf-8', 'surrogateescape')).hexdigest(),
+            self.CACHE_FN_EXT))
+
+    def get_file_header(self, fname):
+        """Возвращает заголовок (словарь) с параметрами файла fname.
+        В случае ошибок ввода/вывода генерируются исключения."""
+
+        fname = os.path.abspath(fname)
+
+        fhash = hashlib.sha1()
+
+        with open(fname, 'rb') as f:
+            st = os.fstat(f.fileno())
+
+            while True:
+                buf = f.read(self.HASH_BLOCK_SIZE)
+                if not buf:
+                    break
+
+                fhash.update(buf)
+
+        return {self.H_CACHE_VERSION:self.CACHE_VERSION,
+            self.H_APP_VERSION:VERSION,
+            self.H_PATH:fname,
+            self.H_MTIME:st.st_mtime_ns,
+            self.H_SIZE:st.st_size,
+            self.H_HASH:fhash.hexdigest()}
+
+    def encode_tree(self, rootnode):
+        """Преобразование дерева в набор столбцов для кэша.
+
+        rootnode    - экземпляр InkOrgParser.
+
+        Возвращает кортеж из двух элементов:
+        1. кортеж столбцов (см. decode_tree) - значения полей ветвей
+           в порядке прямого обхода дерева;
+        2. список экземпляров OrgNode в том же порядке.
+
+        Если в дереве есть ветви неизвестных типов, генерируется
+        исключение ValueError."""
+
+        kinds = bytearray()
+        nchildren = []
+        lines = []
+        texts = []
+        extras = []
+
+        nodes = []
+
+        stack = [rootnode]
+
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+
+            children = node.children
+            if children:
+                stack.extend(reversed(children))
+
+            ntype = type(node)
+
+            if ntype is OrgTextNode:
+                kinds.append(self.K_TEXT)
+            elif ntype is InkHeadlineNode:
+                kinds.append(self.K_INK)
+
+                usage = node.usage
+                if usage is not None:
+                    usage = [(u.date.toordinal(), u.comment) for u in usage]
+
+                extras.append((node.done, node.priority, node.tags,
+                    node.missing, node.color, node.maincolor, usage,
+                    node.daysSLU, node.avail, node.availMl, node.availCartridges,
+                    node.tagMask))
+            elif ntype is OrgHeadlineNode:
+                kinds.append(self.K_HEADLINE)
+                extras.append((node.done, node.priority, node.tags))
+            elif ntype is OrgCommentNode:
+                kinds.append(self.K_COMMENT)
+            elif ntype is OrgDirectiveNode:
+                kinds.append(self.K_DIRECTIVE)
+                extras.append((node.name,))
+            elif ntype is InkOrgParser and node is rootnode:
+                kinds.append(self.K_ROOT)
+                extras.append((node.preambleHash, node.blockHashes))
+            else:
+                raise ValueError('неподдерживаемый тип ветви - %s' % ntype.__name__)
+
+            nchildren.append(len(children))
+            lines.append(node.line)
+            texts.append(node.text)
+
+        return ((bytes(kinds), nchildren, lines, texts, extras), nodes)
+
+    def decode_tree(self, columns):
+        """Восстановление дерева из столбцов, созданных encode_tree().
+
+        columns - кортеж из пяти элементов:
+                  1. bytes - типы ветвей (K_*);
+                  2. список кол-в дочерних ветвей;
+                  3. список номеров строк;
+                  4. список строк с текстом ветвей;
+                  5. список кортежей с полями, специфичными для типа
+                     (только для ветвей, у которых такие поля есть).
+
+        Столбцы вместо списка кортежей по ветвям: длинные списки
+        строк и чисел pickle читает заметно быстрее, чем столько же
+        мелких кортежей, а самые многочисленные ветви (текстовые)
+        создаются без распаковки отдельных записей.
+
+        Возвращает кортеж из двух элементов - экземпляр InkOrgParser
+        и список всех экземпляров OrgNode в порядке прямого обхода.
+
+        В случае повреждённых данных генерируются исключения."""
+
+        kinds, nchildren, lines, texts, extras = columns
+
+        if not (len(kinds) == len(nchildren) == len(lines) == len(texts)):
+            raise ValueError('неправильная длина столбцов в кэше')
+
+        nextextra = iter(extras).__next__
+
+        K_TEXT = self.K_TEXT
+        K_INK = self.K_INK
+        K_HEADLINE = self.K_HEADLINE
+        K_COMMENT = self.K_COMMENT
+        K_DIRECTIVE = self.K_DIRECTIVE
+        K_ROOT = self.K_ROOT
+
+        newnode = object.__new__
+        noChildren = OrgNode.EMPTY_CHILDREN
+        usageinfo = InkNodeStatistics.usageinfo
+        fromordinal = datetime.date.fromordinal
+
+        nodes = []
+
+        # незаполненный список дочерних ветвей, кол-во недостающих
+        # в нём ветвей и стек таких же пар для вышестоящих уровней
+        children = None
+        nmissing = 0
+        stack = []
+
+        rootnode = None
+
+        for kind, nchld, line, text in zip(kinds, nchildren, lines, texts):
+            if kind == K_TEXT:
+                node = newnode(OrgTextNode)
+            elif kind == K_INK:
+                node = newnode(InkHeadlineNode)
+                node.done, node.priority, node.tags,\
+                    node.missing, node.color, node.maincolor, usage,\
+                    node.daysSLU, node.avail, node.availMl, node.availCartridges,\
+                    node.tagMask = nextextra()
+
+                if usage is not None:
+                    usage = [usageinfo(fromordinal(udate), ucmt) for udate, ucmt in usage]
+
+                node.usage = usage
+            elif kind == K_HEADLINE:
+                node = newnode(OrgHeadlineNode)
+                node.done, node.priority, node.tags = nextextra()
+            elif kind == K_COMMENT:
+                node = newnode(OrgCommentNode)
+            elif kind == K_DIRECTIVE:
+                node = newnode(OrgDirectiveNode)
+                node.name, = nextextra()
+            elif kind == K_ROOT and rootnode is None:
+                node = newnode(InkOrgParser)
+                node.preambleHash, node.blockHashes = nextextra()
+                rootnode = node
+            else:
+                raise ValueError('неправильный тип ветви - %s' % kind)
+
+            node.line = line
+            node.text = text
+
+            if nmissing:
+                children.append(node)
+                nmissing -= 1
+
+                if not nmissing and stack:
+                    children, nmissing = stack.pop()
+            elif nodes:
+                raise ValueError('лишние ветви в кэше')
+
+            nodes.append(node)
+
+            if nchld:
+                if nmissing:
+                    stack.append((children, nmissing))
+
+                node.children = children = []
+                nmissing = nchld
+            else:
+                node.children = noChildren
+
+        if nmissing or not nodes or rootnode is not nodes[0]:
+            raise ValueError('неполное дерево в кэше')
+
+        return (rootnode, nodes)
+
+    def load(self, fname, header):
+        """Загрузка дерева и статистики из кэша.
+
+        fname   - имя файла БД;
+        header  - заголовок, полученный от get_file_header(fname).
+
+        Возвращает кортеж из двух элементов (экземпляров InkOrgParser
+        и InkNodeStatistics), если в кэше есть годные данные,
+        иначе возвращает None."""
+
+        # при создании множества мелких объектов сборщик мусора
+        # срабатывает раз за разом впустую (мусора при загрузке
+        # не образуется), так что на время загрузки его отключаем
+        gcenabled = gc.isenabled()
+        gc.disable()
+
+        try:
+            with open(self.get_cache_file_name(fname), 'rb') as f:
+                if pickle.load(f) != header:
+                    return
+
+                db, nodes = self.decode_tree(pickle.load(f))
+                stats = self.NodeUnpickler(f, nodes).load()
+        except Exception:
+            # кэша нет, или он повреждён, или остался от версии
+            # с другими классами - один фиг разбираем файл заново
+            return
+        finally:
+            if gcenabled:
+                gc.enable()
+
+        if not isinstance(stats, InkNodeStatistics):
+            return
+
+        return (db, stats)
+
+    def save(self, fname, header, db, stats):
+        """Сохранение дерева и статистики в кэш.
+
+        fname   - имя файла БД;
+        header  - заголовок, полученный от get_file_header(fname)
+                  до разбора файла;
+        db      - экземпляр InkOrgParser;
+        stats   - экземпляр InkNodeStatistics.
+
+        Файл кэша пишется через временный файл, дабы при сбое
+        не оставить недописанный кэш.
+        Ошибки записи игнорируются - кэш не обязателен."""
+
+        tmpname = None
+
+        try:
+            records, nodes = self.encode_tree(db)
+
+            if not os.path.exists(self.cacheDir):
+                os.makedirs(self.cacheDir)
+
+            fd, tmpname = tempfile.mkstemp(prefix=self.CACHE_FN_PREFIX,
+                dir=self.cacheDir)
+
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(records, f, pickle.HIGHEST_PROTOCOL)
+                self.NodePickler(f, nodes).dump(stats)
+
+            os.replace(tmpname, self.get_cache_file_name(fname))
+            tmpname = None
+        except (OSError, ValueError, pickle.PicklingError, RecursionError):
+            pass
+        finally:
+            if tmpname is not None:
+                try:
+                    os.remove(tmpname)
+                except OSError:
+                    pass
+
+    def load_ink_db(self, fname, trackblocks=False, progress=None):
+        """Загрузка БД чернил с использованием кэша.
+
+        fname       - имя файла БД;
+        trackblocks - булевское значение, см. inkavail.load_ink_db();
+                      если True, а дерево в кэше сохранено без хэшей
+                      блоков - кэш не используется;
+        progress    - None или функция с одним параметром - строкой
+                      с названием этапа загрузки (STAGE_*), вызываемая
+                      перед началом каждого этапа; т.к. load_ink_db()
+                      может выполняться в отдельном потоке, функция
+                      должна быть потокобезопасной.
+
+        Возвращает кортеж из двух элементов - экземпляров InkOrgParser
+        и InkNodeStatistics, или (None, None), если файл не найден.
+
+        Если данные взяты из кэша, но статистика была посчитана
+        не сегодня, статистика пересчитывается по закэшированному
+        дереву (кол-во дней с последнего использования зависит
+        от текущей даты), а кэш перезаписывается."""
+
+        def __stage(name):
+            if progress is not None:
+                progress(name)
+
+        if not fname or not os.path.exists(fname):
+            # сообщение об ошибке выдаст inkavail.load_ink_db()
+            return (load_ink_db(fname, trackblocks), None)
+
+        try:
+            header = self.get_file_header(fname)
+        except OSError:
+            header = None
+
+        if header is None:
+            # хэш посчитать не удалось - работаем без кэша
+            __stage(self.STAGE_PARSE)
+            db = load_ink_db(fname, trackblocks)
+
+            __stage(self.STAGE_STATS)
+            return (db, get_ink_stats(db))
+
+        __stage(self.STAGE_CACHE)
+
+        cached = self.load(fname, header)
+        if cached is not None and trackblocks and cached[0].blockHashes is None:
+            cached = None
+
+        if cached is not None:
+            db, stats = cached
+
+            if stats.nowDate == datetime.datetime.now().date():
+                return (db, stats)
+        else:
+            __stage(self.STAGE_PARSE)
+            db = load_ink_db(fname, trackblocks)
+
+        __stage(self.STAGE_STATS)
+        stats = get_ink_stats(db)
+
+        if db is not None:
+            __stage(self.STAGE_SAVE)
+            self.save(fname, header, db, stats)
+
+        return (db, stats)
+
+    def update_ink_db(self, db, stats):
+        """Частичная перезагрузка БД с обновлением кэша.
+
+        Параметры и возвращаемое значение - как у inkavail.update_ink_db()."""
+
+        fname = db.text
+
+        try:
+            header = self.get_file_header(fname)
+        except OSError:
+            header = None
+
+        stats, changes = update_ink_db(db, stats)
+
+        if header is not None:
+            self.save(fname, header, db, stats)
+
+        return (stats, changes)
+
+
+def load_ink_db_cached(fname, cachedir=None):
+    """Загрузка БД чернил fname с использованием кэша в каталоге cachedir
+    (см. InkDBCache).
+
+    Возвращает кортеж из двух элементов - экземпляров InkOrgParser
+    и InkNodeStatistics, или (None, None)."""
+
+    return InkDBCache(cachedir).load_ink_db(fname)
+
+
+def __debug_cache_benchmark(fname, repeat=5):
+    from time import perf_counter
+
+    with tempfile.TemporaryDirectory() as cachedir:
+        t0 = perf_counter()
+        for i in range(repeat):
+            get_ink_stats(load_ink_db(fname))
+        tparse = (perf_counter() - t0) / repeat
+
+        cache = InkDBCache(cachedir)
+        cache.load_ink_db(fname)
+
+        t0 = perf_counter()
+        for i in range(repeat):
+            db, stats = cache.load_ink_db(fname)
+        tcache = (perf_counter() - t0) / repeat
+
+    print('parse: %.3f s, cache: %.3f s' % (tparse, tcache))
+
+
+if __name__ == '__main__':
+    print('[debugging %s]' % __file__)
+
+    __debug_cache_benchmark(sys.argv[1] if len(sys.argv) > 1 else 'inks.org')
@@ -20,36 +20,139 @@
 
 
 
+# Внимание!
+# Модуль должен импортироваться (и CLI - запускаться) быстро:
+# тяжёлые модули (inkavail с orgmodeparser, re, datetime и т.п.)
+# импортируются только при необходимости пересоздания снимка БД
+# (см. RandomInkSnapshot.build()).
+
 import sys
-from random import choice as random_choice
-from textwrap import fill
+import os, os.path
+import marshal
+import time
+from zlib import crc32
+from random import randrange, random
+from bisect import bisect_right
+from itertools import accumulate
+from heapq import nlargest
+from math import log, inf
+
+from inktags import TagTable
+
+
+#
+# весовые функции для RandomInkChooser.set_weight_function()
+# получают экземпляр InkHeadlineNode, возвращают неотрицательное
+# число - вес (чем больше, тем чаще выбираются чернила)
+#
+
+# сколько дней считать для ни разу не использованных чернил
+NEVER_USED_DAYS = 365
+
+
+def weight_days_since_use(ink):
+    """Давно не использованные чернила выбираются чаще."""
+
+    return (NEVER_USED_DAYS if ink.daysSLU is None else ink.daysSLU) + 1
+
 
-from inkavail import *
+def weight_usage_count(ink):
+    """Реже заправлявшиеся чернила выбираются чаще."""
+
+    return 1.0 / (1 + len(ink.usage))
+
+
+def weight_avail_ml(ink):
+    """Чем больше чернил осталось, тем чаще они выбираются
+    (у чернил только в картриджах - минимальный вес)."""
+
+    return max(ink.availMl, 1.0)
+
+
+# ключи - названия режимов выбора, значения - весовые функции
+# (None - равновероятный выбор)
+WEIGHT_FUNCTIONS = {'uniform':None,
+    'days':weight_days_since_use,
+    'usage':weight_usage_count,
+    'volume':weight_avail_ml}
 
 
 class RandomInkChooser():
-    def __init__(self, stats, excludetags, includetags):
+    def __init__(self, stats, excludetags, includetags, availinks=None, tagtable=None,
+            weightfunc=None):
         """Параметры:
         excludetags     - None или множество строк с тэгами,
                           которые НЕ ДОЛЖНЫ попадать в выбор;
         includetags     - None или множество строк с тэгами,
                           которые ДОЛЖНЫ попадать в выбор.
-        stats           - экземпляр inkavail.InkNodeStatistics.
+        stats           - экземпляр inkavail.InkNodeStatistics
+                          или None (если указан availinks);
+        availinks       - None или список экземпляров OrgHeadlineNode
+                          с данными о чернилах, которые есть в наличии;
+                          если None - используется stats.availInks;
+        tagtable        - None или экземпляр inktags.TagTable, в котором
+                          посчитаны маски меток (InkHeadlineNode.tagMask)
+                          чернил из availinks;
+                          если None - используется stats.tagTable;
+        weightfunc      - None (равновероятный выбор) или весовая
+                          функция (см. set_weight_function()).
 
         Поля:
-        stats           - экземпляр inkavail.InkNodeStatistics;
+        stats           - экземпляр inkavail.InkNodeStatistics или None;
+        availInks       - None или список чернил в наличии
+                          (параметр availinks);
         inks            - отфильтрованный (по меткам) список экземпляров)
                           OrgHeadlineNode с данными о чернилах, которые
-                          есть в наличии."""
+                          есть в наличии;
+        filterCache     - словарь с результатами filter_inks(), где ключи -
+                          кортежи из масок меток фильтров, а значения -
+                          списки вида [inks, None или словарь, где ключи -
+                          id(ink), а значения - индексы ink в inks,
+                          None или список накопленных сумм весов inks];
+                          сбрасывается методом invalidate();
+        weightFunc      - None или весовая функция."""
+
+        if availinks is not None and tagtable is None and not stats:
+            raise ValueError('%s: availinks requires stats or tagtable' % self.__class__.__name__)
 
         self.stats = stats
+        self.availInks = availinks
+        self.tagTable = tagtable if tagtable is not None else stats.tagTable if stats else TagTable()
         self.inks = []
 
+        self.filterCache = dict()
+        self.__filtered = None
+
+        self.weightFunc = weightfunc
+
         self.nInks = 0
         self.lastChoice = None
+        self.lastIndex = None
 
         self.filter_inks(excludetags, includetags)
 
+    def invalidate(self):
+        """Сброс кэша отфильтрованных списков; вызывать после изменения
+        списка чернил в наличии (перезагрузки БД)."""
+
+        self.filterCache.clear()
+
+    def set_weight_function(self, weightfunc):
+        """Выбор режима для choice().
+
+        weightfunc  - None (все чернила выбираются равновероятно)
+                      или функция, получающая экземпляр InkHeadlineNode
+                      и возвращающая вес - неотрицательное число
+                      (см. WEIGHT_FUNCTIONS).
+
+        Таблицы весов строятся заново при следующем выборе."""
+
+        if weightfunc is not self.weightFunc:
+            self.weightFunc = weightfunc
+
+            for filtered in self.filterCache.values():
+                filtered[2] = None
+
     def filter_inks(self, excludetags, includetags):
         """Заполнение списка inks экземплярами OrgHeadlineNode
         с данными чернил, соответствующих меткам.
@@ -58,70 +161,538 @@ class RandomInkChooser():
         excludetags - None или множество строк с тэгами,
                       которые НЕ ДОЛЖНЫ попадать в выбор;
         includetags - None или множество строк с тэгами,
-                      которые ДОЛЖНЫ попадать в выбор."""
+                      которые ДОЛЖНЫ попадать в выбор.
 
-        def __filter_ink(ink):
-            """Параметры:
-            ink         - экземпляр OrgHeadlineNode;
+        Результаты кэшируются до вызова invalidate()."""
 
-            Возвращает булевское значение (True, если ink соответствует
-            заданным параметрам)."""
+        # метки фильтров переводим в битовые маски один раз,
+        # дальше для каждых чернил - только битовые операции
+        # (TagTable регистр букв не учитывает)
+        excludeMask = self.tagTable.find_mask(excludetags) if excludetags else 0
+        includeMask = self.tagTable.find_mask(includetags) if includetags else 0
 
-            if ink.availMl < 0.0 and not ink.availCartridges:
-                return False
+        # includeMask == 0 при непустом includetags (незнакомые метки) -
+        # не то же самое, что отсутствие фильтра
+        cachekey = (excludeMask, includeMask if includetags else None)
 
-            inkTags = set(map(lambda s: s.lower(), ink.tags))
+        filtered = self.filterCache.get(cachekey)
 
-            if excludetags and not inkTags.isdisjoint(excludetags):
-                return False
+        if filtered is None:
+            def __filter_ink(ink):
+                """Параметры:
+                ink         - экземпляр InkHeadlineNode;
 
-            if includetags and inkTags.isdisjoint(includetags):
-                return False
+                Возвращает булевское значение (True, если ink соответствует
+                заданным параметрам)."""
 
-            return True
+                if ink.availMl < 0.0 and not ink.availCartridges:
+                    return False
 
-        if self.stats:
-            self.inks = list(filter(__filter_ink, self.stats.availInks))
-        else:
-            self.inks.clear()
+                if ink.tagMask & excludeMask:
+                    return False
+
+                if includetags and not ink.tagMask & includeMask:
+                    return False
+
+                return True
 
+            if self.availInks is not None:
+                inks = list(filter(__filter_ink, self.availInks))
+            elif self.stats:
+                inks = list(filter(__filter_ink, self.stats.availInks))
+            else:
+                inks = []
+
+            filtered = [inks, None, None]
+            self.filterCache[cachekey] = filtered
+
+        self.__filtered = filtered
+        self.inks = filtered[0]
         self.nInks = len(self.inks)
 
+    def __get_last_index(self):
+        """Возвращает индекс lastChoice в inks или None,
+        если lastChoice в inks нет."""
+
+        if self.lastChoice is None:
+            return None
+
+        # чаще всего список с прошлого раза не менялся
+        if self.lastIndex is not None and self.lastIndex < self.nInks \
+                and self.inks[self.lastIndex] is self.lastChoice:
+            return self.lastIndex
+
+        # иначе - по словарю индексов, который строится один раз
+        # для каждого закэшированного списка
+        filtered = self.__filtered
+        if filtered[1] is None:
+            filtered[1] = {id(ink): ix for ix, ink in enumerate(self.inks)}
+
+        return filtered[1].get(id(self.lastChoice))
+
+    def __get_weight_sums(self):
+        """Возвращает список накопленных сумм весов
+        для inks; таблица строится один раз для каждого закэшированного
+        списка (до смены фильтров, весовой функции или БД)."""
+
+        filtered = self.__filtered
+
+        if filtered[2] is None:
+            weightfunc = self.weightFunc
+            filtered[2] = list(accumulate(max(weightfunc(ink), 0.0) for ink in self.inks))
+
+        return filtered[2]
+
+    def __weighted_index(self, lastix):
+        """Возвращает индекс в inks, выбранный с учётом весов
+        (кроме lastix, если он не None), или None, если у всех
+        кандидатов нулевые веса."""
+
+        sums = self.__get_weight_sums()
+
+        if lastix is None:
+            lastlo = lastw = 0.0
+        else:
+            # отрезок lastix на оси накопленных сумм выкидываем
+            lastlo = sums[lastix - 1] if lastix > 0 else 0.0
+            lastw = sums[lastix] - lastlo
+
+        total = sums[-1] - lastw
+        if total <= 0.0:
+            return None
+
+        r = random() * total
+        if lastix is not None and r >= lastlo:
+            r += lastw
+
+        ix = bisect_right(sums, r)
+
+        # защита от погрешностей округления на границах отрезков
+        if ix >= self.nInks:
+            ix = self.nInks - 1
+        if ix == lastix:
+            ix = ix + 1 if ix + 1 < self.nInks else ix - 1
+
+        return ix
+
     def choice(self):
         """Возвращает случайный экземпляр OrgHeadlineNode
-        (если было из чего выбирать) или None."""
+        (если было из чего выбирать) или None.
+        Чернила, выбранные в прошлый раз, повторно не выбираются
+        (если есть из чего выбирать).
+        Если задана весовая функция (см. set_weight_function()),
+        вероятность выбора чернил пропорциональна их весу; выбор -
+        двоичный поиск по таблице накопленных сумм весов."""
 
         if self.nInks >= 2:
-            # не присобачить ли счетчик на случай зацикливания ГПСЧ на одинаковом значении?
-            while True:
-                ink = random_choice(self.inks)
-                if ink != self.lastChoice:
-                    break
+            lastix = self.__get_last_index()
+
+            ix = None if self.weightFunc is None else self.__weighted_index(lastix)
+
+            # равновероятный выбор - и без весовой функции,
+            # и если у всех кандидатов нулевой вес
+            if ix is None:
+                if lastix is None:
+                    ix = randrange(self.nInks)
+                else:
+                    # одна попытка: выбираем из всех индексов, кроме lastix
+                    ix = randrange(self.nInks - 1)
+                    if ix >= lastix:
+                        ix += 1
         elif self.nInks == 1:
-            ink = self.inks[0]
+            ix = 0
+        else:
+            ix = None
+
+        self.lastIndex = ix
+        self.lastChoice = None if ix is None else self.inks[ix]
+
+        return self.lastChoice
+
+    def sample(self, count, uniquemaincolor=False):
+        """Возвращает список из не более чем count разных экземпляров
+        OrgHeadlineNode, выбранных случайным образом (без повторов) -
+        напр., план заправок на неделю.
+
+        uniquemaincolor - если True, в список не попадут двое чернил
+                          с одинаковым основным цветом
+                          (InkHeadlineNode.maincolor; чернила без
+                          основного цвета ограничением не затронуты).
+
+        Если задана весовая функция, выбор - как при последовательных
+        вызовах choice() без возврата (каждому кандидату один раз
+        назначается случайный ключ random() ** (1 / вес), берутся
+        кандидаты с наибольшими ключами). Чернила с нулевым весом
+        попадают в список только если остальных не хватило."""
+
+        if count <= 0 or not self.inks:
+            return []
+
+        weightfunc = self.weightFunc
+
+        if weightfunc is None:
+            keys = [random() for ink in self.inks]
+        else:
+            # log(u) / w вместо u ** (1 / w) - тот же порядок,
+            # но без потери точности при маленьких весах;
+            # 1.0 - random() - чтобы не было log(0)
+            keys = []
+
+            for ink in self.inks:
+                w = weightfunc(ink)
+                keys.append(log(1.0 - random()) / w if w > 0.0 else -inf)
+
+            # у чернил с нулевым весом - случайный порядок между собой
+            keys = list(zip(keys, (random() for k in keys)))
+
+        if not uniquemaincolor:
+            return [self.inks[ix] for ix in nlargest(count, range(self.nInks), key=keys.__getitem__)]
+
+        # с ограничением: обходим кандидатов в порядке убывания ключей,
+        # пропуская чернила с уже выбранными основными цветами
+        chosen = []
+        usedColors = set()
+
+        for ix in sorted(range(self.nInks), key=keys.__getitem__, reverse=True):
+            ink = self.inks[ix]
+
+            if ink.maincolor is not None:
+                if ink.maincolor in usedColors:
+                    continue
+
+                usedColors.add(ink.maincolor)
+
+            chosen.append(ink)
+            if len(chosen) >= count:
+                break
+
+        return chosen
+
+
+class InkSnapshotRecord():
+    """Данные чернил из снимка БД (см. RandomInkSnapshot) - то, что
+    нужно RandomInkChooser, весовым функциям и выводу CLI.
+    Поля с теми же именами, что у InkHeadlineNode, имеют тот же смысл.
+
+    Поля:
+    text, tagMask, maincolor, daysSLU, availMl, availCartridges;
+    usage           - кортеж дат использования (date.toordinal());
+    tagsText        - строка с человекочитаемыми метками;
+    description     - описание, уже разбитое на строки для вывода;
+    availability    - строка с описанием наличия."""
+
+    __slots__ = 'text', 'tagsText', 'description', 'availability',\
+        'tagMask', 'maincolor', 'daysSLU', 'usage', 'availMl', 'availCartridges'
+
+    def __init__(self, text, tagsText, description, availability,
+            tagMask, maincolor, daysSLU, usage, availMl, availCartridges):
+        self.text = text
+        self.tagsText = tagsText
+        self.description = description
+        self.availability = availability
+        self.tagMask = tagMask
+        self.maincolor = maincolor
+        self.daysSLU = daysSLU
+        self.usage = usage
+        self.availMl = availMl
+        self.availCartridges = availCartridges
+
+
+class RandomInkSnapshot():
+    """Компактный снимок чернил в наличии для быстрого старта CLI.
+
+    Хранится в файле (формат marshal) в каталоге настроек и
+    пересоздаётся только при изменении времени модификации или размера
+    файла БД (или формата снимка).
+
+    Поля:
+    dbFileName      - полный путь к файлу БД;
+    snapshotPath    - полный путь к файлу снимка;
+    title           - название и версия программы, создавшей снимок
+                      (чтобы не импортировать ради них inkavail);
+    tags            - список меток в порядке битов TagTable;
+    records         - список экземпляров InkSnapshotRecord."""
+
+    SNAPSHOT_VERSION = 1
+
+    CFGAPP = 'inktools'
+    SNAPSHOT_FN_PREFIX = 'rndsnapshot-'
+
+    def __init__(self, dbfname, snapshotdir=None):
+        """dbfname      - путь к файлу БД;
+        snapshotdir - каталог для снимков; если None -
+                      ~/.config/inktools (как у inktoolscfg.Config)."""
+
+        self.dbFileName = os.path.abspath(os.path.expanduser(dbfname))
+
+        if snapshotdir is None:
+            snapshotdir = os.path.join(os.path.expanduser('~'), '.config', self.CFGAPP)
+
+        self.snapshotPath = os.path.join(snapshotdir, '%s%.8x.marshal' % (self.SNAPSHOT_FN_PREFIX,
+            crc32(self.dbFileName.encode('utf-8', 'surrogatepass'))))
+
+        self.title = ''
+        self.tags = []
+        self.records = []
+
+    @staticmethod
+    def get_day_number():
+        """Возвращает номер текущего (местного) дня - для пересчёта
+        daysSLU без импорта datetime.
+        Полдень - чтобы переходы на летнее время не сдвигали дату."""
+
+        t = time.localtime()
+
+        return int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 12, 0, 0, 0, 0, -1)) // 86400)
+
+    def __get_db_stat(self):
+        st = os.stat(self.dbFileName)
+
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self):
+        """Загрузка снимка из файла.
+        Возвращает True, если снимок загружен и соответствует файлу БД,
+        иначе False (в т.ч. если файла снимка нет или он повреждён).
+        Если нет файла БД - генерируется исключение OSError."""
+
+        dbstat = self.__get_db_stat()
+
+        try:
+            with open(self.snapshotPath, 'rb') as f:
+                data = marshal.load(f)
+
+            version, dbfname, mtime, size, daynum, title, tags, records = data
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+
+        if version != self.SNAPSHOT_VERSION or dbfname != self.dbFileName or (mtime, size) != dbstat:
+            return False
+
+        # daysSLU в снимке посчитаны на день его создания
+        ddays = self.get_day_number() - daynum
+
+        self.title = title
+        self.tags = tags
+        self.records = [InkSnapshotRecord(*rec) for rec in records]
+
+        if ddays:
+            for rec in self.records:
+                if rec.daysSLU is not None:
+                    rec.daysSLU += ddays
+
+        return True
+
+    def build(self):
+        """Создание снимка разбором файла БД (потоковым, см.
+        inkavail.InkRecordReader).
+        В случае ошибок генерируются исключения."""
+
+        from inkavail import InkRecordReader, TITLE_VERSION
+        from textwrap import fill
+
+        reader = InkRecordReader()
+
+        self.records.clear()
+
+        for ink in reader.read_file(self.dbFileName):
+            if not ink.avail:
+                continue
+
+            inkName, inkTags, inkDescription, inkAvailability = reader.get_ink_description(ink)
+
+            self.records.append(InkSnapshotRecord(inkName, inkTags, fill(inkDescription), inkAvailability,
+                ink.tagMask, ink.maincolor, ink.daysSLU,
+                tuple(u.date.toordinal() for u in ink.usage),
+                ink.availMl, ink.availCartridges))
+
+        self.title = TITLE_VERSION
+        self.tags = list(reader.tagTable.tags)
+
+    def save(self):
+        """Запись снимка в файл (через временный файл, чтобы
+        одновременно запущенный CLI не прочёл недописанный).
+        В случае ошибок генерируются исключения."""
+
+        dbstat = self.__get_db_stat()
+
+        data = (self.SNAPSHOT_VERSION, self.dbFileName, dbstat[0], dbstat[1],
+            self.get_day_number(), self.title, self.tags,
+            [(rec.text, rec.tagsText, rec.description, rec.availability,
+                rec.tagMask, rec.maincolor, rec.daysSLU, rec.usage,
+                rec.availMl, rec.availCartridges) for rec in self.records])
+
+        os.makedirs(os.path.dirname(self.snapshotPath), exist_ok=True)
+
+        # tempfile не используем - он импортируется долго
+        tmppath = '%s.%d.tmp' % (self.snapshotPath, os.getpid())
+
+        try:
+            with open(tmppath, 'wb') as f:
+                marshal.dump(data, f)
+
+            os.replace(tmppath, self.snapshotPath)
+            tmppath = None
+        finally:
+            if tmppath is not None and os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def update(self):
+        """Загрузка снимка, а если он устарел или отсутствует -
+        пересоздание и запись (ошибки записи не фатальны -
+        снимок просто не сохраняется).
+        Возвращает True, если снимок был пересоздан."""
+
+        if self.load():
+            return False
+
+        self.build()
+
+        try:
+            self.save()
+        except OSError as ex:
+            print('* не удалось сохранить снимок БД: %s' % str(ex), file=sys.stderr)
+
+        return True
+
+    def get_tag_table(self):
+        """Возвращает экземпляр TagTable с теми же номерами битов,
+        что и при создании снимка."""
+
+        return TagTable(self.tags)
+
+
+class CmdLineArgs():
+    """Параметры командной строки (см. process_cmdline())."""
+
+    USAGE = """Использование: %s [-f файл_БД] [-n количество] [-u] [-w режим] [[!]метка ...]
+
+  [!]метка              метки чернил, которые нужно включить в выбор
+                        ("!метка" - исключить из выбора)
+  -f, --file ФАЙЛ       файл БД (по умолчанию - inks.org в каталоге программы)
+  -n, --count N         сколько разных чернил выбрать
+                        (напр., план заправок на неделю)
+  -u, --unique-color    не выбирать чернила с одинаковым основным цветом
+  -w, --weight РЕЖИМ    режим выбора: uniform - равновероятный,
+                        days - чаще давно не использованные,
+                        usage - чаще реже заправлявшиеся,
+                        volume - чаще те, которых больше осталось
+  -h, --help            эта справка"""
+
+    def __init__(self):
+        self.dbfile = os.path.join(os.path.split(os.path.abspath(sys.argv[0]))[0], 'inks.org')
+        self.tags = []
+        self.count = 1
+        self.uniquecolor = False
+        self.weight = 'uniform'
+
+
+def process_cmdline(argv=None):
+    """Разбор командной строки (argv - список параметров без имени
+    программы; если None - берётся из sys.argv).
+    Возвращает экземпляр CmdLineArgs.
+
+    argparse/getopt здесь не используются - они тянут за собой
+    gettext, re и т.п., а CLI должен запускаться быстро.
+    При ошибках выводит сообщение и завершает программу."""
+
+    args = CmdLineArgs()
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    def __usage_exit(msg=None, code=2):
+        if msg:
+            print('Ошибка: %s\n' % msg, file=sys.stderr)
+
+        print(args.USAGE % os.path.split(sys.argv[0])[-1], file=sys.stderr if msg else sys.stdout)
+        sys.exit(code)
+
+    argv = list(argv)
+    nomoreopts = False
+
+    while argv:
+        arg = argv.pop(0)
+
+        if nomoreopts or not arg.startswith('-') or arg == '-':
+            args.tags.append(arg)
+            continue
+
+        if arg == '--':
+            nomoreopts = True
+            continue
+
+        # "--opt=value" и "-oVALUE"
+        value = None
+        if arg.startswith('--'):
+            if '=' in arg:
+                arg, value = arg.split('=', 1)
+        elif len(arg) > 2:
+            arg, value = arg[:2], arg[2:]
+
+        if arg in ('-h', '--help'):
+            __usage_exit(code=0)
+        elif arg in ('-u', '--unique-color'):
+            if value is not None:
+                __usage_exit('у параметра %s не может быть значения' % arg)
+
+            args.uniquecolor = True
+            continue
+        elif arg not in ('-f', '--file', '-n', '--count', '-w', '--weight'):
+            __usage_exit('неизвестный параметр "%s"' % arg)
+
+        if value is None:
+            if not argv:
+                __usage_exit('не указано значение параметра %s' % arg)
+
+            value = argv.pop(0)
+
+        if arg in ('-f', '--file'):
+            args.dbfile = value
+        elif arg in ('-n', '--count'):
+            try:
+                args.count = int(value)
+            except ValueError:
+                args.count = 0
+
+            if args.count < 1:
+                __usage_exit('неправильное количество чернил - "%s"' % value)
         else:
-            ink = None
+            if value not in WEIGHT_FUNCTIONS:
+                __usage_exit('неизвестный режим выбора "%s"' % value)
 
-        self.lastChoice = ink
+            args.weight = value
 
-        return ink
+    return args
 
 
 def __rc_main():
     #TODO присобачить файл настроек с указанием файла БД
 
-    print('%s\n' % TITLE_VERSION)
+    args = process_cmdline()
+
+    # для случайного выбора нужны только чернила в наличии; их данные
+    # берутся из снимка БД, а если его нет или файл БД изменился -
+    # файл разбирается (потоково, без построения полного дерева)
+    # и снимок записывается заново
+    snapshot = RandomInkSnapshot(args.dbfile)
 
-    stats = get_ink_stats(load_ink_db(process_cmdline()))
+    try:
+        snapshot.update()
+    except OSError as ex:
+        print('Ошибка: %s' % str(ex), file=sys.stderr)
+        return 1
 
-    if not stats.availInks:
+    print('%s\n' % snapshot.title)
+
+    if not snapshot.records:
         print('Нет чернил - не из чего выбирать')
         return 0
 
     excludeTags = set()
     includeTags = set()
 
-    for arg in sys.argv[1:]:
+    for arg in args.tags:
         arg = arg.lower()
 
         if arg.startswith('!'):
@@ -129,18 +700,25 @@ def __rc_main():
         else:
             includeTags.add(arg)
 
-    chooser = RandomInkChooser(stats, excludeTags, includeTags)
+    chooser = RandomInkChooser(None, excludeTags, includeTags, snapshot.records,
+        snapshot.get_tag_table(), WEIGHT_FUNCTIONS[args.weight])
 
-    ink = chooser.choice()
-    if not ink:
+    inks = chooser.sample(args.count, args.uniquecolor)
+    if not inks:
         print('ничего подходящего не нашлось')
+    elif len(inks) == 1:
+        ink = inks[0]
+
+        print('\033[1m%s (%s)\033[0m' % (ink.text, ink.tagsText))
+        print(ink.description)
+        if ink.availability:
+            print('\n\033[3mВ наличии: %s\033[0m' % ink.availability)
     else:
-        inkName, inkTags, inkDescription, inkAvailability = stats.get_ink_description(ink)
+        for ix, ink in enumerate(inks, 1):
+            print('%d. \033[1m%s\033[0m (%s)' % (ix, ink.text, ink.tagsText))
 
-        print('\033[1m%s (%s)\033[0m' % (inkName, inkTags))
-        print(fill(inkDescription))
-        if inkAvailability:
-            print('\n\033[3mВ наличии: %s\033[0m' % inkAvailability)
+        if len(inks) < args.count:
+            print('\n(больше ничего подходящего не нашлось)')
 
     return 0
 
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" inkstatsmodel.py
+
+    Copyright 2020-2021 MC-6312 (http://github.com/mc6312)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+from gtktools import *
+from gi.repository import Gtk, GObject
+from gi.repository.GdkPixbuf import Pixbuf
+
+
+class DetailStatsModel(GObject.GObject, Gtk.TreeModel):
+    """Облегчённая модель для дерева детальной статистики.
+
+    Строки не копируются в Gtk.TreeStore, а берутся прямо из
+    статистики (экземпляра inkavail.InkNodeStatistics) при запросе
+    от Gtk.TreeView, т.е. формируются только для отображаемых строк.
+
+    Дерево трёхуровневое:
+    1. таблицы статистики - экземпляры TagStatInfo из stats.tagStats;
+    2. метки таблицы со счётчиками;
+    3. чернила с соответствующей меткой.
+
+    Столбцы: экземпляр InkHeadlineNode (или None для строк
+    первых двух уровней), название, четыре строки счётчиков
+    (см. TagStatInfo.StatValue.counter_strs()), значок цвета.
+
+    Модель неизменяемая: при изменении статистики следует создать
+    новый экземпляр модели и подставить его в Gtk.TreeView.
+
+    Положение строки в Gtk.TreeIter хранится в виде индексов на
+    каждом уровне, увеличенных на единицу (0 - уровня нет)
+    в полях user_data, user_data2 и user_data3."""
+
+    COLUMN_TYPES = (GObject.TYPE_PYOBJECT,
+        GObject.TYPE_STRING,
+        GObject.TYPE_STRING, GObject.TYPE_STRING, GObject.TYPE_STRING, GObject.TYPE_STRING,
+        Pixbuf.__gtype__)
+
+    # макс. кол-во запоминаемых строк (см. get_row())
+    ROW_CACHE_SIZE = 2048
+
+    MAX_DEPTH = 3
+
+    def __init__(self, stats, inkrowf):
+        """Параметры:
+        stats   - экземпляр InkNodeStatistics или None;
+        inkrowf - функция, получающая экземпляр InkHeadlineNode
+                  и возвращающая кортеж со значениями столбцов
+                  для строки чернил."""
+
+        super().__init__()
+
+        self.stats = stats
+        self.inkRowF = inkrowf
+
+        self.stamp = id(self) & 0x7fffffff
+
+        self.groups = stats.tagStats if stats is not None else []
+
+        # отсортированные списки кортежей (метка, TagStatInfo.StatValue)
+        # для каждой таблицы; заполняются при первом обращении
+        self.groupItems = [None] * len(self.groups)
+
+        # отсортированные списки чернил; ключи - кортежи индексов
+        # (таблица, метка)
+        self.groupInks = {}
+
+        # ключи - кортежи индексов, значения - кортежи значений столбцов
+        self.rowCache = {}
+
+    def get_group_items(self, gix):
+        """Возвращает список кортежей (метка, экземпляр StatValue)
+        для таблицы с индексом gix в порядке отображения."""
+
+        items = self.groupItems[gix]
+
+        if items is None:
+            tagstat = self.groups[gix]
+
+            items = list(tagstat.stats.items())
+
+            # мелкий костылинг: сортироваться должны только списки,
+            # полученные обработкой директив TAGSTATS
+            if tagstat.issortable:
+                # порядок сортировки: наличие, название метки
+                def __group_key_f(r):
+                    return '%5d%s' % (r[1].available,
+                                      self.stats.get_tag_display_name(r[0]).lower())
+
+                items.sort(key=__group_key_f, reverse=True)
+
+            self.groupItems[gix] = items
+
+        return items
+
+    def get_inks(self, gix, tix):
+        """Возвращает список чернил для метки с индексом tix
+        таблицы с индексом gix."""
+
+        key = (gix, tix)
+        inks = self.groupInks.get(key)
+
+        if inks is None:
+            # конкретные марки чернил сортируем уже по названию в алфавитном порядке
+            inks = sorted(self.get_group_items(gix)[tix][1].inks, key=lambda i: i.text.lower())
+            self.groupInks[key] = inks
+
+        return inks
+
+    def prepare(self):
+        """Генератор, заранее формирующий отсортированные списки
+        меток и чернил (см. get_group_items() и get_inks()) -
+        по одному списку за шаг.
+
+        Предназначен для выполнения по кусочку в обработчике
+        GLib.idle_add(), пока пользователь ничего не делает, дабы
+        ветви потом разворачивались без задержки; если ветвь
+        развернули раньше, её списки формируются сразу при обращении,
+        а генератор их просто пропускает.
+        Возвращаемые значения - кортежи индексов обработанной строки."""
+
+        for gix in range(len(self.groups)):
+            items = self.get_group_items(gix)
+            yield (gix,)
+
+            for tix in range(len(items)):
+                self.get_inks(gix, tix)
+                yield (gix, tix)
+
+    def get_n_children(self, ixs):
+        """Возвращает кол-во дочерних строк у строки с индексами ixs
+        (кортежем; пустой кортеж - корень дерева)."""
+
+        depth = len(ixs)
+
+        if depth == 0:
+            return len(self.groups)
+        elif depth == 1:
+            return len(self.get_group_items(ixs[0]))
+        elif depth == 2:
+            # для подсчёта сортировать список чернил не нужно
+            return len(self.get_group_items(ixs[0])[ixs[1]][1].inks)
+        else:
+            return 0
+
+    def is_valid_indices(self, ixs):
+        if not ixs or len(ixs) > self.MAX_DEPTH:
+            return False
+
+        for depth, ix in enumerate(ixs):
+            if ix < 0 or ix >= self.get_n_children(ixs[:depth]):
+                return False
+
+        return True
+
+    def get_row(self, ixs):
+        """Возвращает кортеж со значениями столбцов строки
+        с индексами ixs."""
+
+        row = self.rowCache.get(ixs)
+
+        if row is None:
+            depth = len(ixs)
+
+            if depth == 1:
+                row = (None, self.groups[ixs[0]].title, '', '', '', '', None)
+            elif depth == 2:
+                tag, nfo = self.get_group_items(ixs[0])[ixs[1]]
+                row = (None, self.stats.get_tag_display_name(tag), *nfo.counter_strs(), None)
+            else:
+                row = self.inkRowF(self.get_inks(ixs[0], ixs[1])[ixs[2]])
+
+            if len(self.rowCache) >= self.ROW_CACHE_SIZE:
+                self.rowCache.clear()
+
+            self.rowCache[ixs] = row
+
+        return row
+
+    def __new_iter(self, ixs):
+        itr = Gtk.TreeIter()
+        itr.stamp = self.stamp
+
+        depth = len(ixs)
+        itr.user_data = ixs[0] + 1
+        itr.user_data2 = ixs[1] + 1 if depth > 1 else 0
+        itr.user_data3 = ixs[2] + 1 if depth > 2 else 0
+
+        return itr
+
+    @staticmethod
+    def __get_indices(itr):
+        if not itr.user_data2:
+            return (itr.user_data - 1,)
+        elif not itr.user_data3:
+            return (itr.user_data - 1, itr.user_data2 - 1)
+        else:
+            return (itr.user_data - 1, itr.user_data2 - 1, itr.user_data3 - 1)
+
+    @staticmethod
+    def __set_last_index(itr, depth, ix):
+        if depth == 1:
+            itr.user_data = ix + 1
+        elif depth == 2:
+            itr.user_data2 = ix + 1
+        else:
+            itr.user_data3 = ix + 1
+
+    #
+    # реализация Gtk.TreeModel
+    #
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self):
+        return len(self.COLUMN_TYPES)
+
+    def do_get_column_type(self, n):
+        return self.COLUMN_TYPES[n]
+
+    def do_get_iter(self, path):
+        ixs = tuple(path.get_indices())
+
+        if self.is_valid_indices(ixs):
+            return (True, self.__new_iter(ixs))
+
+        return (False, None)
+
+    def do_get_path(self, itr):
+        return Gtk.TreePath.new_from_indices(self.__get_indices(itr))
+
+    def do_get_value(self, itr, column):
+        if column == 0:
+            # сами чернила берём прямо из списка, не формируя строку -
+            # этот столбец перебирают при построении индекса
+            # (см. gtktools.TreeModelIndex)
+            if itr.user_data3:
+                return self.get_inks(itr.user_data - 1, itr.user_data2 - 1)[itr.user_data3 - 1]
+
+            return None
+
+        return self.get_row(self.__get_indices(itr))[column]
+
+    def do_iter_next(self, itr):
+        ix = itr.user_data3
+        if ix:
+            # строки чернил - самый частый случай: при разворачивании
+            # ветви Gtk.TreeView перебирает все дочерние строки,
+            # потому обходимся без кортежей индексов
+            if ix < len(self.get_group_items(itr.user_data - 1)[itr.user_data2 - 1][1].inks):
+                itr.user_data3 = ix + 1
+                return True
+
+            return False
+
+        ixs = self.__get_indices(itr)
+        ix = ixs[-1] + 1
+
+        if ix < self.get_n_children(ixs[:-1]):
+            self.__set_last_index(itr, len(ixs), ix)
+            return True
+
+        return False
+
+    def do_iter_previous(self, itr):
+        ixs = self.__get_indices(itr)
+        ix = ixs[-1] - 1
+
+        if ix >= 0:
+            self.__set_last_index(itr, len(ixs), ix)
+            return True
+
+        return False
+
+    def do_iter_children(self, parent):
+        return self.do_iter_nth_child(parent, 0)
+
+    def do_iter_has_child(self, itr):
+        if itr.user_data3:
+            # у строк чернил дочерних строк не бывает
+            return False
+
+        return self.get_n_children(self.__get_indices(itr)) > 0
+
+    def do_iter_n_children(self, itr):
+        return self.get_n_children(() if itr is None else self.__get_indices(itr))
+
+    def do_iter_nth_child(self, parent, n):
+        ixs = () if parent is None else self.__get_indices(parent)
+
+        if 0 <= n < self.get_n_children(ixs):
+            return (True, self.__new_iter(ixs + (n,)))
+
+        return (False, None)
+
+    def do_iter_parent(self, child):
+        ixs = self.__get_indices(child)
+
+        if len(ixs) > 1:
+            return (True, self.__new_iter(ixs[:-1]))
+
+        return (False, None)
+
+
+def __debug_model():
+    from inkavail import load_ink_db, get_ink_stats
+
+    stats = get_ink_stats(load_ink_db('inks.org'))
+    model = DetailStatsModel(stats, lambda ink: (ink, ink.text, '', '', '', '', None))
+
+    def __print_level(parent, indent):
+        itr = model.iter_children(parent)
+
+        while itr is not None:
+            print('%s%s %s' % (indent, model.get_path(itr), model.get_value(itr, 1)))
+            __print_level(itr, indent + '  ')
+
+            itr = model.iter_next(itr)
+
+    __print_level(None, '')
+
+
+if __name__ == '__main__':
+    print('[debugging %s]' % __file__)
+
+    __debug_model()
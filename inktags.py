@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" inktags.py
+
+    This file is part of InkTools.
+
+    InkTools is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    InkTools is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with InkTools.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+class TagTable():
+    """Таблица интернирования меток.
+
+    Каждой метке назначается номер бита, набору меток соответствует
+    целое - битовая маска, так что проверки вида "есть ли у чернил
+    какая-то из меток" сводятся к одной битовой операции.
+    Регистр букв в метках не учитывается.
+
+    Поля:
+    bits    - словарь, где ключи - метки (как в нижнем регистре,
+              так и в том виде, в котором они встречались),
+              а значения - номера битов;
+    tags    - список меток в нижнем регистре, индекс - номер бита."""
+
+    def __init__(self, tags=()):
+        """tags - последовательность меток, которым биты
+        назначаются сразу (напр., из директивы +TAGS)."""
+
+        self.bits = dict()
+        self.tags = []
+
+        self.add_tags(tags)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def get_bit(self, tag):
+        """Возвращает номер бита для метки tag,
+        при необходимости назначает новый."""
+
+        bit = self.bits.get(tag)
+        if bit is None:
+            ltag = tag.lower()
+
+            bit = self.bits.get(ltag)
+            if bit is None:
+                bit = len(self.tags)
+                self.tags.append(ltag)
+                self.bits[ltag] = bit
+
+            # запоминаем и исходное написание, чтобы не вызывать
+            # lower() для той же метки повторно
+            self.bits[tag] = bit
+
+        return bit
+
+    def add_tags(self, tags):
+        for tag in tags:
+            self.get_bit(tag)
+
+    def get_mask(self, tags):
+        """Возвращает битовую маску для последовательности меток tags
+        (незнакомым меткам назначаются новые биты)."""
+
+        mask = 0
+        for tag in tags:
+            mask |= 1 << self.get_bit(tag)
+
+        return mask
+
+    def find_mask(self, tags):
+        """Возвращает битовую маску для последовательности меток tags,
+        не добавляя в таблицу незнакомые метки (для фильтров - у чернил
+        таких меток всё равно нет)."""
+
+        mask = 0
+        for tag in tags:
+            bit = self.bits.get(tag)
+            if bit is None:
+                bit = self.bits.get(tag.lower())
+
+            if bit is not None:
+                mask |= 1 << bit
+
+        return mask
+
+    def get_tags(self, mask):
+        """Возвращает список меток (в нижнем регистре) из маски mask."""
+
+        return [tag for bit, tag in enumerate(self.tags) if (mask >> bit) & 1]
+
+
+if __name__ == '__main__':
+    print('[debugging %s]' % __file__)
+
+    tt = TagTable(('Blue', 'red'))
+    print(tt.tags, bin(tt.get_mask(('red', 'BLUE', 'green'))), bin(tt.find_mask(('green', 'nosuch'))))
@@ -21,7 +21,7 @@
 
 from gtktools import *
 
-from gi.repository import Gtk, GdkPixbuf
+from gi.repository import Gtk, GdkPixbuf, GLib
 from gi.repository.GdkPixbuf import Pixbuf
 from gi.repository.GLib import markup_escape_text
 
@@ -29,15 +29,19 @@ from gtkchecklistbox import CheckListBox
 
 import sys
 import os.path
+import threading
 from shutil import which
 from subprocess import Popen
+from time import perf_counter
 
 from colorsys import rgb_to_hls
 from math import sqrt
 
 from inktoolscfg import *
 from inkavail import *
+from inkdbcache import InkDBCache
 from inkrandom import RandomInkChooser
+from inkstatsmodel import DetailStatsModel
 
 
 class MainWnd():
@@ -61,12 +65,21 @@ class MainWnd():
 
     DET_COL_INK, DET_COL_LABEL,\
     DET_COL_AVAIL, DET_COL_UNAVAIL, DET_COL_WANTED, DET_COL_UNWANTED,\
-    DET_COL_COLOR, DET_COL_HINT = range(8)
+    DET_COL_COLOR = range(7)
+
+    # макс. время (в секундах) одного шага подготовки списков
+    # detailstats в обработчике GLib.idle_add() (см. start_detail_prepare())
+    DET_PREPARE_TIME = 0.02
 
     SAMPLE_COL_VALUE, SAMPLE_COL_HINT, SAMPLE_COL_PIX = range(3)
 
     COPY_RGB, COPY_HEX, COPY_HLS = range(3)
 
+    # цвета значков в detailstats
+    CTODO = '#fd0'
+    CNODO = '#c00'
+    CDONE = '#0f0'
+
     def wnd_destroy(self, widget):
         Gtk.main_quit()
 
@@ -108,6 +121,8 @@ class MainWnd():
         self.cfg.maxPixelSamplerMode = len(self.cursorSamplers) - 1
         self.cfg.load()
 
+        self.dbcache = InkDBCache(self.cfg.configDir)
+
         resldr = get_resource_loader()
         uibldr = get_gtk_builder(resldr, 'inktools.ui')
 
@@ -120,6 +135,21 @@ class MainWnd():
         self.rndchooser = None
         self.stats = None
 
+        # фоновая загрузка БД (см. load_db())
+        self.dbLoadThread = None
+        self.dbLoadPending = False
+
+        # подсказки к строкам detailstats (см. get_ink_hint())
+        self.inkHints = {}
+
+        # подготовка списков detailstats в фоне (см. start_detail_prepare())
+        self.detailPrepareGen = None
+        self.detailPrepareIdle = None
+
+        # чернила, которые следует выбрать в detailstats, когда
+        # будет готов индекс (см. select_detail_ink())
+        self.detailPendingInk = None
+
         # для выбора в случайном выбираторе
         self.includetags = set()
         self.excludetags = set()
@@ -155,6 +185,9 @@ class MainWnd():
 
         _, self.samplePixbufSize, _ = Gtk.IconSize.lookup(Gtk.IconSize.MENU)
 
+        # общие для всех виджетов значки-образцы цветов
+        self.swatches = SwatchCache()
+
         #
         # страница статистики
         #
@@ -163,10 +196,16 @@ class MainWnd():
             Gtk.IconSize.MENU,
             'dialog-question-symbolic')
 
-        self.totalstatlstore, self.totalstatview = get_ui_widgets(uibldr,
-            'totalstatlstore', 'totalstatview')
+        self.totalstats = TreeViewShell.new_from_uibuilder(uibldr, 'totalstatview')
 
         self.detailstats = TreeViewShell.new_from_uibuilder(uibldr, 'detailstatsview')
+
+        # строк может быть очень много, потому ширины столбцов считаем
+        # заранее, а не по содержимому строк
+        cntwidth = self.detailstats.get_text_width('00000')
+        self.detailstats.set_fixed_height_mode((WIDGET_BASE_WIDTH * 32,
+            self.samplePixbufSize,
+            cntwidth, cntwidth, cntwidth, cntwidth))
         detailstatswnd = uibldr.get_object('detailstatswnd')
 
         # костылинг
@@ -206,9 +245,6 @@ class MainWnd():
         self.includetagstxt, self.excludetagstxt, self.tagchooserdlg = get_ui_widgets(uibldr,
             'includetagstxt', 'excludetagstxt', 'tagchooserdlg')
 
-        self.randominkColorPixbuf = Pixbuf.new(GdkPixbuf.Colorspace.RGB,
-            False, 8, self.samplePixbufSize, self.samplePixbufSize)
-
         self.tagchecklistbox = CheckListBox(selectionbuttons=True)
         # костыль
         # потому что set_min_content_width с какого-то хрена не работает
@@ -233,9 +269,7 @@ class MainWnd():
             'labCursorRGBX', 'imgLens', 'imgCursorColor')
 
         self.pixbuf = None
-        self.pixbufPixels = None
-        self.pixbufChannels = 0
-        self.pixbufRowStride = 0
+        self.pixelSampler = None
         self.pixbufCX = 0
         self.pixbufCY = 0
 
@@ -268,6 +302,10 @@ class MainWnd():
             'btnSampleRemove')
         self.itrSelectedSample = None
 
+        # для быстрой проверки наличия образца цвета в списке;
+        # строки добавляются и удаляются только через индекс
+        self.samplesIndex = TreeModelIndex(self.lstoreSamples, self.SAMPLE_COL_VALUE)
+
         self.cursorSampler = self.get_pixbuf_pixel_color
 
         for ix, (rbtnn, sampler) in enumerate(self.cursorSamplers):
@@ -364,127 +402,209 @@ class MainWnd():
             self.cursorSampler = self.cursorSamplers[samplerIx][-1]
             self.cfg.pixelSamplerMode = samplerIx
 
-    def load_db(self):
-        self.totalstatview.set_model(None)
-        self.totalstatlstore.clear()
-
-        self.detailstats.view.set_model(None)
-        self.detailstats.store.clear()
-
-        expand = []
+    def get_detail_ink_row(self, ink):
+        """Возвращает кортеж со значениями столбцов строки
+        detailstats.store для ink (экземпляра InkHeadlineNode).
+        Всплывающая подсказка в строку не входит, см. get_ink_hint()."""
 
         def __bool_s(b, clr=None):
             st = '√' if clr is None else '<span color="%s"><b>√</b></span>' % clr
             return st if b else ''
 
-        CTODO = '#fd0'
-        CNODO = '#c00'
-        CDONE = '#0f0'
+        if ink.color:
+            pbuf = self.swatches.get_swatch(ink.color, self.samplePixbufSize)
+        else:
+            pbuf = self.nocoloricon
+
+        bunwanted = ink.done is None
+
+        return (ink,
+            ink.text,
+            # avail
+            __bool_s(ink.avail, self.CDONE),
+            # unavail
+            __bool_s(not ink.avail, None if bunwanted else self.CTODO),
+            # wanted
+            __bool_s(ink.done == False, self.CTODO), # прямое сравнение, т.к. иначе None будет воспринято тоже как False
+            # unwanted
+            __bool_s(bunwanted, self.CNODO),
+            pbuf)
+
+    def get_ink_hint(self, ink):
+        """Возвращает строку с разметкой Pango для всплывающей подсказки
+        к строке detailstats с чернилами ink (экземпляром InkHeadlineNode).
+        Подсказки формируются только при первом запросе и запоминаются
+        в словаре inkHints."""
+
+        hint = self.inkHints.get(ink)
+        if hint is not None:
+            return hint
+
+        # 'название', 'отсортированный список человекочитаемых меток', 'описание', 'наличие'
+        _inkname, _inktags, _inkdesc, _inkavail = self.stats.get_ink_description(ink)
+
+        hint = ['<b>%s</b>' % markup_escape_text(_inkname)]
+
+        if ink.color:
+            hint.append('Цвет: <span color="#%.6x">██</span> %s' % (ink.color,
+                markup_escape_text(ColorValue.new_from_rgb24(ink.color).get_description())))
+
+        if _inkdesc:
+            hint.append(markup_escape_text(_inkdesc))
+
+        if _inkavail:
+            hint.append('В наличии: %s' % markup_escape_text(_inkavail))
+
+        if ink.done == False:
+            hint.append('Запланирована покупка этих чернил')
+
+        if ink.missing:
+            hint.append('Отсутствуют данные: %s' % self.stats.get_ink_missing_data_str(ink))
+
+        hint = '\n\n'.join(hint)
+        self.inkHints[ink] = hint
+
+        return hint
+
+    def detailstatsview_query_tooltip(self, tv, x, y, kbmode, tooltip):
+        r, x, y, model, path, itr = tv.get_tooltip_context(x, y, kbmode)
+        if not r:
+            return False
+
+        ink = model.get_value(itr, self.DET_COL_INK)
+        if ink is None:
+            return False
+
+        tooltip.set_markup(self.get_ink_hint(ink))
+        tv.set_tooltip_row(tooltip, path)
+
+        return True
+
+    def fill_total_stats(self):
+        """Заполнение таблицы общей статистики."""
+
+        self.totalstats.bulk_load(self.stats.get_total_result_table())
+
+    def load_db(self):
+        """Загрузка файла БД self.cfg.databaseFileName.
+
+        Разбор файла и подсчёт статистики выполняются в отдельном
+        потоке, дабы не подвешивать интерфейс на больших файлах;
+        до окончания загрузки отображаются прежние данные.
+        Если загрузка уже идёт, новая будет запущена после её
+        окончания, а результат текущей - выброшен."""
+
+        if self.dbLoadThread is not None:
+            # прервать разбор файла в потоке нельзя, потому
+            # откладываем загрузку до его завершения
+            self.dbLoadPending = True
+            return
+
+        self.dbLoadPending = False
+
+        fname = self.cfg.databaseFileName
+
+        self.headerbar.set_subtitle('%s: загрузка...' % os.path.split(fname)[-1] if fname else '')
+
+        self.dbLoadThread = threading.Thread(target=self.__load_db_thread,
+            args=(fname,), daemon=True)
+        self.dbLoadThread.start()
+
+    def __load_db_thread(self, fname):
+        """Загрузка БД в отдельном потоке (см. load_db()).
+        GTK отсюда трогать нельзя - всё, что касается интерфейса,
+        передаётся главному потоку через GLib.idle_add()."""
+
+        def __progress(stage):
+            GLib.idle_add(self.__load_db_progress, fname, stage)
+
+        db = None
+        stats = None
+        error = None
 
         try:
-            self.db = load_ink_db(self.cfg.databaseFileName)
-            self.stats = get_ink_stats(self.db)
-            self.rndchooser = None
-
-            # статистика
-            if self.stats:
-                dfname = os.path.split(self.cfg.databaseFileName)[-1]
-
-                #
-                # общая статистика
-                #
-                totals = self.stats.get_total_result_table()
-
-                for row in totals:
-                    self.totalstatlstore.append(row)
-
-                #
-                # детали
-                #
-                for tagstat in self.stats.tagStats:
-                    itr = self.detailstats.store.append(None,
-                            (None, tagstat.title, '', '', '', '', None, None))
-
-                    expand.append(self.detailstats.store.get_path(itr))
-
-                    _items = tagstat.stats.items()
-
-                    # мелкий костылинг: сортироваться должны только списки,
-                    # полученные обработкой директив TAGSTATS
-
-                    if tagstat.issortable:
-                        # порядок сортировки: название метки, наличие
-                        # на кой чорт питонщики сделали key вместо cmp?
-                        # в случае cmp не пришлось бы тратить память на
-                        # значение временного ключа сортировки
-                        # и фрагментировать кучу
-                        def __group_key_f(r):
-                            return '%5d%s' % (r[1].available,
-                                              self.stats.get_tag_display_name(r[0]).lower())
-
-                        _items = sorted(_items, key=__group_key_f, reverse=True)
-
-                    for tag, nfo in _items:
-                        row = (None, self.stats.get_tag_display_name(tag),
-                            *nfo.counter_strs(), None,
-                            None)
-
-                        subitr = self.detailstats.store.append(itr, row)
-
-                        # конкретные марки чернил сортируем уже по названию в алфавитном порядке
-                        for ink in sorted(nfo.inks, key=lambda i: i.text.lower()):
-                            if ink.color:
-                                pbuf = Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, self.samplePixbufSize, self.samplePixbufSize)
-                                pbuf.fill(int(ColorValue.get_rgb32_value(ink.color)))
-                            else:
-                                pbuf = self.nocoloricon
-
-                            # 'название', 'отсортированный список человекочитаемых меток', 'описание', 'наличие'
-                            _inkname, _inktags, _inkdesc, _inkavail = self.stats.get_ink_description(ink)
-
-                            hint = ['<b>%s</b>' % markup_escape_text(_inkname)]
-
-                            if ink.color:
-                                hint.append('Цвет: <span color="#%.6x">██</span> %s' % (ink.color,
-                                    markup_escape_text(ColorValue.new_from_rgb24(ink.color).get_description())))
-
-                            if _inkdesc:
-                                hint.append(markup_escape_text(_inkdesc))
-
-                            if _inkavail:
-                                hint.append('В наличии: %s' % markup_escape_text(_inkavail))
-
-                            if ink.done == False:
-                                hint.append('Запланирована покупка этих чернил')
-
-                            if ink.missing:
-                                hint.append('Отсутствуют данные: %s' % self.stats.get_ink_missing_data_str(ink))
-
-                            bunwanted = ink.done is None
-                            self.detailstats.store.append(subitr,
-                                    (ink,
-                                    ink.text,
-                                    # avail
-                                    __bool_s(ink.avail, CDONE),
-                                    # unavail
-                                    __bool_s(not ink.avail, None if bunwanted else CTODO),
-                                    # wanted
-                                    __bool_s(ink.done == False, CTODO), # прямое сравнение, т.к. иначе None будет воспринято тоже как False
-                                    # unwanted
-                                    __bool_s(bunwanted, CNODO),
-                                    pbuf,
-                                    '\n\n'.join(hint)))
-
-                self.rndchooser = RandomInkChooser(self.stats, None, None)
+            db, stats = self.dbcache.load_ink_db(fname, True, __progress)
+        except Exception as ex:
+            error = ex
 
-            else:
-                dfname = ''
+        GLib.idle_add(self.__load_db_done, fname, db, stats, error)
+
+    def __load_db_progress(self, fname, stage):
+        # сообщения от устаревшей загрузки не показываем
+        if self.dbLoadThread is not None and not self.dbLoadPending:
+            self.headerbar.set_subtitle('%s: %s...' % (os.path.split(fname)[-1], stage))
+
+        return False
+
+    def __load_db_done(self, fname, db, stats, error):
+        """Завершение фоновой загрузки БД; вызывается в главном потоке."""
+
+        self.dbLoadThread = None
+
+        if self.dbLoadPending:
+            # за время загрузки запрошен другой файл или перезагрузка
+            self.load_db()
+
+        elif error is not None:
+            print('* %s' % str(error), file=sys.stderr)
+
+            self.headerbar.set_subtitle(os.path.split(self.db.text)[-1] if self.db is not None else '')
+
+            msg_dialog(self.window, TITLE,
+                'Ошибка загрузки файла "%s":\n%s' % (fname, str(error)))
+
+        else:
+            self.set_db(db, stats)
+
+        return False
+
+    def set_db(self, db, stats):
+        """Отображение загруженной БД.
+
+        db      - экземпляр InkOrgParser или None;
+        stats   - экземпляр InkNodeStatistics или None.
+
+        Таблица общей статистики заполняется в новый экземпляр
+        Gtk.ListStore, а для детальной статистики
+        создаётся новый экземпляр DetailStatsModel; затем они
+        подставляются вместо прежних."""
+
+        self.inkHints.clear()
+
+        # новый экземпляр будет подключен к totalstats.view
+        # в конце заполнения (см. TreeViewShell.bulk_load())
+        self.totalstats.store = new_model_like(self.totalstats.store)
+
+        self.db = db
+        self.stats = stats
+        self.rndchooser = None
+
+        # статистика
+        if self.stats:
+            dfname = os.path.split(self.cfg.databaseFileName)[-1]
 
             #
-            # метки
+            # общая статистика
             #
-            self.tagchecklistbox.clear_items()
+            self.fill_total_stats()
+
+            self.rndchooser = RandomInkChooser(self.stats, None, None)
 
+        else:
+            dfname = ''
+            self.totalstats.view.set_model(self.totalstats.store)
+
+        # детали
+        # ветви верхнего уровня (таблицы) разворачиваем все
+        self.set_detail_model(DetailStatsModel(self.stats, self.get_detail_ink_row),
+            None)
+
+        #
+        # метки
+        #
+        self.tagchecklistbox.clear_items()
+
+        if self.stats:
             def __add_tag(tagname):
                 tagdisp = tagname if tagname not in self.stats.tagNames else self.stats.tagNames[tagname]
                 self.tagchecklistbox.add_item(False, tagdisp, tagname)
@@ -502,29 +622,256 @@ class MainWnd():
                 for tagname in sorted(self.stats.tags):
                     __add_tag(tagname)
 
-            self.includetags.clear() # пустое множество - выбирать все
-            self.excludetags.clear() # пустое множество - не исключать ничего
+        self.includetags.clear() # пустое множество - выбирать все
+        self.excludetags.clear() # пустое множество - не исключать ничего
 
-            self.includetagstxt.set_text(self.INCLUDE_ANY)
-            self.excludetagstxt.set_text(self.EXCLUDE_NOTHING)
+        self.includetagstxt.set_text(self.INCLUDE_ANY)
+        self.excludetagstxt.set_text(self.EXCLUDE_NOTHING)
 
-            #
+        #
+
+        self.openorgfiledlg.select_filename(self.cfg.databaseFileName)
+        self.headerbar.set_subtitle(dfname)
+
+        self.cfg.add_recent_file(self.cfg.databaseFileName)
+        self.update_recent_files_menu()
 
-            self.openorgfiledlg.select_filename(self.cfg.databaseFileName)
-            self.headerbar.set_subtitle(dfname)
+        self.choose_random_ink()
 
-            self.cfg.add_recent_file(self.cfg.databaseFileName)
-            self.update_recent_files_menu()
+    def get_detail_row_labels(self, path):
+        """Возвращает кортеж с названиями строк detailstats
+        (таблицы, метки и чернил) на пути от верхнего уровня
+        до строки path (экземпляра Gtk.TreePath).
+        В отличие от самого пути, названия остаются годными
+        и после замены модели (см. find_detail_row())."""
 
-        finally:
-            self.detailstats.view.set_model(self.detailstats.store)
+        store = self.detailstats.store
+        ixs = tuple(path.get_indices())
 
-            for path in expand:
-                self.detailstats.view.expand_row(path, False)
+        return tuple(store.get_row(ixs[:depth])[self.DET_COL_LABEL]
+            for depth in range(1, len(ixs) + 1))
 
-            self.totalstatview.set_model(self.totalstatlstore)
+    def find_detail_row(self, labels):
+        """Поиск строки detailstats по кортежу названий, полученному
+        от get_detail_row_labels().
 
-        self.choose_random_ink()
+        Возвращает экземпляр Gtk.TreePath найденной строки; если
+        строки уже нет - путь к ближайшей сохранившейся вышестоящей
+        строке; если нет и таблицы - None."""
+
+        model = self.detailstats.store
+        ixs = ()
+
+        for label in labels:
+            if len(ixs) < 2:
+                for ix in range(model.get_n_children(ixs)):
+                    if model.get_row(ixs + (ix,))[self.DET_COL_LABEL] == label:
+                        break
+                else:
+                    break
+            else:
+                # строки чернил не формируем - названия берём
+                # прямо из списка
+                for ix, ink in enumerate(model.get_inks(*ixs)):
+                    if ink.text == label:
+                        break
+                else:
+                    break
+
+            ixs += (ix,)
+
+        return Gtk.TreePath.new_from_indices(ixs) if ixs else None
+
+    def get_detail_expanded(self):
+        """Возвращает множество кортежей с названиями развёрнутых
+        ветвей detailstats (название таблицы или название таблицы
+        и метки) - см. set_detail_model()."""
+
+        expanded = set()
+
+        def __add_row(tv, path, *data):
+            expanded.add(self.get_detail_row_labels(path))
+
+        self.detailstats.view.map_expanded_rows(__add_row)
+
+        return expanded
+
+    def set_detail_model(self, model, expanded):
+        """Подстановка новой модели в detailstats.view.
+
+        model       - экземпляр DetailStatsModel;
+        expanded    - None (развернуть все ветви верхнего уровня)
+                      или множество, полученное от get_detail_expanded()
+                      для прежней модели."""
+
+        self.stop_detail_prepare()
+
+        self.detailstats.set_index(None)
+        self.detailstats.store = model
+        self.detailstats.view.set_model(model)
+
+        for gix in range(model.get_n_children(())):
+            glabel = model.get_row((gix,))[self.DET_COL_LABEL]
+
+            if expanded is not None and (glabel,) not in expanded:
+                continue
+
+            self.detailstats.view.expand_row(Gtk.TreePath.new_from_indices((gix,)), False)
+
+            if expanded:
+                for tix in range(model.get_n_children((gix,))):
+                    if (glabel, model.get_row((gix, tix))[self.DET_COL_LABEL]) in expanded:
+                        self.detailstats.view.expand_row(Gtk.TreePath.new_from_indices((gix, tix)), False)
+
+        self.start_detail_prepare()
+
+    def start_detail_prepare(self):
+        """Запуск подготовки списков меток и чернил модели
+        detailstats (см. DetailStatsModel.prepare()) и индекса
+        строк чернил (см. select_detail_ink()) в промежутках
+        между событиями - таблицы верхнего уровня видны сразу,
+        а ко времени разворачивания ветвей их содержимое, скорее
+        всего, уже готово."""
+
+        self.stop_detail_prepare()
+
+        self.detailPrepareGen = self.__detail_prepare_steps()
+        self.detailPrepareIdle = GLib.idle_add(self.__detail_prepare_idle)
+
+    def __detail_prepare_steps(self):
+        """Генератор для __detail_prepare_idle(): подготовка
+        списков модели, затем построение индекса."""
+
+        model = self.detailstats.store
+
+        yield from model.prepare()
+
+        # модель неизменяемая, так что индекс достаточно построить
+        # один раз
+        index = TreeModelIndex(model, self.DET_COL_INK, False)
+        yield from index.iter_rebuild()
+
+        self.detailstats.set_index(index)
+
+        if self.detailPendingInk is not None:
+            self.select_detail_ink(self.detailPendingInk)
+
+    def stop_detail_prepare(self):
+        """Остановка подготовки, запущенной start_detail_prepare()."""
+
+        if self.detailPrepareIdle is not None:
+            GLib.source_remove(self.detailPrepareIdle)
+            self.detailPrepareIdle = None
+
+        self.detailPrepareGen = None
+
+    def __detail_prepare_idle(self):
+        """Шаг подготовки списков detailstats; управление отдаётся
+        главному циклу, как только на шаг потрачено DET_PREPARE_TIME
+        секунд, дабы не тормозить UI."""
+
+        tend = perf_counter() + self.DET_PREPARE_TIME
+
+        for ixs in self.detailPrepareGen:
+            if perf_counter() >= tend:
+                return True
+
+        self.detailPrepareGen = None
+        self.detailPrepareIdle = None
+
+        return False
+
+    def reload_db(self):
+        """Перезагрузка изменившегося файла БД (например, после правки
+        в редакторе, см. start_editor()).
+        Заново разбираются только изменённые блоки файла (см.
+        inkavail.update_ink_db()); модель detailstats создаётся заново
+        (это дёшево, т.к. строки формируются только при отображении),
+        развёрнутые ветви, курсор и положение прокрутки сохраняются."""
+
+        if self.dbLoadThread is not None or self.db is None or self.stats is None or self.db.text != self.cfg.databaseFileName:
+            self.load_db()
+            return
+
+        oldTagStats = self.stats.tagStats
+
+        try:
+            self.stats, changes = self.dbcache.update_ink_db(self.db, self.stats)
+        except OSError as ex:
+            print('* %s' % str(ex), file=sys.stderr)
+            changes = None
+
+        if changes is None or self.stats.tagStats != oldTagStats:
+            # статистика посчитана заново или изменился состав таблиц -
+            # обновляем всё (разбирать файл ещё раз load_db не будет -
+            # обновлённые данные уже лежат в кэше)
+            self.load_db()
+            return
+
+        rminks, newinks = changes
+        if not rminks and not newinks:
+            return
+
+        rmset = set(rminks)
+
+        for ink in rminks:
+            self.inkHints.pop(ink, None)
+
+        self.fill_total_stats()
+
+        vadj = self.detailstats.view.get_vadjustment()
+        vpos = vadj.get_value()
+        expanded = self.get_detail_expanded()
+
+        cursor = self.detailstats.view.get_cursor()[0]
+        if cursor is not None:
+            cursor = self.get_detail_row_labels(cursor)
+
+        self.set_detail_model(DetailStatsModel(self.stats, self.get_detail_ink_row),
+            expanded)
+
+        if cursor is not None:
+            # курсор (а с ним и выделение) ставим на ту же строку
+            # новой модели, если она уцелела
+            cursor = self.find_detail_row(cursor)
+            if cursor is not None:
+                self.detailstats.view.set_cursor(cursor, None, False)
+
+        # размеры дерева пересчитываются не сразу, поэтому
+        # положение прокрутки восстанавливаем потом
+        GLib.idle_add(vadj.set_value, vpos)
+
+        if self.rndchooser is not None:
+            # списки чернил в статистике поменялись
+            self.rndchooser.invalidate()
+            self.rndchooser.filter_inks(self.excludetags, self.includetags)
+
+        if self.chosenInk in rmset:
+            # если выбранные чернила изменились - показываем новую версию
+            for ink in newinks:
+                if ink.text == self.chosenInk.text:
+                    self.show_ink(ink, False)
+                    break
+            else:
+                self.choose_random_ink()
+
+    def select_detail_ink(self, ink):
+        """Выбор в detailstats первой строки с чернилами ink
+        (экземпляром InkHeadlineNode), если таковая есть.
+        Если индекс строк чернил ещё не построен (см.
+        start_detail_prepare()) - выбор откладывается до его
+        готовности, дабы не перебирать всё дерево."""
+
+        if self.detailstats.index is None:
+            self.detailPendingInk = ink
+            return
+
+        self.detailPendingInk = None
+
+        itr = self.detailstats.find_iter(self.DET_COL_INK, ink)
+
+        if itr is not None:
+            self.detailstats.select_iter(itr)
 
     def detailstatsview_row_activated(self, tv, path, col):
         ink = self.detailstats.store.get_value(self.detailstats.store.get_iter(path),
@@ -546,7 +893,7 @@ class MainWnd():
 
         self.chosenInk = ink
 
-        self.randominkusageview.refresh_begin()
+        usagerows = []
 
         if not ink:
             inknamet = 'ничего подходящего не нашлось'
@@ -566,7 +913,7 @@ class MainWnd():
                 inkstatust = 'планируется покупка'
 
             if ink.color:
-                inkcolor = ColorValue.get_rgb32_value(ink.color)
+                inkcolor = ink.color
                 inkcolordesc = ColorValue.new_from_rgb24(ink.color).get_description()
 
             if ink.maincolor:
@@ -579,11 +926,11 @@ class MainWnd():
             for unfo in ink.usage:
                 _dd = dnow - unfo.date
 
-                self.randominkusageview.store.append((str(unfo.date),
+                usagerows.append((str(unfo.date),
                     'сегодня' if _dd.days <= 1 else '%d дн. назад' % _dd.days,
                     unfo.comment))
 
-        self.randominkusageview.refresh_end()
+        self.randominkusageview.bulk_load(usagerows)
 
         self.randominkname.set_text(inknamet)
         self.randominktags.set_markup(inktagst)
@@ -598,11 +945,13 @@ class MainWnd():
         if inkcolor is None:
             self.randominkcolorimg.set_from_pixbuf(self.nocoloricon)
         else:
-            self.randominkColorPixbuf.fill(inkcolor)
-            self.randominkcolorimg.set_from_pixbuf(self.randominkColorPixbuf)
+            self.randominkcolorimg.set_from_pixbuf(self.swatches.get_swatch(inkcolor, self.samplePixbufSize))
 
         if switchpage:
             self.pages.set_visible_child(self.pageChooser)
+        elif ink:
+            # выбранные чернила сразу видны и на странице статистики
+            self.select_detail_ink(ink)
 
     def choose_random_ink(self):
         if self.rndchooser is not None:
@@ -665,7 +1014,7 @@ class MainWnd():
         if not self.cfg.databaseFileName:
             self.select_load_db()
         else:
-            self.load_db()
+            self.reload_db()
 
     def mnuFileEdit_activate(self, wgt):
         self.start_editor()
@@ -764,9 +1113,18 @@ class MainWnd():
             0, 0, 1.0, 1.0,
             GdkPixbuf.InterpType.TILES, 255);
 
-        self.pixbufPixels = self.pixbuf.get_pixels()
-        self.pixbufChannels = self.pixbuf.get_n_channels()
-        self.pixbufRowStride = self.pixbuf.get_rowstride()
+        if self.pixelSampler is not None:
+            # если предыдущее изображение ещё обсчитывается - бросаем
+            self.pixelSampler.cancel()
+
+        # get_pixels() возвращает копию данных, потому вызываем его один раз
+        self.pixelSampler = PixelSampler(self.pixbuf.get_pixels(),
+            self.pixbufCX, self.pixbufCY,
+            self.pixbuf.get_n_channels(), self.pixbuf.get_rowstride())
+
+        # яркость и насыщенность всех точек считаем в фоне,
+        # до окончания подсчёта выборка работает и без них
+        threading.Thread(target=self.pixelSampler.compute_planes, daemon=True).start()
 
         #self.swImgView.set_max_content_width(self.pixbufCX)
         #self.swImgView.set_max_content_height(self.pixbufCY)
@@ -777,7 +1135,7 @@ class MainWnd():
         self.swImgView.get_vadjustment().set_value(0)
 
         #
-        self.lstoreSamples.clear()
+        self.samplesIndex.clear()
         self.update_sample_count()
         self.compute_average_color()
 
@@ -796,13 +1154,7 @@ class MainWnd():
         self.btnImageFile.grab_focus()
 
     def color_sample_find_itr(self, v):
-        itr = self.lstoreSamples.get_iter_first()
-
-        while itr is not None:
-            if v == self.lstoreSamples.get_value(itr, self.SAMPLE_COL_VALUE):
-                return itr
-
-            itr = self.lstoreSamples.iter_next(itr)
+        return self.samplesIndex.find(v)
 
     def color_sample_add(self, x, y):
         colorv = self.cursorSampler(x, y)
@@ -813,10 +1165,9 @@ class MainWnd():
         itr = self.color_sample_find_itr(colorv)
 
         if (itr is None) and (self.lstoreSamples.iter_n_children() < self.MAX_COLOR_SAMPLES):
-            pbuf = Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, self.samplePixbufSize, self.samplePixbufSize)
-            pbuf.fill(int(colorv))
+            pbuf = self.swatches.get_swatch(int(colorv) >> 8, self.samplePixbufSize)
 
-            itr = self.lstoreSamples.append((colorv,
+            itr = self.samplesIndex.append((colorv,
                 'R=%d, G=%d, B=%d (%s)' % (*colorv.get_values(), colorv.hexv),
                 pbuf))
 
@@ -826,16 +1177,16 @@ class MainWnd():
             self.compute_average_color()
 
     def compute_average_color(self):
-        colorv = ColorValue(0, 0, 0)
+        avgcolor = ColorAccumulator()
 
         itr = self.lstoreSamples.get_iter_first()
 
         while itr is not None:
-            colorv.avg_color_add(self.lstoreSamples.get_value(itr, self.SAMPLE_COL_VALUE))
+            avgcolor.avg_color_add(self.lstoreSamples.get_value(itr, self.SAMPLE_COL_VALUE))
 
             itr = self.lstoreSamples.iter_next(itr)
 
-        colorv = colorv.avg_color_get()
+        colorv = avgcolor.avg_color_get()
 
         if colorv:
             self.averageColorPixbuf.fill(int(colorv))
@@ -851,14 +1202,14 @@ class MainWnd():
 
     def color_sample_remove(self):
         if self.itrSelectedSample:
-            self.lstoreSamples.remove(self.itrSelectedSample)
+            self.samplesIndex.remove(self.itrSelectedSample)
             self.compute_average_color()
 
     def btnSampleRemove_clicked(self, btn):
         self.color_sample_remove()
 
     def btnSampleRemoveAll_clicked(self, btn):
-        self.lstoreSamples.clear()
+        self.samplesIndex.clear()
         self.compute_average_color()
 
     def ivSamples_selection_changed(self, iv):
@@ -899,51 +1250,20 @@ class MainWnd():
         Возвращает экземпляр ColorValue, если координаты находятся
         внутри границ self.pixel, иначе None."""
 
-        if (self.pixbuf is None) or (x < 0) or (x >= self.pixbufCX) or (y < 0) or (y >= self.pixbufCY):
+        if self.pixelSampler is None:
             return None
 
-        pix = x * self.pixbufChannels + y * self.pixbufRowStride
-
-        return ColorValue(self.pixbufPixels[pix],
-                self.pixbufPixels[pix + 1],
-                self.pixbufPixels[pix + 2])
-
-    def __scan_pixel_area(self, x, y, cmpf):
-        """Просматривает область 7х7 точек вокруг указанных координат.
-        Возвращает экземпляр ColorValue для точки, наиболее
-        подходящей под условие. Если область за пределами изображения,
-        возвращает None.
-
-        x, y    - координаты курсора;
-        cmpf    - функция;
-                  получает два экземпляра ColorValue,
-                  возвращает булевское значение, результат сравнения
-                  цветов."""
-
-        # размер области пока приколочен гвоздями
-
-        retc = None
-
-        for ox in range(x - 3, x + 4):
-            for oy in range(y - 3, y + 4):
-                c = self.get_pixbuf_pixel_color(ox, oy)
-
-                if c is not None:
-                    if (retc is None) or (cmpf(retc, c)):
-                        retc = c
-                        retc = c
-
-        return retc
+        return self.pixelSampler.get_pixel_color(x, y)
 
     def get_pixbuf_intense_color(self, x, y):
         """Возвращает значение самого тёмного и насыщенного цвета из
         области 7х7 в виде экземпляра ColorValue.
         Если область за пределами границ self.pixbuf, возвращает None."""
 
-        def __is_intense(clr, otherclr):
-            return (clr.s < otherclr.s) and (clr.l > otherclr.l)
+        if self.pixelSampler is None:
+            return None
 
-        return self.__scan_pixel_area(x, y, __is_intense)
+        return self.pixelSampler.get_intense_color(x, y)
 
     def motion_event(self, x, y):
         self.lensPixbuf.fill(self.sampleFillColor)
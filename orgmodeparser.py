@@ -23,8 +23,13 @@
 
 
 import sys
-import os.path
+import os, os.path
 import re
+import io
+import mmap
+import locale
+import hashlib
+from collections import namedtuple
 
 
 VERSION = '0.9'
@@ -40,12 +45,31 @@ class OrgNode():
                   НЕ обновляет номера строк!
     text        - строка (содержимое);
                   подробности зависят от класса-потомка;
-    children    - список дочерних ветвей."""
+    children    - список дочерних ветвей;
+                  у ветвей без потомков - пустой кортеж EMPTY_CHILDREN,
+                  общий для всех экземпляров (дабы не тратить память
+                  на пустые списки), поэтому для добавления дочерних
+                  ветвей следует использовать метод add_child().
+
+    Все классы ветвей дерева используют __slots__ - экземпляров
+    в дереве много, и словари атрибутов им ни к чему."""
+
+    __slots__ = 'line', 'text', 'children'
+
+    EMPTY_CHILDREN = ()
 
     def __init__(self, text):
         self.line = 0
         self.text = text
-        self.children = []
+        self.children = self.EMPTY_CHILDREN
+
+    def add_child(self, node):
+        """Добавление дочерней ветви node (экземпляра OrgNode)."""
+
+        if self.children:
+            self.children.append(node)
+        else:
+            self.children = [node]
 
     def find_text_node_by_regex(self, regex):
         """Ищет в списке children первый дочерний
@@ -150,10 +174,16 @@ class OrgHeadlineNode(OrgNode):
     done        - None или булевское значение:
                   True для DONE, False для TODO;
     priority    - None или строка "A"/"B"/"C";
-    tags        - тэги - список строк (м.б. пустым);
+    tags        - тэги - список строк;
                   т.к. порядок тэгов должен быть тот же, что в .org-файле,
                   и формат допускает пустые пару "::", здесь используем
-                  список, а не множество."""
+                  список, а не множество;
+                  если тэгов нет - пустой кортеж NO_TAGS, общий для
+                  всех экземпляров."""
+
+    __slots__ = 'done', 'priority', 'tags'
+
+    NO_TAGS = ()
 
     # тэги м.б. только в конце строки!
     __RX_HEADLINE = re.compile('^((TODO|DONE)?\s+)?(\[#(A|B|C)\]\s+)?(.*?)?(:(\S*):)?\s*$', re.UNICODE)
@@ -161,7 +191,7 @@ class OrgHeadlineNode(OrgNode):
     def __init__(self, text):
         self.done = None
         self.priority = None
-        self.tags = []
+        self.tags = self.NO_TAGS
 
         rm = self.__RX_HEADLINE.match(text)
         if rm:
@@ -209,13 +239,15 @@ class OrgTextNode(OrgNode):
     """Простой текст.
     В поле text - весь текст соотв. строки."""
 
-    pass
+    __slots__ = ()
 
 
 class OrgCommentNode(OrgNode):
     """Комментарий.
     В поле text - единственный элемент, весь текст соотв. строки."""
 
+    __slots__ = ()
+
     def __str__(self):
         return '# %s' % self.text
 
@@ -226,6 +258,8 @@ class OrgDirectiveNode(OrgCommentNode):
     name    - имя директивы,
     text    - аргументы директивы (остаток строки после ":")."""
 
+    __slots__ = ('name',)
+
     def __init__(self, text, name):
         super().__init__(text)
         self.name = name
@@ -235,9 +269,15 @@ class OrgDirectiveNode(OrgCommentNode):
 
 
 class OrgParseIter():
-    """Класс итератора для синтаксического разбора org-файла."""
+    """Класс итератора для синтаксического разбора org-файла.
+
+    Разбор производится генератором tokens(), который классифицирует
+    каждую строку файла целиком (строковыми методами, без посимвольного
+    прохода) и возвращает компактные кортежи (type, line, value).
+    При использовании экземпляра класса как итератора эти кортежи
+    оборачиваются в экземпляры TokenInfo - для совместимости."""
 
-    class TokenInfo():
+    class TokenInfo(namedtuple('TokenInfo', 'type line value')):
         """Синтаксический элемент файла.
         Поля:
         type    - int, значение HEADLINE/...;
@@ -252,158 +292,363 @@ class OrgParseIter():
                               после этого токена должен следовать
                               токен с type=TEXT и аргументами директивы."""
 
-        __slots__ = 'type', 'line', 'value'
+        __slots__ = ()
 
         HEADLINE, HLEXIT, TEXT, COMMENT, DIRECTIVE = range(5)
 
         TKN_NAME = ('HEADLINE', 'HLEXIT', 'TEXT', 'COMMENT', 'DIRECTIVE')
 
-        def __init__(self, type_, line, value):
-            self.type, self.line, self.value = type_, line, value
-
         def __repr__(self):
             return '%s(type=%s, line=%d%s)' % (self.__class__.__name__,
                 self.TKN_NAME[self.type],
                 self.line,
                 '' if self.value is None else ', value="%s"' % self.value)
 
-    def __init__(self, fileobj):
-        self.fileobj = fileobj
-        self.buf = None
-        self.buflen = 0
-        self.bufpos = 0
+    # символы, из которых может состоять имя директивы "#+NAME: value(s)"
+    CTL_WORD_CHARS = '_ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 
-        self.level = 0
-        self.oldlevel = 0
+    def __init__(self, fileobj, firstline=1):
+        """fileobj      - файловый объект, открытый в текстовом режиме,
+                          или любой другой итерируемый объект,
+                          возвращающий строки;
+        firstline       - номер первой строки (для разбора фрагмента
+                          файла, начинающегося не с первой строки)."""
 
-        self.hold = []
+        self.fileobj = fileobj
+        self.firstLine = firstline
 
-        self.lineno = 0
+        self.__tokens = self.tokens()
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        """Возвращает кортеж из трёх элементов:
-        токен (int),
-        уровень вложенности (int),
-        значение (str).
+        """Возвращает экземпляр TokenInfo.
         Если файл кончился, генерирует исключение StopIteration."""
 
-        # возвращаем "отложенные" токены
-        if self.hold:
-            return self.hold.pop()
-
-        if self.buf is None or self.bufpos >= self.buflen:
-            # вот тут и может вылезти StopIteration
-            try:
-                # пробельные символы в начале строки ОСТАВЛЯЕМ!
-                # они учитываются Emacs в случае (вложенных) списков и т.п.
-                self.buf = next(self.fileobj).rstrip()
-                self.lineno += 1
-            except StopIteration:
-                if self.hold:
-                    return self.hold.pop()
-                else:
-                    raise StopIteration
+        return self.TokenInfo._make(next(self.__tokens))
 
-            self.buflen = len(self.buf)
-            self.bufpos = 0
+    def tokens(self):
+        """Генератор токенов.
 
-        if self.buflen == 0:
-            return self.TokenInfo(self.TokenInfo.TEXT, self.lineno, '')
+        Возвращает кортежи из трёх элементов - (type, line, value),
+        значения полей - как у одноимённых полей TokenInfo.
+        Экземпляр TokenInfo на каждый токен не создаётся,
+        поэтому для быстрого разбора следует использовать
+        этот метод, а не итерацию по экземпляру класса."""
 
-        def __skip_space():
-            while self.bufpos < self.buflen and self.buf[self.bufpos].isspace(): self.bufpos += 1
+        # локальные переменные - ради скорости
+        ti = self.TokenInfo
+        HEADLINE, HLEXIT, TEXT, COMMENT, DIRECTIVE = ti.HEADLINE, ti.HLEXIT, ti.TEXT, ti.COMMENT, ti.DIRECTIVE
+        ctlchars = self.CTL_WORD_CHARS
 
-        def __is_ctl_word(frompos, topos):
-            """Проверка, содержит ли self.buf[frompos:topos] только заглавные символы
-            латинского алфавита и символ "_".
-            Возвращает True в случае соответствия, иначе - False."""
+        level = 0
 
-            while frompos < topos:
-                if self.buf[frompos] not in '_ABCDEFGHIJKLMNOPQRSTUVWXYZ':
-                    return False
+        for lineno, buf in enumerate(self.fileobj, self.firstLine):
+            # пробельные символы в начале строки ОСТАВЛЯЕМ!
+            # они учитываются Emacs в случае (вложенных) списков и т.п.
+            buf = buf.rstrip()
 
-                frompos += 1
+            if not buf:
+                yield (TEXT, lineno, '')
+                continue
+
+            c = buf[0]
 
-            return True
+            if c == '*':
+                value = buf.lstrip('*')
 
-        if self.buf.startswith('*'):
-            while self.bufpos < self.buflen and self.buf[self.bufpos] == '*': self.bufpos += 1
+                # "заголовком" считается строка с цепочкой из "*" в начале И пробелом после "*"
+                if not value or not value[0].isspace():
+                    # не заголовок - просто строка с "*" в начале!
+                    yield (TEXT, lineno, buf)
+                    continue
 
-            # "заголовком" считается строка с цепочкой из "*" в начале И пробелом после "*"
-            if self.bufpos >= self.buflen or not self.buf[self.bufpos].isspace():
-                # не заголовок - просто строка с "*" в начале!
-                self.bufpos = self.buflen
-                return self.TokenInfo(self.TokenInfo.TEXT, self.lineno, self.buf)
+                nstars = len(buf) - len(value)
 
-            self.oldlevel = self.level
+                # кол-во "*" в заголовке блока может быть произвольным
+                # но level нельзя увеличивать больше, чем на 1 за раз
+                if nstars > level:
+                    level += 1
+                else:
+                    # HLEXITы должны приезжать перед следующим HEADLINE:
+                    # один - за выход из текущего блока, и ещё по одному
+                    # на каждую ступень возврата, т.к. при уменьшении
+                    # уровень уменьшаем на любое значение
+                    hlexit = (HLEXIT, lineno, None)
+                    yield hlexit
+
+                    while level > nstars:
+                        yield hlexit
+                        level -= 1
+
+                yield (HEADLINE, lineno, value.lstrip())
+
+            elif c == '#':
+                # проверяем, не директива ли это вида "#+NAME: value(s)"
+                if buf.startswith('#+'):
+                    colonpos = buf.find(':', 2)
+
+                    # имя директивы состоит только из символов ctlchars
+                    # (strip() для такой строки вернёт пустую строку)
+                    if colonpos >= 0 and not buf[2:colonpos].strip(ctlchars):
+                        # первым возвращаем токен DIRECTIVE с value='имя_директивы',
+                        # за ним следует TEXT с аргументами
+                        yield (DIRECTIVE, lineno, buf[2:colonpos])
+                        yield (TEXT, lineno, buf[colonpos + 1:].strip())
+                        continue
+
+                # не директива, а простой комментарий
+                yield (COMMENT, lineno, buf[1:].lstrip())
 
-            # кол-во "*" в заголовке блока может быть произвольным
-            # но level нельзя увеличивать больше, чем на 1 за раз
-            if self.bufpos > self.level:
-                self.level += 1
-            elif self.bufpos < self.level:
-                # а вот при уменьшении - уменьшаем на любое значение,
-                # т.к. может быть возврат на несколько ступеней сразу
-                self.level = self.bufpos
+            else:
+                yield (TEXT, lineno, buf)
 
-            __skip_space()
 
-            headtkn = self.TokenInfo(self.TokenInfo.HEADLINE, self.lineno, self.buf[self.bufpos:])
-            self.bufpos = self.buflen
+class OrgBytesParseIter(OrgParseIter):
+    """Итератор для синтаксического разбора org-файла, загруженного
+    в память (или отображённого в память через mmap) целиком.
 
-            if self.level <= self.oldlevel:
-                # HLEXITы должны приезжать перед следующим HEADLINE
-                self.hold.append(headtkn)
+    Границы строк и префиксы "*"/"#" ищутся в "сырых" байтах,
+    в строки (str) декодируются только те фрагменты, которые
+    становятся значениями токенов.
+    Поток токенов совпадает с потоком OrgParseIter для того же файла,
+    открытого в текстовом режиме с той же кодировкой.
+    Внимание! Кодировка должна быть совместимой с ASCII (напр. UTF-8)."""
 
-                delta = self.oldlevel - self.level
+    # символы, которые str.isspace() считает пробельными,
+    # в виде байтов (кроме '\r' и '\n', т.к. они в строку не попадут)
+    __ASCII_SPACES = b' \t\x0b\x0c\x1c\x1d\x1e\x1f'
 
-                while delta > 0:
-                    self.hold.append(self.TokenInfo(self.TokenInfo.HLEXIT, self.lineno, None))
-                    delta -= 1
+    # одиночный CR (не из пары CR LF)
+    __RX_LONE_CR = re.compile(b'\r(?!\n)')
 
-                return self.TokenInfo(self.TokenInfo.HLEXIT, self.lineno, None)
-            else:
-                return headtkn
+    # размер блоков, на которые режется буфер при поиске границ строк
+    BLOCK_SIZE = 1 << 20
 
-        if self.buf.startswith('#'):
-            self.bufpos += 1
-            bufpos0 = self.bufpos
+    # максимальная длина (в байтах) строк, для которых
+    # кэшируются результаты декодирования
+    MAX_CACHED_LENGTH = 40
 
-            tkn = self.TokenInfo.COMMENT
+    def __init__(self, buf, encoding=None):
+        """buf         - bytes, bytearray, mmap.mmap или другой объект,
+                      поддерживающий buffer protocol, срезы и метод find();
+        encoding    - None или строка с названием кодировки;
+                      если None - используется та же кодировка,
+                      что и по умолчанию у open()."""
 
-            # проверяем, не директива ли это вида "#+NAME: value(s)"
-            if self.bufpos < self.buflen + 3 and self.buf[self.bufpos] == '+':
-                while True:
-                    self.bufpos += 1
-                    if self.bufpos >= self.buflen:
-                        break
+        super().__init__(buf)
 
-                    colonpos = self.buf.find(':', self.bufpos)
-                    if colonpos < 0:
-                        break
+        self.encoding = encoding if encoding else locale.getpreferredencoding(False)
 
-                    if not __is_ctl_word(self.bufpos, colonpos):
-                        break
+    def __split_lines(self, buf):
+        """Генератор, возвращающий списки строк (bytes, без '\\n')
+        из буфера buf, нарезанного на блоки примерно по BLOCK_SIZE байт
+        (по границам строк).
+        Т.о. в памяти одновременно находится не весь файл, а только
+        один блок."""
 
-                    # первым возвращаем токен DIRECTIVE с value='имя_директивы',
-                    # за ним следует TEXT с аргументами
-                    self.hold.append(self.TokenInfo(self.TokenInfo.TEXT, self.lineno, self.buf[colonpos + 1:].strip()))
-                    self.bufpos = self.buflen
-                    return self.TokenInfo(self.TokenInfo.DIRECTIVE, self.lineno, self.buf[bufpos0 + 1:colonpos])
+        buflen = len(buf)
+        pos = 0
 
-            # не директива, а простой комментарий - откатываемся взад и вертаем всю строку
-            self.bufpos = bufpos0
-            __skip_space()
-        else:
-            tkn = self.TokenInfo.TEXT
+        while pos < buflen:
+            end = pos + self.BLOCK_SIZE
 
-        bufpos = self.bufpos
-        self.bufpos = self.buflen
+            if end < buflen:
+                eol = buf.rfind(b'\n', pos, end)
+                if eol < 0:
+                    # строка длиннее блока
+                    eol = buf.find(b'\n', end)
 
-        return self.TokenInfo(tkn, self.lineno, self.buf[bufpos:])
+                end = buflen if eol < 0 else eol + 1
+            else:
+                end = buflen
+
+            lines = buf[pos:end].split(b'\n')
+
+            # за последним '\n' блока - пустой "хвост", который строкой не является
+            if not lines[-1]:
+                del lines[-1]
+
+            pos = end
+
+            yield lines
+
+    def tokens(self):
+        """Генератор токенов, см. OrgParseIter.tokens()."""
+
+        ti = self.TokenInfo
+        HEADLINE, HLEXIT, TEXT, COMMENT, DIRECTIVE = ti.HEADLINE, ti.HLEXIT, ti.TEXT, ti.COMMENT, ti.DIRECTIVE
+        ctlchars = self.CTL_WORD_CHARS.encode('ascii')
+        spaces = self.__ASCII_SPACES
+        encoding = self.encoding
+
+        # короткие строки (вроде "нет", "флакон 30 мл" или заголовков
+        # "параметры" и "в наличии") в БД часто повторяются - такие
+        # декодируются один раз, и все соотв. ветви дерева ссылаются
+        # на один и тот же экземпляр str
+        cache = {}
+        maxcached = self.MAX_CACHED_LENGTH
+
+        buf = self.fileobj
+
+        if self.__RX_LONE_CR.search(buf):
+            # в файле есть одиночные CR, которые в текстовом режиме
+            # тоже считаются переводами строк - разбираем по-простому,
+            # иначе номера строк не совпадут
+            yield from OrgParseIter(io.StringIO(buf[:].decode(encoding), newline=None)).tokens()
+            return
+
+        level = 0
+        lineno = 0
+
+        for lines in self.__split_lines(buf):
+            for line in lines:
+                line = line.rstrip()
+                lineno += 1
+
+                if not line:
+                    yield (TEXT, lineno, '')
+                    continue
+
+                c = line[0]
+
+                if c == 42: # '*'
+                    value = line.lstrip(b'*')
+
+                    if value and value[0] >= 0x80:
+                        # после "*" - не-ASCII символ, который тоже может
+                        # оказаться пробельным; такие строки разбираем
+                        # как текст, т.е. так же, как OrgParseIter
+                        sline = line.decode(encoding).rstrip()
+                        svalue = sline.lstrip('*')
+
+                        if not svalue or not svalue[0].isspace():
+                            yield (TEXT, lineno, sline)
+                            continue
+
+                        svalue = svalue.lstrip()
+                    elif not value or value[0] not in spaces:
+                        # не заголовок - просто строка с "*" в начале!
+                        yield (TEXT, lineno, line.decode(encoding).rstrip())
+                        continue
+                    else:
+                        if len(value) <= maxcached:
+                            svalue = cache.get(value)
+                            if svalue is None:
+                                svalue = cache[value] = value.decode(encoding).strip()
+                        else:
+                            svalue = value.decode(encoding).strip()
+
+                        if not svalue:
+                            # после "*" были только пробельные символы
+                            yield (TEXT, lineno, line.decode(encoding).rstrip())
+                            continue
+
+                    nstars = len(line) - len(value)
+
+                    if nstars > level:
+                        level += 1
+                    else:
+                        hlexit = (HLEXIT, lineno, None)
+                        yield hlexit
+
+                        while level > nstars:
+                            yield hlexit
+                            level -= 1
+
+                    yield (HEADLINE, lineno, svalue)
+
+                elif c == 35: # '#'
+                    if line.startswith(b'#+'):
+                        colonpos = line.find(b':', 2)
+
+                        # имя директивы состоит только из ASCII-символов,
+                        # так что позиции в байтах и в символах совпадают
+                        if colonpos >= 0 and not line[2:colonpos].strip(ctlchars):
+                            yield (DIRECTIVE, lineno, line[2:colonpos].decode('ascii'))
+                            yield (TEXT, lineno, line[colonpos + 1:].decode(encoding).strip())
+                            continue
+
+                    yield (COMMENT, lineno, line[1:].decode(encoding).strip())
+
+                else:
+                    if len(line) <= maxcached:
+                        value = cache.get(line)
+                        if value is None:
+                            value = cache[line] = line.decode(encoding).rstrip()
+                    else:
+                        value = line.decode(encoding).rstrip()
+
+                    yield (TEXT, lineno, value)
+
+
+def build_org_tree(destnode, tokens, new_headline_node=OrgHeadlineNode):
+    """Построение дерева из потока токенов.
+
+    destnode            - экземпляр OrgNode, в список children которого
+                          добавляются элементы;
+    tokens              - итератор, возвращающий кортежи (type, line, value),
+                          см. OrgParseIter.tokens();
+    new_headline_node   - функция, создающая ветви-заголовки (см.
+                          MinimalOrgParser.new_headline_node()).
+
+    Функция завершается, когда кончаются токены, или на токене HLEXIT,
+    выводящем за пределы destnode (этот токен считывается из tokens),
+    т.е. если destnode - ветвь-заголовок, уже созданная по токену
+    HEADLINE, функция строит только поддерево destnode."""
+
+    ti = OrgParseIter.TokenInfo
+    HEADLINE, HLEXIT, TEXT, COMMENT, DIRECTIVE = ti.HEADLINE, ti.HLEXIT, ti.TEXT, ti.COMMENT, ti.DIRECTIVE
+
+    add_child = OrgNode.add_child
+
+    # дерево строится без рекурсии: вместо вложенного вызова
+    # для каждого заголовка состояние текущего уровня
+    # (ветвь, в которую добавляются элементы, префикс директивы
+    # и последний добавленный элемент) сохраняется в стеке
+    stack = []
+
+    prefix = None
+    dname = None
+    node = None
+
+    for ttype, tline, tvalue in tokens:
+        if ttype == HEADLINE:
+            node = new_headline_node(tvalue)
+            node.line = tline
+            add_child(destnode, node)
+
+            stack.append((destnode, prefix, dname, node))
+
+            destnode = node
+            prefix = None
+            dname = None
+            node = None
+            continue
+        elif ttype == HLEXIT:
+            if not stack:
+                break
+
+            destnode, prefix, dname, node = stack.pop()
+            continue
+        elif ttype == COMMENT:
+            node = OrgCommentNode(tvalue)
+            add_child(destnode, node)
+        elif ttype == DIRECTIVE:
+            prefix = ttype
+            dname = tvalue
+        elif ttype == TEXT:
+            if prefix == DIRECTIVE:
+                node = OrgDirectiveNode(tvalue, dname)
+            else:
+                node = OrgTextNode(tvalue)
+
+            add_child(destnode, node)
+            prefix = None
+
+        if node:
+            node.line = tline
 
 
 class MinimalOrgParser(OrgNode):
@@ -412,50 +657,226 @@ class MinimalOrgParser(OrgNode):
     Понимает только блоки с заголовками, комментарии, директивы и
     простой текст. Ключевые слова (кроме TODO/DONE и приоритетов в
     заголовках headlines), списки и всё прочее считается
-    частью текстового содержимого соответствующих элементов."""
+    частью текстового содержимого соответствующих элементов.
+
+    Поля (кроме унаследованных от OrgNode):
+    preambleHash    - None или хэш (bytes) текста до первого заголовка;
+    blockHashes     - None или список хэшей (bytes) текстов блоков
+                      верхнего уровня (см. split_blocks()) в порядке
+                      их следования в файле; соответствующие блокам
+                      ветви-заголовки находятся в конце списка children.
+    Хэши используются методом update() и вычисляются, только если
+    конструктору передан параметр trackblocks=True."""
+
+    def __init__(self, filename, usemmap=False, trackblocks=False):
+        """filename    - имя файла;
+        usemmap     - булевское значение; если True - файл не читается
+                      построчно в текстовом режиме, а отображается
+                      в память (mmap) и разбирается OrgBytesParseIter;
+                      результат разбора в обоих случаях одинаков;
+        trackblocks - булевское значение; если True - вычисляются
+                      хэши блоков верхнего уровня для последующей
+                      частичной перезагрузки методом update();
+                      в этом случае usemmap игнорируется."""
 
-    def __init__(self, filename):
         super().__init__(filename)
 
+        self.preambleHash = None
+        self.blockHashes = None
+
+        if trackblocks:
+            with open(filename, 'r') as orgfile:
+                lines = orgfile.readlines()
+
+            self.build_tree(OrgParseIter(lines).tokens())
+            self.preambleHash, self.blockHashes = self.get_block_hashes(lines,
+                self.split_blocks(lines))
+        elif usemmap:
+            with open(filename, 'rb') as orgfile:
+                # пустой файл mmap отображать отказывается
+                if os.fstat(orgfile.fileno()).st_size == 0:
+                    return
+
+                with mmap.mmap(orgfile.fileno(), 0, access=mmap.ACCESS_READ) as orgbuf:
+                    self.build_tree(OrgBytesParseIter(orgbuf).tokens())
+        else:
+            with open(filename, 'r') as orgfile:
+                self.build_tree(OrgParseIter(orgfile).tokens())
+
+    def new_headline_node(self, text):
+        """Создание ветви-заголовка при разборе файла.
+        Потомок может перекрыть этот метод, если для каких-то
+        заголовков нужны экземпляры потомков OrgHeadlineNode.
+
+        text    - строка заголовка без префикса "*".
+
+        Возвращает экземпляр OrgHeadlineNode."""
+
+        return OrgHeadlineNode(text)
+
+    def build_tree(self, tokens, destnode=None):
+        """Построение дерева из потока токенов.
+
+        tokens      - итератор, возвращающий кортежи (type, line, value),
+                      см. OrgParseIter.tokens();
+        destnode    - None или экземпляр OrgNode.
+
+        Элементы добавляются в список children экземпляра destnode,
+        а если он не указан - текущего экземпляра (см. build_org_tree())."""
+
+        build_org_tree(self if destnode is None else destnode, tokens,
+            self.new_headline_node)
+
+    @staticmethod
+    def split_blocks(lines):
+        """Разбивка файла на блоки верхнего уровня.
+
+        lines   - список строк файла.
+
+        Блок верхнего уровня начинается с заголовка, который при разборе
+        попадает в children корня дерева, т.е. с первого заголовка
+        в файле или с заголовка с одной "*", и продолжается до начала
+        следующего такого блока (или до конца файла). Строки до первого
+        блока - "преамбула".
+
+        Возвращает список индексов первых строк блоков в lines
+        (пустой, если заголовков в файле нет)."""
+
+        starts = []
+
+        for ix, buf in enumerate(lines):
+            if not buf.startswith('*'):
+                continue
+
+            # проверка - та же, что в OrgParseIter.tokens()
+            buf = buf.rstrip()
+            value = buf.lstrip('*')
+
+            if not value or not value[0].isspace():
+                continue
+
+            if not starts or len(buf) - len(value) == 1:
+                starts.append(ix)
+
+        return starts
+
+    @staticmethod
+    def get_block_hashes(lines, starts):
+        """Вычисление хэшей преамбулы и блоков верхнего уровня.
+
+        lines   - список строк файла;
+        starts  - список индексов первых строк блоков,
+                  полученный от split_blocks().
+
+        Возвращает кортеж из двух элементов - хэш преамбулы
+        и список хэшей блоков."""
+
+        def __hash(first, last):
+            return hashlib.sha1(''.join(lines[first:last]).encode('utf-8', 'surrogatepass')).digest()
+
+        ends = starts[1:] + [len(lines)]
+
+        return (__hash(0, starts[0] if starts else len(lines)),
+            [__hash(first, last) for first, last in zip(starts, ends)])
+
+    @staticmethod
+    def shift_lines(node, delta):
+        """Прибавление delta к номерам строк ветви node
+        и всех её потомков."""
+
+        stack = [node]
+
+        while stack:
+            node = stack.pop()
+            node.line += delta
+
+            if node.children:
+                stack.extend(node.children)
+
+    def update(self, filename=None):
+        """Повторная загрузка изменившегося файла с разбором только
+        изменённых блоков верхнего уровня (см. split_blocks()).
+
+        filename    - None или имя файла; если None - используется
+                      имя файла, загруженного ранее.
+
+        Блоки нового файла сопоставляются с блоками дерева по хэшам
+        их текста. Ветви блоков, текст которых не изменился, остаются
+        в дереве (номера строк у них и у их потомков при необходимости
+        исправляются), прочие блоки разбираются заново.
+
+        Возвращает кортеж из двух списков - ветвей верхнего уровня,
+        удалённых из дерева и добавленных в дерево, в порядке следования
+        в файле; неизменившиеся ветви в эти списки не попадают.
+
+        Если дерево было загружено без trackblocks=True или изменилась
+        преамбула (в ней могут быть директивы, влияющие на весь файл),
+        дерево строится заново целиком, и метод возвращает None.
+
+        В случае ошибок ввода/вывода генерируются исключения."""
+
+        if filename is None:
+            filename = self.text
+
         with open(filename, 'r') as orgfile:
-            try:
-                orgiter = OrgParseIter(orgfile)
-
-                def parse_block(destnode, level):
-                    prefix = None
-                    dname = None
-
-                    node = None
-
-                    for nfo in orgiter:
-                        if nfo.type == OrgParseIter.TokenInfo.HEADLINE:
-                            node = OrgHeadlineNode(nfo.value)
-                            destnode.children.append(node)
-                            parse_block(destnode.children[-1], level + 1)
-                        elif nfo.type == OrgParseIter.TokenInfo.HLEXIT:
-                            break
-                        elif nfo.type == OrgParseIter.TokenInfo.COMMENT:
-                            node = OrgCommentNode(nfo.value)
-                            destnode.children.append(node)
-                        elif nfo.type == OrgParseIter.TokenInfo.DIRECTIVE:
-                            prefix = nfo.type
-                            dname = nfo.value
-                        elif nfo.type == OrgParseIter.TokenInfo.TEXT:
-                            if prefix == OrgParseIter.TokenInfo.DIRECTIVE:
-                                node = OrgDirectiveNode(nfo.value, dname)
-                            else:
-                                node = OrgTextNode(nfo.value)
-
-                            destnode.children.append(node)
-                            prefix = None
-
-                        if node:
-                            node.line = nfo.line
-
-                parse_block(self, 0)
-
-            except StopIteration:
-                pass
+            lines = orgfile.readlines()
+
+        starts = self.split_blocks(lines)
+        preambleHash, blockHashes = self.get_block_hashes(lines, starts)
+
+        self.text = filename
+
+        if self.blockHashes is None or preambleHash != self.preambleHash:
+            self.children = self.EMPTY_CHILDREN
+            self.build_tree(OrgParseIter(lines).tokens())
+            self.preambleHash, self.blockHashes = preambleHash, blockHashes
+
+            return None
+
+        # ветви блоков - в конце children, перед ними - ветви преамбулы
+        npreamble = len(self.children) - len(self.blockHashes)
+        oldnodes = self.children[npreamble:]
+
+        # ключи - хэши, значения - списки ветвей (одинаковых блоков
+        # в файле может быть несколько)
+        oldblocks = {}
+        for bhash, node in zip(self.blockHashes, oldnodes):
+            if bhash in oldblocks:
+                oldblocks[bhash].append(node)
+            else:
+                oldblocks[bhash] = [node]
+
+        children = self.children[:npreamble]
+        added = []
+        reused = set()
+
+        ends = starts[1:] + [len(lines)]
+
+        for bhash, first, last in zip(blockHashes, starts, ends):
+            nodes = oldblocks.get(bhash)
+
+            if nodes:
+                node = nodes.pop(0)
+                reused.add(node)
+
+                # номер строки заголовка блока - номер первой строки блока
+                delta = first + 1 - node.line
+                if delta:
+                    self.shift_lines(node, delta)
+            else:
+                blockroot = OrgNode(None)
+                self.build_tree(OrgParseIter(lines[first:last], first + 1).tokens(), blockroot)
+
+                # в блоке ровно один заголовок верхнего уровня
+                node = blockroot.children[0]
+                added.append(node)
+
+            children.append(node)
+
+        self.children = children if children else self.EMPTY_CHILDREN
+        self.blockHashes = blockHashes
+
+        return ([node for node in oldnodes if node not in reused], added)
 
     def __dumps_node(self, node, level):
         buf = []
@@ -477,6 +898,27 @@ class MinimalOrgParser(OrgNode):
         return self.__dumps_node(self, level)
 
 
+def __debug_tokenizer_benchmark(fname, repeat=5):
+    """Замер скорости токенизатора OrgParseIter.tokens()."""
+
+    from time import perf_counter
+    from collections import deque
+
+    with open(fname, 'r') as orgfile:
+        lines = orgfile.readlines()
+
+    best = None
+    for _ in range(repeat):
+        t0 = perf_counter()
+        deque(OrgParseIter(iter(lines)).tokens(), maxlen=0)
+        t0 = perf_counter() - t0
+
+        if best is None or t0 < best:
+            best = t0
+
+    print('%s: %d lines, %.3f s (%d lines/s)' % (fname, len(lines), best, len(lines) / best))
+
+
 def __debug_sample():
     fname = 'inks.org'
     rootnode = MinimalOrgParser(fname)